@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Register a directory of source scans against one target on all cores.
+The target is loaded, sampled and preprocessed once in the parent; its
+vertices, faces, sampled points/normals and downsampled points/normals/FPFH
+are put in shared memory, and each worker process maps them as NumPy
+arrays without copying (Open3D keeps its own copy of the clouds, made once
+per worker rather than once per job). Jobs that exceed the timeout or crash their worker
+are recorded as failures and the worker is replaced. Each worker sends its
+results on its own pipe, so killing one cannot leave a shared queue locked
+or half written.
+"""
+import glob
+import json
+import multiprocessing
+import multiprocessing.connection
+import time
+import traceback
+from collections import deque
+from multiprocessing import shared_memory
+from context import *
+from cache_utils import ArrayCache, ResultCache
+from registration_engine import (RegistrationEngine, MeshData, GLOBAL_STAGES, LOCAL_STAGES, DEFAULT_PARAMS,
+                                 PARAM_TYPES)
+from register import to_json
+
+
+def share_arrays(arrays):
+    """
+    Copy arrays into new shared memory blocks.
+    Returns (blocks, spec) where spec is a picklable {name: (block name,
+    shape, dtype)} for attach_arrays. The caller owns the blocks and must
+    close and unlink them.
+    """
+    blocks, spec = [], {}
+    for name, a in arrays.items():
+        a = np.ascontiguousarray(a)
+        # Zero-size blocks are not allowed
+        block = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        np.ndarray(a.shape, a.dtype, buffer=block.buf)[...] = a
+        blocks.append(block)
+        spec[name] = (block.name, a.shape, a.dtype.str)
+    return blocks, spec
+
+
+def attach_arrays(spec):
+    """Read-only views of the arrays described by spec. Keep the blocks alive while using them."""
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        a = np.ndarray(shape, dtype, buffer=block.buf)
+        a.flags.writeable = False
+        blocks.append(block)
+        arrays[name] = a
+    return blocks, arrays
+
+
+def worker_main(tasks, results, target_path, spec, voxel_size, engine_args):
+    """
+    Worker process body: attach the target, then register sources from
+    tasks until None, sending (index, result) on the results connection.
+    """
+    blocks, arrays = attach_arrays(spec)
+    engine = RegistrationEngine(**engine_args)
+    engine.add_mesh(MeshData.from_arrays(target_path, arrays, engine.params["samples"], voxel_size))
+    # Ready: job timeouts start counting from here, not from process start
+    results.send((None, None))
+    while True:
+        job = tasks.get()
+        if job is None:
+            break
+        index, source_path = job
+        try:
+            result = engine.register(source_path, target_path)
+        except Exception:
+            result = {"source": source_path, "target": target_path, "error": traceback.format_exc()}
+        # Sources are used once, do not keep them around
+        engine.drop_source(source_path)
+        results.send((index, result))
+    del arrays
+    for block in blocks:
+        block.close()
+
+
+class Worker:
+    def __init__(self, ctx, target_path, spec, voxel_size, engine_args):
+        self.tasks = ctx.Queue()
+        self.results, sender = ctx.Pipe(duplex=False)
+        self.ready = False
+        self.job = None
+        self.started = None
+        self.process = ctx.Process(
+            target=worker_main, args=(self.tasks, sender, target_path, spec, voxel_size, engine_args),
+            daemon=True)
+        self.process.start()
+        # Only the worker writes, so the pipe reports EOF once it is gone
+        sender.close()
+
+    def submit(self, job):
+        self.job = job
+        self.started = time.perf_counter()
+        self.tasks.put(job)
+
+
+def batch_register(source_paths, target_path, num_workers=None, timeout=None, progress=None,
+                   cache: ArrayCache | None = None, start_method="spawn", **engine_args):
+    """
+    Register every source against target_path in num_workers processes
+    (default: all cores) sharing the preprocessed target. Returns one
+    result dict per source, in order, as RegistrationEngine.register does;
+    failed jobs have an "error" entry instead of a transformation. A job
+    running longer than timeout seconds kills its worker. progress, if
+    given, is called as progress(done, total, result) after each job.
+    engine_args are passed to RegistrationEngine.
+    """
+    num_workers = num_workers or os.cpu_count()
+    engine = RegistrationEngine(cache=cache, **engine_args)
+    target = engine.mesh(target_path)
+    voxel_size = engine.voxel_size(target) if engine.global_stage is not None else None
+    blocks, spec = share_arrays(target.export_arrays(voxel_size))
+    del engine, target
+
+    ctx = multiprocessing.get_context(start_method)
+    pending = deque(enumerate(source_paths))
+    results = [None] * len(source_paths)
+    done = 0
+
+    def finish(index, result):
+        nonlocal done
+        results[index] = result
+        done += 1
+        if progress is not None:
+            progress(done, len(results), result)
+
+    def spawn():
+        return Worker(ctx, target_path, spec, voxel_size, engine_args)
+
+    workers = [spawn() for _ in range(min(num_workers, len(source_paths)))]
+    try:
+        while done < len(results):
+            for k, worker in enumerate(workers):
+                if not (worker.ready and worker.job is None and pending):
+                    continue
+                if not worker.process.is_alive():
+                    # Died while idle, its replacement gets the job once it is ready
+                    worker.process.join()
+                    worker.results.close()
+                    workers[k] = spawn()
+                    continue
+                worker.submit(pending.popleft())
+            readable = multiprocessing.connection.wait(
+                [w.results for w in workers if not w.results.closed], timeout=0.1)
+            for worker in workers:
+                if worker.results not in readable:
+                    continue
+                try:
+                    index, result = worker.results.recv()
+                except EOFError:
+                    # The worker exited, handled below
+                    worker.results.close()
+                    continue
+                if index is None:
+                    worker.ready = True
+                elif worker.job is not None and worker.job[0] == index:
+                    worker.job = None
+                    finish(index, result)
+
+            for k, worker in enumerate(workers):
+                if worker.job is None:
+                    if not worker.ready and not worker.process.is_alive():
+                        raise RuntimeError("Worker exited with code %s while loading the target"
+                                           % worker.process.exitcode)
+                    continue
+                index, source_path = worker.job
+                if timeout is not None and time.perf_counter() - worker.started > timeout:
+                    error = "timed out after %g s" % timeout
+                elif not worker.process.is_alive():
+                    error = "worker exited with code %s" % worker.process.exitcode
+                else:
+                    continue
+                worker.process.kill()
+                worker.process.join()
+                # Whatever the killed worker had half written goes with its pipe
+                worker.results.close()
+                worker.job = None
+                finish(index, {"source": source_path, "target": target_path, "error": error})
+                if pending:
+                    workers[k] = spawn()
+    finally:
+        for worker in workers:
+            if worker.process.is_alive():
+                worker.tasks.put(None)
+        for worker in workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.results.close()
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return results
+
+
+def find_sources(source, patterns):
+    if os.path.isfile(source):
+        return [source]
+    paths = set()
+    for pattern in patterns:
+        paths.update(glob.glob(os.path.join(source, pattern)))
+    return sorted(paths)
+
+
+def print_progress(done, total, result):
+    if "error" in result:
+        print("[%d/%d] %s failed: %s" % (done, total, result["source"],
+                                         result["error"].strip().splitlines()[-1]))
+    else:
+        print("[%d/%d] %s fitness %.4f rmse %.4g %.3f s%s" % (
+            done, total, result["source"], result["fitness"], result["inlier_rmse"], result["seconds"],
+            " (cached)" if result["cached"] else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Register a directory of source scans against one target on all cores"
+    )
+    parser.add_argument("sources", type=str, help="Directory of source meshes (or a single mesh)")
+    parser.add_argument("mesh_target", type=str, help="Path to target mesh B")
+    parser.add_argument("--pattern", type=str, nargs="+", default=["*.ply", "*.obj"],
+                        help="File patterns of source meshes in the directory")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds per job")
+    parser.add_argument("--global_stage", choices=list(GLOBAL_STAGES) + ["none"], default="fgr")
+    parser.add_argument("--local_stage", choices=list(LOCAL_STAGES) + ["none"], default="refine_icp")
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Cache the target's sampled cloud and features in this directory")
+    parser.add_argument("--result_cache", type=str, default=None,
+                        help="Reuse results of sources registered before with the same meshes, "
+                             "stages and parameters, stored in this directory (shared by the workers)")
+    for name, default in DEFAULT_PARAMS.items():
+        if isinstance(default, bool):
+            parser.add_argument("--" + name, action=argparse.BooleanOptionalAction, default=default)
+        else:
+            parser.add_argument("--" + name, default=default,
+                                type=type(default) if default is not None else PARAM_TYPES.get(name, float))
+    args = parser.parse_args()
+
+    sources = find_sources(args.sources, args.pattern)
+    if not sources:
+        parser.error("no source meshes found in %s" % args.sources)
+
+    start = time.perf_counter()
+    results = batch_register(
+        sources, args.mesh_target, args.workers, args.timeout, progress=print_progress,
+        cache=ArrayCache(args.cache_dir) if args.cache_dir is not None else None,
+        result_cache=ResultCache(args.result_cache) if args.result_cache is not None else None,
+        global_stage=None if args.global_stage == "none" else args.global_stage,
+        local_stage=None if args.local_stage == "none" else args.local_stage,
+        **{name: getattr(args, name) for name in DEFAULT_PARAMS})
+    failed = sum("error" in r for r in results)
+    print("Registered %d sources (%d failed) in %.3f s" % (len(results), failed, time.perf_counter() - start))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([to_json(r) for r in results], f, indent=1)
+
+
+# To run:
+# python batch_register.py ../data/scans ../data/max_planck_face2.ply --workers 8 --timeout 120 --output results.json
+if __name__ == "__main__":
+    main()
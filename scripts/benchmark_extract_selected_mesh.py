@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import time
+from context import *
+from open3d_utils import extract_selected_arrays, sample_selected_point_cloud
+
+
+def extract_selected_arrays_reference(data):
+    """The per-face list comprehension that extract_selected_mesh used before."""
+    vertices = data["vertices"]
+    faces = data["faces"]
+    vsel = data["vertex_selection"]
+    fsel = data["face_selection"]
+
+    if fsel is not None:
+        selected_faces = faces[fsel[:, 0] > 0]
+    else:
+        mask = np.isin(faces, np.where(vsel[:, 0] > 0)[0]).all(axis=1)
+        selected_faces = faces[mask]
+    selected_vertices_idx = np.unique(selected_faces.flatten())
+    selected_vertices = vertices[selected_vertices_idx]
+    index_map = np.zeros(len(vertices), dtype=int)
+    index_map[selected_vertices_idx] = np.arange(len(selected_vertices))
+    remapped_faces = np.array([[index_map[i] for i in f] for f in selected_faces])
+    return selected_vertices, remapped_faces
+
+
+def synthetic_grid(n, selected_fraction=0.5, seed=0):
+    """(n+1)^2-vertex grid with 2 n^2 faces; a disc in the middle is selected."""
+    x, y = np.meshgrid(np.linspace(0, 1, n + 1), np.linspace(0, 1, n + 1))
+    vertices = np.stack([x.ravel(), y.ravel(), np.zeros(x.size)], axis=1)
+    i = np.arange(n)[:, None] * (n + 1) + np.arange(n)[None, :]
+    i = i.ravel()
+    faces = np.concatenate([
+        np.stack([i, i + 1, i + n + 1], axis=1),
+        np.stack([i + 1, i + n + 2, i + n + 1], axis=1),
+    ]).astype(np.int32)
+    centroids = vertices[faces].mean(axis=1)
+    radius = np.sqrt(selected_fraction / np.pi)
+    inside = np.linalg.norm(centroids[:, :2] - 0.5, axis=1) < radius
+    vinside = np.linalg.norm(vertices[:, :2] - 0.5, axis=1) < radius
+    return {
+        "vertices": vertices,
+        "faces": faces,
+        "vertex_selection": np.float32(vinside)[:, None],
+        "face_selection": np.float32(inside)[:, None],
+    }
+
+
+def best_time(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark extract_selected_arrays against the list-comprehension remapping"
+    )
+    parser.add_argument("--grid", type=int, default=1000,
+                        help="Grid resolution, the mesh has 2 * grid^2 faces (default 1000)")
+    parser.add_argument("--samples", type=int, default=50000,
+                        help="Points for sample_selected_point_cloud (default 50000)")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    data = synthetic_grid(args.grid)
+    print("Synthetic mesh: %d vertices, %d faces" % (len(data["vertices"]), len(data["faces"])))
+
+    for mode in ("face_selection", "vertex_selection"):
+        d = dict(data)
+        if mode == "vertex_selection":
+            d["face_selection"] = None
+        t_ref, (V_ref, F_ref) = best_time(lambda: extract_selected_arrays_reference(d), 1)
+        t_new, (V_new, F_new) = best_time(lambda: extract_selected_arrays(d), args.repeats)
+        assert np.array_equal(V_ref, V_new) and np.array_equal(F_ref, F_new)
+        print("%-16s reference %.3f s, vectorized %.3f s, speedup %.1fx" % (
+            mode, t_ref, t_new, t_ref / t_new))
+
+    t_sample, pcd = best_time(
+        lambda: sample_selected_point_cloud(data, args.samples, seed=0), args.repeats)
+    print("sample_selected_point_cloud(%d points) %.3f s" % (len(pcd.points), t_sample))
+
+
+# To run:
+# python benchmark_extract_selected_mesh.py --grid 1000
+if __name__ == "__main__":
+    main()
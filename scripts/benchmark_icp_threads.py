@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import time
+import igl
+from context import *
+
+
+def time_call(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare a Python loop over icp_libigl with the threaded icp_libigl_batch"
+    )
+    parser.add_argument("mesh_a", type=str, help="Path to source mesh A")
+    parser.add_argument("mesh_b", type=str, help="Path to target mesh B")
+    parser.add_argument("--pairs", type=int, default=32,
+                        help="Number of (source, target) pairs in the batch (default 32)")
+    parser.add_argument("--samples", type=int, default=2000,
+                        help="Number of sampled points from mesh A per iteration (default 2000)")
+    parser.add_argument("--iters", type=int, default=30,
+                        help="Maximum number of ICP iterations (default 30)")
+    parser.add_argument("--threads", type=int, nargs="+", default=None,
+                        help="Thread counts to try (default 1, 2, 4, ... up to all cores)")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Timed repetitions, the best one is reported (default 3)")
+    args = parser.parse_args()
+
+    VA, FA = igl.read_triangle_mesh(args.mesh_a)
+    VB, FB = igl.read_triangle_mesh(args.mesh_b)
+    FA = FA.astype(np.int32)
+    FB = FB.astype(np.int32)
+    VAs, FAs = [VA] * args.pairs, [FA] * args.pairs
+    VBs, FBs = [VB] * args.pairs, [FB] * args.pairs
+
+    threads = args.threads
+    if threads is None:
+        cores = os.cpu_count() or 1
+        threads = [1 << k for k in range(cores.bit_length()) if (1 << k) <= cores]
+        if threads[-1] != cores:
+            threads.append(cores)
+
+    def loop():
+        for i in range(args.pairs):
+            pc_align.icp_libigl(VAs[i], FAs[i], VBs[i], FBs[i], args.samples, args.iters)
+
+    t_loop = time_call(loop, args.repeats)
+    print("%-24s %10s %14s %8s" % ("mode", "time [s]", "pairs / s", "speedup"))
+    print("%-24s %10.3f %14.2f %8.2f" % ("loop icp_libigl", t_loop, args.pairs / t_loop, 1.0))
+    for n in threads:
+        t = time_call(lambda: pc_align.icp_libigl_batch(
+            VAs, FAs, VBs, FBs, args.samples, args.iters, n), args.repeats)
+        print("%-24s %10.3f %14.2f %8.2f" % (
+            "icp_libigl_batch x%d" % n, t, args.pairs / t, t_loop / t))
+
+    target = pc_align.ICPTarget(VB, FB)
+    for n in threads:
+        t = time_call(lambda: target.align_batch(
+            VAs, FAs, args.samples, args.iters, n), args.repeats)
+        print("%-24s %10.3f %14.2f %8.2f" % (
+            "ICPTarget.align_batch x%d" % n, t, args.pairs / t, t_loop / t))
+
+
+# To run:
+# python benchmark_icp_threads.py ../data/mask.obj ../data/max_planck_face2.ply --pairs 64
+if __name__ == "__main__":
+    main()
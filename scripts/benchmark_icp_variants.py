@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import time
+import igl
+from context import *
+
+# name: ICPOptions fields set on top of the shared ones
+VARIANTS = {
+    "point_to_plane": {},
+    "point_to_plane fixed": {"fixed_samples": True},
+    "point_to_point fixed": {"fixed_samples": True, "metric": "point_to_point"},
+    "trimmed 0.8": {"fixed_samples": True, "trim_fraction": 0.8},
+    "huber": {"fixed_samples": True, "kernel": "huber"},
+    "tukey": {"fixed_samples": True, "kernel": "tukey"},
+    "tukey trimmed 0.8": {"fixed_samples": True, "kernel": "tukey", "trim_fraction": 0.8},
+}
+
+
+def make_options(args, seed, **fields):
+    options = pc_align.ICPOptions()
+    options.num_samples = args.samples
+    options.max_iters = args.iters
+    options.rel_rmse_tol = args.rmse_tol
+    options.step_tol = args.step_tol
+    options.seed = seed
+    for name, value in fields.items():
+        if name == "metric":
+            value = getattr(pc_align.ICPMetric, value)
+        elif name == "kernel":
+            value = getattr(pc_align.ICPKernel, value)
+        setattr(options, name, value)
+    return options
+
+
+def trimmed_rmse(target, VA, R, t, fraction=0.8, n=20000):
+    """RMS distance of the closest fraction of the source vertices, insensitive to partial overlap."""
+    X = VA @ R + t
+    if len(X) > n:
+        X = X[np.random.default_rng(0).choice(len(X), n, replace=False)]
+    tree = igl.AABB()
+    tree.init(target.V, target.F)
+    sqrD = np.sort(tree.squared_distance(target.V, target.F, X)[0])
+    return float(np.sqrt(sqrD[:max(1, int(fraction * len(sqrD)))].mean()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare iterations to converge and wall time of the native ICP variants "
+                    "with libigl's own iterative_closest_point"
+    )
+    parser.add_argument("mesh_a", type=str, help="Path to source mesh A")
+    parser.add_argument("mesh_b", type=str, help="Path to target mesh B")
+    parser.add_argument("--samples", type=int, default=2000,
+                        help="Number of sampled points from mesh A (default 2000)")
+    parser.add_argument("--iters", type=int, default=100,
+                        help="Maximum number of ICP iterations (default 100)")
+    parser.add_argument("--rmse_tol", type=float, default=1e-4,
+                        help="Relative RMSE change to stop at (default 1e-4)")
+    parser.add_argument("--step_tol", type=float, default=1e-5,
+                        help="Sample motion / bbox diagonal to stop at (default 1e-5)")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Runs per variant with different seeds (default 5)")
+    args = parser.parse_args()
+
+    VA, FA = igl.read_triangle_mesh(args.mesh_a)
+    VB, FB = igl.read_triangle_mesh(args.mesh_b)
+    FA = FA.astype(np.int32)
+    FB = FB.astype(np.int32)
+    target = pc_align.ICPTarget(VB, FB)
+
+    print("%-22s %10s %10s %12s" % ("variant", "iters", "time [s]", "trim. rmse"))
+    # Baseline: igl::iterative_closest_point itself, which only the path
+    # binding still calls. It has no stopping test, so it always runs
+    # args.iters iterations; the time of reading both meshes is subtracted.
+    times, errors = [], []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        igl.read_triangle_mesh(args.mesh_a)
+        igl.read_triangle_mesh(args.mesh_b)
+        read = time.perf_counter() - start
+        start = time.perf_counter()
+        R, t = pc_align.icp_libigl_from_paths(args.mesh_a, args.mesh_b, args.samples, args.iters)
+        times.append(time.perf_counter() - start - read)
+        errors.append(trimmed_rmse(target, VA, R, t))
+    print("%-22s %10d %10.3f %12.4g" % (
+        "igl::icp (fixed)", args.iters, np.mean(times), np.mean(errors)))
+
+    for name, fields in VARIANTS.items():
+        times, iterations, errors = [], [], []
+        for seed in range(1, args.repeats + 1):
+            options = make_options(args, seed, **fields)
+            start = time.perf_counter()
+            result = target.icp(VA, FA, options)
+            times.append(time.perf_counter() - start)
+            iterations.append(result.iterations)
+            errors.append(trimmed_rmse(target, VA, result.R, result.t))
+        print("%-22s %10.1f %10.3f %12.4g" % (
+            name, np.mean(iterations), np.mean(times), np.mean(errors)))
+
+
+# To run:
+# python benchmark_icp_variants.py ../data/mask.obj ../data/max_planck_face2.ply --repeats 10
+if __name__ == "__main__":
+    main()
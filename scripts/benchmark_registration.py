@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Speed and accuracy of every registration path on synthetic problems with a
+known answer: each target mesh is moved by a random rigid transform (plus
+vertex noise) to make the source, and each method has to recover the
+inverse. Each method runs in a forked child so its peak memory can be
+measured in isolation.
+"""
+import json
+import multiprocessing
+import multiprocessing.connection
+import platform
+import resource
+import time
+import traceback
+import open3d as o3d
+from context import *
+from open3d_utils import load_mesh_arrays, sample_mesh_arrays, preprocess_point_cloud, transform_from_rt
+from libigl_rigid_algnment import rigid_align_arrays
+from open3d_registration_fgr import execute_fast_global_registration
+from open3d_registration_ransac import execute_ransac_registration
+import utility
+
+DEFAULT_MESHES = ["../data/bunny.obj", "../data/mask.obj", "../data/max_planck_face2.ply"]
+
+# name: (max rotation in degrees, max translation and vertex noise as fractions
+# of the bounding box diagonal)
+SCALES = {
+    "small": (5.0, 0.02, 0.001),
+    "medium": (20.0, 0.05, 0.002),
+    "large": (60.0, 0.2, 0.005),
+}
+
+METHODS = ["libigl_icp", "numpy_icp", "open3d_icp", "fgr", "ransac"]
+
+
+def random_rigid_transform(rng, max_angle_deg, max_translation):
+    """4x4 transform (column vectors) with a random axis, angle and direction."""
+    axis = rng.normal(size=3)
+    axis /= np.linalg.norm(axis)
+    angle = np.deg2rad(rng.uniform(0.0, max_angle_deg))
+    K = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    T = np.eye(4)
+    T[:3, :3] = np.eye(3) + np.sin(angle) * K + (1 - np.cos(angle)) * K @ K
+    direction = rng.normal(size=3)
+    T[:3, 3] = direction / np.linalg.norm(direction) * rng.uniform(0.0, max_translation)
+    return T
+
+
+def rotation_error_deg(T_est, T_gt):
+    c = (np.trace(T_est[:3, :3].T @ T_gt[:3, :3]) - 1.0) / 2.0
+    return float(np.rad2deg(np.arccos(np.clip(c, -1.0, 1.0))))
+
+
+def to_point_cloud(V, F, n_points, seed):
+    points, normals = sample_mesh_arrays(V, F, n_points, seed)
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    pcd.normals = o3d.utility.Vector3dVector(normals)
+    return pcd
+
+
+def run_method(method, VA, FA, VB, FB, diag, args):
+    """Registration transform (4x4, column vectors) from source A to target B."""
+    if method == "libigl_icp":
+        R, t = pc_align.icp_libigl(VA, FA, VB, FB, args.samples, args.iters)
+        return transform_from_rt(R, t)
+    if method == "numpy_icp":
+        R, t = rigid_align_arrays(VA, VB, FB.astype(np.int64), args.iters)
+        return transform_from_rt(R, t)
+
+    # Same sampled clouds for all Open3D methods
+    src = to_point_cloud(VA, FA, args.samples, args.seed)
+    dst = to_point_cloud(VB, FB, args.samples, args.seed + 1)
+    if method == "open3d_icp":
+        result = o3d.pipelines.registration.registration_icp(
+            src, dst, args.icp_distance * diag, np.eye(4),
+            o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+            o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=args.iters))
+        return result.transformation
+
+    voxel_size = args.voxel * diag
+    distance_threshold = 1.5 * voxel_size
+    src_down, src_fpfh = preprocess_point_cloud(src, voxel_size)
+    dst_down, dst_fpfh = preprocess_point_cloud(dst, voxel_size)
+    if method == "fgr":
+        result = execute_fast_global_registration(
+            src_down, dst_down, src_fpfh, dst_fpfh, distance_threshold)
+    elif method == "ransac":
+        result = execute_ransac_registration(
+            src_down, dst_down, src_fpfh, dst_fpfh, distance_threshold,
+            max_iterations=args.ransac_iterations)
+    else:
+        raise ValueError("Unknown method %s" % method)
+    return result.transformation
+
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+def measure(method, VA, FA, VB, FB, diag, args, results):
+    """Child process body: time one registration and send it with its peak memory on results."""
+    try:
+        baseline = current_rss_bytes()
+        start = time.perf_counter()
+        T = run_method(method, VA, FA, VB, FB, diag, args)
+        seconds = time.perf_counter() - start
+        results.send({"transformation": np.asarray(T).tolist(), "seconds": seconds,
+                      "peak_memory_bytes": max(0, peak_rss_bytes() - baseline)})
+    except Exception:
+        results.send({"error": traceback.format_exc()})
+
+
+def run_isolated(method, VA, FA, VB, FB, diag, args):
+    """
+    Run measure in a forked child. A child that crashes is reported with
+    its exit code as soon as it exits, one that runs past args.timeout is
+    killed.
+    """
+    ctx = multiprocessing.get_context("fork")
+    results, sender = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=measure, args=(method, VA, FA, VB, FB, diag, args, sender))
+    proc.start()
+    # Only the child writes, so the pipe reports EOF once it is gone
+    sender.close()
+    result = None
+    if multiprocessing.connection.wait([results, proc.sentinel], timeout=args.timeout):
+        # A result sent just before exiting is still in the pipe
+        if results.poll():
+            try:
+                result = results.recv()
+            except EOFError:
+                pass
+    else:
+        proc.kill()
+        result = {"error": "timed out after %g s" % args.timeout}
+    proc.join()
+    results.close()
+    if result is None:
+        result = {"error": "crashed with exit code %s" % proc.exitcode}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark registration methods on synthetic ground-truth transforms"
+    )
+    parser.add_argument("--meshes", type=str, nargs="+", default=DEFAULT_MESHES)
+    parser.add_argument("--scales", type=str, nargs="+", default=list(SCALES), choices=list(SCALES))
+    parser.add_argument("--methods", type=str, nargs="+", default=METHODS, choices=METHODS)
+    parser.add_argument("--trials", type=int, default=3, help="Random transforms per mesh and scale")
+    parser.add_argument("--samples", type=int, default=10000, help="Points sampled per cloud / ICP iteration")
+    parser.add_argument("--iters", type=int, default=30, help="ICP iterations")
+    parser.add_argument("--voxel", type=float, default=0.01,
+                        help="FGR/RANSAC voxel size as a fraction of the bounding box diagonal")
+    parser.add_argument("--icp_distance", type=float, default=0.1,
+                        help="Open3D ICP correspondence distance as a fraction of the diagonal")
+    parser.add_argument("--ransac_iterations", type=int, default=100000)
+    parser.add_argument("--chamfer_samples", type=int, default=20000)
+    parser.add_argument("--timeout", type=float, default=600.0, help="Seconds per run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="benchmark_registration.json")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    records = []
+    for path in args.meshes:
+        VB, FB = load_mesh_arrays(path)
+        diag = float(np.linalg.norm(VB.max(axis=0) - VB.min(axis=0)))
+        for scale in args.scales:
+            max_angle, max_translation, noise = SCALES[scale]
+            for trial in range(args.trials):
+                # The source is the target moved by T, so the answer is T^-1
+                T = random_rigid_transform(rng, max_angle, max_translation * diag)
+                VA = VB @ T[:3, :3].T + T[:3, 3] + rng.normal(scale=noise * diag, size=VB.shape)
+                T_gt = np.linalg.inv(T)
+                for method in args.methods:
+                    record = {"mesh": os.path.basename(path), "scale": scale, "trial": trial,
+                              "method": method, "ground_truth": T_gt.tolist()}
+                    record.update(run_isolated(method, VA, FB, VB, FB, diag, args))
+                    if "error" not in record:
+                        T_est = np.array(record["transformation"])
+                        record["rotation_error_deg"] = rotation_error_deg(T_est, T_gt)
+                        record["translation_error"] = float(np.linalg.norm(T_est[:3, 3] - T_gt[:3, 3]))
+                        record["translation_error_rel"] = record["translation_error"] / diag
+                        VA_est = VA @ T_est[:3, :3].T + T_est[:3, 3]
+                        record["chamfer"] = float(utility.chamfer_distance(
+                            VA_est, FB, VB, FB, n=args.chamfer_samples))
+                        print("%-22s %-6s %d %-10s %8.3f s %8.1f MB  rot %7.3f deg  trans %.2e  chamfer %.3e" % (
+                            record["mesh"], scale, trial, method, record["seconds"],
+                            record["peak_memory_bytes"] / 2 ** 20, record["rotation_error_deg"],
+                            record["translation_error_rel"], record["chamfer"]))
+                    else:
+                        print("%-22s %-6s %d %-10s failed: %s" % (
+                            record["mesh"], scale, trial, method, record["error"].strip().splitlines()[-1]))
+                    records.append(record)
+
+    results = {
+        "config": vars(args),
+        "platform": {"system": platform.system(), "machine": platform.machine(),
+                     "python": platform.python_version(), "numpy": np.__version__,
+                     "open3d": o3d.__version__},
+        "results": records,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    print("Wrote %d results to %s" % (len(records), args.output))
+
+
+# To run:
+# python benchmark_registration.py --trials 3 --output ../results/benchmark_registration.json
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Time of each surface sampler, the evenness of its samples and the accuracy
+of FGR + point-to-plane ICP on clouds it sampled, for synthetic problems
+with a known answer (the mesh moved by a random rigid transform).
+"""
+import json
+import time
+import open3d as o3d
+from scipy.spatial import cKDTree
+from context import *
+from open3d_utils import SAMPLERS, sample_mesh, preprocess_point_cloud
+from open3d_registration_fgr import execute_fast_global_registration
+from open3d_icp import global_local_registration
+from benchmark_registration import random_rigid_transform, rotation_error_deg
+
+DEFAULT_MESHES = ["../data/bunny.obj", "../data/mask.obj"]
+
+
+def spacing(points):
+    """Coefficient of variation and min / mean of the nearest-neighbor distances."""
+    d = cKDTree(points).query(points, k=2)[0][:, 1]
+    return float(d.std() / d.mean()), float(d.min() / d.mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark surface samplers for time and downstream registration accuracy"
+    )
+    parser.add_argument("--meshes", type=str, nargs="+", default=DEFAULT_MESHES)
+    parser.add_argument("--samplers", type=str, nargs="+", default=["poisson"] + list(SAMPLERS),
+                        choices=["poisson"] + list(SAMPLERS))
+    parser.add_argument("--samples", type=int, nargs="+", default=[10000, 50000],
+                        help="Point counts to time")
+    parser.add_argument("--register_samples", type=int, default=10000,
+                        help="Points per cloud for the registration trials")
+    parser.add_argument("--trials", type=int, default=3, help="Random transforms per mesh")
+    parser.add_argument("--max_angle", type=float, default=60.0, help="Degrees")
+    parser.add_argument("--voxel", type=float, default=0.01,
+                        help="FGR voxel size as a fraction of the bounding box diagonal")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON")
+    args = parser.parse_args()
+
+    records = []
+    print("%-14s %-10s %8s %9s %8s %8s" % ("mesh", "sampler", "points", "time [s]", "nn cv", "min/mean"))
+    for path in args.meshes:
+        mesh = o3d.io.read_triangle_mesh(path)
+        for sampler in args.samplers:
+            for n in args.samples:
+                start = time.perf_counter()
+                pcd = sample_mesh(mesh, n, sampler, args.seed)
+                seconds = time.perf_counter() - start
+                cv, min_ratio = spacing(np.asarray(pcd.points))
+                records.append({"mesh": os.path.basename(path), "sampler": sampler, "points": n,
+                                "seconds": seconds, "nn_cv": cv, "nn_min_ratio": min_ratio})
+                print("%-14s %-10s %8d %9.3f %8.3f %8.3f" % (
+                    os.path.basename(path), sampler, n, seconds, cv, min_ratio))
+
+    print("\n%-14s %-10s %9s %10s %11s" % ("mesh", "sampler", "time [s]", "rot [deg]", "trans/diag"))
+    rng = np.random.default_rng(args.seed)
+    for path in args.meshes:
+        mesh = o3d.io.read_triangle_mesh(path)
+        V = np.asarray(mesh.vertices)
+        diag = float(np.linalg.norm(V.max(axis=0) - V.min(axis=0)))
+        voxel_size = args.voxel * diag
+        transforms = [random_rigid_transform(rng, args.max_angle, 0.1 * diag) for _ in range(args.trials)]
+        for sampler in args.samplers:
+            rot, trans, seconds = [], [], []
+            for trial, T in enumerate(transforms):
+                # The source is the mesh moved by T, so the answer is T^-1
+                moved = o3d.geometry.TriangleMesh(mesh).transform(T)
+                start = time.perf_counter()
+                src = sample_mesh(moved, args.register_samples, sampler, args.seed + 2 * trial)
+                dst = sample_mesh(mesh, args.register_samples, sampler, args.seed + 2 * trial + 1)
+                src_down, src_fpfh = preprocess_point_cloud(src, voxel_size)
+                dst_down, dst_fpfh = preprocess_point_cloud(dst, voxel_size)
+                result = execute_fast_global_registration(
+                    src_down, dst_down, src_fpfh, dst_fpfh, 1.5 * voxel_size)
+                result, _ = global_local_registration(
+                    src_down, dst_down, result.transformation, 1.5 * voxel_size)
+                seconds.append(time.perf_counter() - start)
+                T_gt = np.linalg.inv(T)
+                T_est = np.asarray(result.transformation)
+                rot.append(rotation_error_deg(T_est, T_gt))
+                trans.append(float(np.linalg.norm(T_est[:3, 3] - T_gt[:3, 3])) / diag)
+            records.append({"mesh": os.path.basename(path), "sampler": sampler,
+                            "points": args.register_samples, "registration_seconds": seconds,
+                            "rotation_error_deg": rot, "translation_error_rel": trans})
+            print("%-14s %-10s %9.3f %10.3f %11.2e" % (
+                os.path.basename(path), sampler, np.mean(seconds), np.median(rot), np.median(trans)))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": records}, f, indent=1)
+
+
+# To run:
+# python benchmark_samplers.py --meshes ../data/bunny.obj ../data/mask.obj --samples 10000 200000
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Startup time of each registration entry point (`--help`, which imports the
+script and everything it imports at module level), the import time of
+each backend, and, with a pair of meshes, a cold `register.py` run against
+the same job on a warm `register.py --serve --socket` server.
+"""
+import json
+import subprocess
+import tempfile
+import time
+from context import *
+
+ENTRY_POINTS = [
+    "register.py", "batch_register.py", "registration_client.py", "libigl_icp.py",
+    "open3d_icp.py", "open3d_registration_fgr.py", "open3d_registration_ransac.py",
+    "streaming_registration.py", "feature_matching.py", "pose_evaluation.py",
+]
+BACKENDS = ["numpy", "scipy.spatial", "open3d", "igl", "pc_align_bindings"]
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def wall_time(command, repeat=1, **kwargs) -> float:
+    """Median wall time of running command repeat times; raises if it fails."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=HERE, **kwargs)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def import_time(module, repeat=1):
+    """Median seconds to import module in a fresh interpreter, None if it is not installed."""
+    code = "import time; s = time.perf_counter(); import %s; print(time.perf_counter() - s)" % module
+    # The build directories context.py would add, without importing NumPy first
+    paths = [os.path.join(HERE, "..", build) for build in ("build", "build-studio")]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(paths + [os.environ.get("PYTHONPATH", "")]))
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        times.append(float(result.stdout.split()[-1]))
+    return float(np.median(times))
+
+
+def warm_server_times(source, target, repeat):
+    """(first, median of the next repeat) client wall time for one job on a fresh server."""
+    socket_path = os.path.join(tempfile.mkdtemp(), "pc_align.sock")
+    server = subprocess.Popen([sys.executable, "register.py", "--serve", "--socket", socket_path],
+                              cwd=HERE, stderr=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(socket_path):
+            if server.poll() is not None:
+                raise RuntimeError("Server exited with code %s" % server.returncode)
+            time.sleep(0.05)
+        client = [sys.executable, "registration_client.py", socket_path, source, target]
+        first = wall_time(client)
+        return first, wall_time(client, repeat)
+    finally:
+        subprocess.run([sys.executable, "registration_client.py", socket_path, "--command", "shutdown"],
+                       cwd=HERE, stdout=subprocess.DEVNULL)
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure startup time of the registration entry points and backends"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (median)")
+    parser.add_argument("--scripts", type=str, nargs="+", default=ENTRY_POINTS)
+    parser.add_argument("--pair", type=str, nargs=2, default=None, metavar=("SOURCE", "TARGET"),
+                        help="Also time a cold register.py run against the warm server on this pair")
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON")
+    args = parser.parse_args()
+
+    records = {"entry_points": {}, "backends": {}}
+    print("%-32s %9s" % ("entry point --help", "time [s]"))
+    for script in args.scripts:
+        seconds = wall_time([sys.executable, script, "--help"], args.repeat)
+        records["entry_points"][script] = seconds
+        print("%-32s %9.3f" % (script, seconds))
+
+    print("\n%-32s %9s" % ("import", "time [s]"))
+    for module in BACKENDS:
+        seconds = import_time(module, args.repeat)
+        records["backends"][module] = seconds
+        print("%-32s %9s" % (module, "missing" if seconds is None else "%.3f" % seconds))
+
+    if args.pair is not None:
+        source, target = (os.path.abspath(p) for p in args.pair)
+        cold = wall_time([sys.executable, "register.py", source, target])
+        first, warm = warm_server_times(source, target, args.repeat)
+        records["pair"] = {"cold": cold, "warm_first": first, "warm": warm}
+        print("\nregister.py, cold process:        %8.3f s" % cold)
+        print("warm server, first job:           %8.3f s" % first)
+        print("warm server, target prepared:     %8.3f s" % warm)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": records}, f, indent=1)
+
+
+# To run:
+# python benchmark_startup.py --pair ../data/mask.obj ../data/max_planck_face2.ply
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "PC_ALIGN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pc_align"))
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def array_hash(*arrays) -> str:
+    """SHA-256 of the shapes, dtypes and bytes of arrays."""
+    h = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.shape, a.dtype.str)).encode())
+        h.update(a.data)
+    return h.hexdigest()
+
+
+def make_key(*parts) -> str:
+    """Cache key from hashes and parameters, e.g. make_key("fpfh", file_hash(p), 0.01)."""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+class ArrayCache:
+    """
+    Content-addressed on-disk cache of named NumPy arrays.
+
+    Each entry is a directory of .npy files, so get() can memory-map them.
+    Entries are written to a temporary directory and renamed into place,
+    so concurrent readers never see partial entries. Reads refresh the
+    entry's mtime; once the cache grows beyond max_bytes the least
+    recently used entries are deleted.
+    """
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, max_bytes: int = 2 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key: str, mmap: bool = True) -> dict[str, np.ndarray] | None:
+        entry = self._entry_dir(key)
+        try:
+            names = [n for n in os.listdir(entry) if n.endswith(".npy")]
+            arrays = {
+                n[:-4]: np.load(os.path.join(entry, n), mmap_mode="r" if mmap else None)
+                for n in names
+            }
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return arrays
+
+    def put(self, key: str, arrays: dict[str, np.ndarray]) -> None:
+        entry = self._entry_dir(key)
+        tmp = os.path.join(self.root, ".tmp-" + uuid.uuid4().hex)
+        os.makedirs(tmp)
+        for name, a in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), np.asarray(a))
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another process stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        """(mtime, size in bytes, path) of every entry."""
+        result = []
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if prefix.startswith(".") or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                try:
+                    size = sum(
+                        os.path.getsize(os.path.join(entry, n)) for n in os.listdir(entry))
+                    result.append((os.path.getmtime(entry), size, entry))
+                except FileNotFoundError:
+                    pass
+        return result
+
+    def evict(self) -> None:
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            # Rename first so readers see either the whole entry or none of it
+            trash = os.path.join(self.root, ".tmp-" + uuid.uuid4().hex)
+            try:
+                os.rename(entry, trash)
+            except OSError:
+                continue
+            shutil.rmtree(trash, ignore_errors=True)
+            total -= size
+
+    def clear(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+
+class ResultCache(ArrayCache):
+    """
+    Registration results keyed by the contents of both meshes, the method
+    and all of its parameters (see key()), so re-running an unchanged pair
+    returns the stored transformation and metrics. Arrays in a result are
+    stored as .npy files, everything else as JSON. Entries are small, hence
+    the lower default bound; eviction and concurrent access from several
+    processes work as in ArrayCache.
+    """
+
+    def __init__(self, root: str = os.path.join(DEFAULT_CACHE_DIR, "results"),
+                 max_bytes: int = 64 << 20):
+        super().__init__(root, max_bytes)
+        self._hashes = {}
+
+    def _file_hash(self, path: str) -> str:
+        # A tiled target (tiled_target.py) is identified by its meta.json,
+        # which holds the hash of the mesh it was built from
+        if os.path.isdir(path):
+            path = os.path.join(path, "meta.json")
+        # Hash each file once per process unless it changes
+        st = os.stat(path)
+        stamp = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        if stamp not in self._hashes:
+            self._hashes[stamp] = file_hash(path)
+        return self._hashes[stamp]
+
+    def key(self, source_path: str, target_path: str, method, params: dict) -> str:
+        return make_key("registration", self._file_hash(source_path),
+                        self._file_hash(target_path), method, sorted(params.items()))
+
+    def get_result(self, key: str) -> dict | None:
+        arrays = self.get(key, mmap=False)
+        if arrays is None or "result" not in arrays:
+            return None
+        result = json.loads(arrays.pop("result").item())
+        result.update(arrays)
+        return result
+
+    def put_result(self, key: str, result: dict) -> None:
+        arrays = {name: v for name, v in result.items() if isinstance(v, np.ndarray)}
+        rest = {name: v for name, v in result.items() if name not in arrays}
+        # NumPy scalars in stage info as plain numbers
+        arrays["result"] = np.array(json.dumps(rest, default=lambda v: v.tolist()))
+        self.put(key, arrays)
@@ -1,8 +1,40 @@
 # These are the imports we're going to use in all scripts.
-import sys, os, platform
+import sys, os, platform, importlib
 import numpy as np
 import argparse
 
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access, so
+    that a script only pays for the backends it uses:
+    o3d = LazyModule("open3d").
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        # Dunder lookups (pickle, copy) must not import; _name and _module
+        # are missing only while unpickling
+        if attr.startswith("__") or attr in ("_name", "_module"):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        return "<lazy module %r%s>" % (self._name, "" if self.loaded else " (not loaded)")
+
+
 # Get the operating system name and version
 os_name = platform.system()
 if os_name == "Darwin":
@@ -18,4 +50,7 @@ if os_name == "Darwin":
 else:
     # For non-macOS systems
     sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../build')))
-import pc_align_bindings as pc_align
+# Repository root, for the utility package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# Compiled bindings, imported when first used
+pc_align = LazyModule("pc_align_bindings")
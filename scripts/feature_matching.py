@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Approximate nearest-neighbor matching of (N, D) feature descriptors, e.g.
+FPFH or learned features saved as .npy files. The target descriptors are
+indexed once (FeatureIndex) and any number of descriptor sets are matched
+against the index, in chunks on a thread pool. Descriptors given as .npy
+paths are memory-mapped and only read chunk by chunk.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from context import *
+from profiling import profiled
+
+
+def as_descriptors(features) -> np.ndarray:
+    """
+    (N, D) descriptors from an array, a path to an .npy file (memory-mapped)
+    or an Open3D Feature, whose data is (D, N). No copy is made.
+    """
+    if isinstance(features, (str, os.PathLike)):
+        features = np.load(features, mmap_mode="r")
+    elif not isinstance(features, np.ndarray) and hasattr(features, "data"):
+        features = np.asarray(features.data).T
+    if features.ndim != 2:
+        raise ValueError("Expected (N, D) descriptors, got shape %s" % (features.shape,))
+    return features
+
+
+class FeatureIndex:
+    """
+    Approximate nearest-neighbor index over (N, D) target descriptors.
+    Descriptors are projected on their first `dims` principal components
+    (fitted on at most sample_size of them) and put in a KD-tree. A query
+    takes the `candidates` nearest in the projection (eps-approximate, see
+    cKDTree.query) and ranks them by their exact distance in all D
+    dimensions. dims >= D gives exact search. The descriptors are kept by
+    reference, so a memory-mapped file stays on disk except for the
+    candidates read during ranking.
+    """
+
+    def __init__(self, descriptors, dims=8, candidates=8, eps=0.5, sample_size=20000,
+                 chunk_size=8192, num_workers=None, seed=0):
+        from scipy.spatial import cKDTree
+        self.descriptors = as_descriptors(descriptors)
+        self.candidates = candidates
+        self.eps = eps
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers or os.cpu_count()
+        n, d = self.descriptors.shape
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(n, min(n, sample_size), replace=False))
+        sample = np.asarray(self.descriptors[rows], dtype=np.float32)
+        self.mean = sample.mean(axis=0)
+        if dims >= d:
+            self.basis = np.eye(d, dtype=np.float32)
+        else:
+            self.basis = np.linalg.svd(sample - self.mean, full_matrices=False)[2][:dims].T.copy()
+        projected = np.empty((n, self.basis.shape[1]), dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            projected[start:start + chunk_size] = self.project(self.descriptors[start:start + chunk_size])
+        self.tree = cKDTree(projected, leafsize=32, balanced_tree=False)
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    def project(self, X):
+        return (np.asarray(X, dtype=np.float32) - self.mean) @ self.basis
+
+    def _query_chunk(self, queries, k):
+        q = np.asarray(queries, dtype=np.float32)
+        c = min(max(k, self.candidates), len(self))
+        _, candidates = self.tree.query(self.project(q), k=c, eps=self.eps)
+        candidates = candidates.reshape(len(q), c)
+        diff = np.asarray(self.descriptors[candidates.ravel()], dtype=np.float32)
+        diff = diff.reshape(len(q), c, -1) - q[:, None, :]
+        dist = np.einsum("ijk,ijk->ij", diff, diff)
+        order = np.argsort(dist, axis=1)[:, :k]
+        return np.take_along_axis(candidates, order, 1), np.take_along_axis(dist, order, 1)
+
+    def query(self, queries, k=1):
+        """
+        Indices (M, k) and squared distances (M, k) of the k nearest indexed
+        descriptors of each of the (M, D) queries, nearest first.
+        """
+        queries = as_descriptors(queries)
+        if queries.shape[1] != self.descriptors.shape[1]:
+            raise ValueError("Queries have %d dimensions, the index %d"
+                             % (queries.shape[1], self.descriptors.shape[1]))
+        k = min(k, len(self))
+        starts = range(0, len(queries), self.chunk_size)
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        dist = np.empty((len(queries), k), dtype=np.float32)
+        # The KD-tree query and the NumPy ranking release the GIL
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            chunks = pool.map(lambda s: self._query_chunk(queries[s:s + self.chunk_size], k), starts)
+            for start, (i, d) in zip(starts, chunks):
+                indices[start:start + len(i)] = i
+                dist[start:start + len(i)] = d
+        return indices, dist
+
+
+@profiled()
+def match_features(src, dst, k=1, ratio=0.9, mutual_filter=False, **index_args):
+    """
+    Correspondences (M, 2) of source to target descriptor indices. src and
+    dst are anything as_descriptors takes or a FeatureIndex to reuse.
+    Each source descriptor is matched to its k nearest targets. A pair with
+    the m-th nearest target is kept if its distance is below ratio times
+    the distance to the (k+1)-th nearest (Lowe's ratio test for k=1;
+    ratio=1 keeps all). With mutual_filter, a pair is only kept if the
+    source descriptor is also the nearest source of its target. index_args
+    go to the FeatureIndex built on dst (and on src for mutual_filter).
+    """
+    src_index = src if isinstance(src, FeatureIndex) else None
+    src = src.descriptors if src_index is not None else as_descriptors(src)
+    index = dst if isinstance(dst, FeatureIndex) else FeatureIndex(dst, **index_args)
+    test_ratio = ratio < 1.0 and k < len(index)
+    indices, dist = index.query(src, k + 1 if test_ratio else k)
+    keep = np.ones(indices[:, :k].shape, dtype=bool)
+    if test_ratio:
+        # Squared distances: compare with ratio^2
+        keep = dist[:, :k] < ratio * ratio * dist[:, k:k + 1]
+        indices = indices[:, :k]
+    pairs = np.stack([np.broadcast_to(np.arange(len(src))[:, None], indices.shape)[keep],
+                      indices[keep]], axis=1)
+    if mutual_filter and len(pairs):
+        # Nearest source of each matched target, from an index like dst's
+        targets, inverse = np.unique(pairs[:, 1], return_inverse=True)
+        reverse = src_index or FeatureIndex(src, dims=index.basis.shape[1], candidates=index.candidates,
+                                            eps=index.eps, chunk_size=index.chunk_size,
+                                            num_workers=index.num_workers)
+        back, _ = reverse.query(index.descriptors[targets], 1)
+        pairs = pairs[back[inverse, 0] == pairs[:, 0]]
+    return pairs
+
+
+def brute_force_nearest(src, dst, chunk_size=1024):
+    """Exact nearest target index and squared distance of each source descriptor, in float64."""
+    src, dst = as_descriptors(src), np.asarray(as_descriptors(dst), dtype=np.float64)
+    nearest = np.empty(len(src), dtype=np.int64)
+    dist = np.empty(len(src))
+    dst_norms = np.einsum("ij,ij->i", dst, dst)
+    for start in range(0, len(src), chunk_size):
+        q = np.asarray(src[start:start + chunk_size], dtype=np.float64)
+        d = dst_norms[None, :] - 2.0 * q @ dst.T + np.einsum("ij,ij->i", q, q)[:, None]
+        nearest[start:start + len(q)] = np.argmin(d, axis=1)
+        dist[start:start + len(q)] = np.maximum(d[np.arange(len(q)), nearest[start:start + len(q)]], 0.0)
+    return nearest, dist
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Match (N, D) descriptors in .npy files with an approximate nearest-neighbor index"
+    )
+    parser.add_argument("source", type=str, help="Source descriptors (.npy, N x D)")
+    parser.add_argument("target", type=str, help="Target descriptors (.npy, N x D)")
+    parser.add_argument("--k", type=int, default=1, help="Targets per source descriptor")
+    parser.add_argument("--ratio", type=float, default=0.9, help="Ratio test threshold (1 = off)")
+    parser.add_argument("--mutual_filter", action="store_true")
+    parser.add_argument("--dims", type=int, default=8, help="Principal components indexed")
+    parser.add_argument("--candidates", type=int, default=8, help="Candidates ranked per query")
+    parser.add_argument("--workers", type=int, default=None, help="Threads (default: all cores)")
+    parser.add_argument("--check", type=int, default=0,
+                        help="Measure nearest-neighbor recall on this many sources against brute force")
+    parser.add_argument("--output", type=str, default=None, help="Write (M, 2) correspondences as .npy")
+    args = parser.parse_args()
+
+    src, dst = as_descriptors(args.source), as_descriptors(args.target)
+    start = time.perf_counter()
+    index = FeatureIndex(dst, dims=args.dims, candidates=args.candidates, num_workers=args.workers)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    pairs = match_features(src, index, args.k, args.ratio, args.mutual_filter)
+    match = time.perf_counter() - start
+    print("%d x %d descriptors (%d dims): index %.3f s, matching %.3f s, %d correspondences" % (
+        len(src), len(dst), src.shape[1], build, match, len(pairs)))
+
+    if args.check > 0:
+        rows = np.random.default_rng(0).choice(len(src), min(args.check, len(src)), replace=False)
+        _, exact = brute_force_nearest(src[np.sort(rows)], dst)
+        _, approx = index.query(src[np.sort(rows)], 1)
+        # Ties count as found
+        recall = np.mean(approx[:, 0] <= exact * (1 + 1e-5) + 1e-6)
+        print("nearest-neighbor recall on %d sources: %.4f" % (len(rows), recall))
+    if args.output is not None:
+        np.save(args.output, pairs)
+
+
+# To run:
+# python feature_matching.py source_fpfh.npy target_fpfh.npy --ratio 0.9 --mutual_filter --check 1000
+if __name__ == "__main__":
+    main()
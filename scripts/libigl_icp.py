@@ -1,9 +1,32 @@
 #!/usr/bin/env python3
 from context import *
+from profiling import PROFILER, span
+from cache_utils import ResultCache
+
+
+def pyramid_levels(num_levels, num_samples, max_iters, diagonal,
+                   coarse_distance=0.1, shrink=0.5):
+    """
+    ICPOptions for pc_align.ICPTarget.icp_pyramid, coarse to fine.
+    Level k samples num_samples / 4^(num_levels-1-k) points. The coarsest
+    level keeps all pairs, later levels reject pairs farther apart than
+    coarse_distance * diagonal, shrunk by `shrink` per level.
+    """
+    levels = []
+    for k in range(num_levels):
+        options = pc_align.ICPOptions()
+        options.num_samples = max(num_samples >> (2 * (num_levels - 1 - k)), 64)
+        options.max_iters = max_iters
+        if k > 0:
+            options.max_distance = coarse_distance * diagonal * shrink ** (k - 1)
+        levels.append(options)
+    return levels
+
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Rigidly align mesh A to mesh B using libigl::iterative_closest_point()"
+        description="Rigidly align mesh A to mesh B using libigl::iterative_closest_point(), or with "
+                    "--rmse_tol, --step_tol or --pyramid the bindings' reimplementation of its loop"
     )
     parser.add_argument("mesh_a", type=str, help="Path to source mesh A")
     parser.add_argument("mesh_b", type=str, help="Path to target mesh B")
@@ -19,11 +42,78 @@ def main():
         default=30,
         help="Maximum number of ICP iterations (default 30)",
     )
+    parser.add_argument(
+        "--rmse_tol",
+        type=float,
+        default=0.0,
+        help="Stop when the relative RMSE change is below this (default 0, off)",
+    )
+    parser.add_argument(
+        "--step_tol",
+        type=float,
+        default=0.0,
+        help="Stop when the RMS sample motion / target bbox diagonal is below this (default 0, off)",
+    )
+    parser.add_argument(
+        "--pyramid",
+        type=int,
+        default=0,
+        help="Number of coarse-to-fine levels (default 0, single level)",
+    )
+    parser.add_argument(
+        "--result_cache",
+        type=str,
+        default=None,
+        help="Reuse R, t of a pair aligned before with the same meshes and options, "
+             "stored in this directory (single-level runs)",
+    )
     args = parser.parse_args()
 
-    R, t = pc_align.icp_libigl_from_paths(
-        args.mesh_a, args.mesh_b, args.samples, args.iters
-    )
+    if args.pyramid > 0:
+        import igl
+        VA, FA = igl.read_triangle_mesh(args.mesh_a)
+        target = pc_align.ICPTarget.from_path(args.mesh_b)
+        levels = pyramid_levels(args.pyramid, args.samples, args.iters, target.diagonal)
+        for options in levels:
+            options.rel_rmse_tol = args.rmse_tol
+            options.step_tol = args.step_tol
+        result = target.icp_pyramid(VA, FA.astype(np.int32), levels)
+        for k, (options, seconds, iters) in enumerate(
+                zip(levels, result.level_seconds, result.level_iterations)):
+            print("level %d: %6d samples, %3d iterations, %.3f s" % (
+                k, options.num_samples, iters, seconds))
+        R, t = result.R, result.t
+    elif args.rmse_tol > 0 or args.step_tol > 0:
+        import igl
+        VA, FA = igl.read_triangle_mesh(args.mesh_a)
+        VB, FB = igl.read_triangle_mesh(args.mesh_b)
+        with span("icp_libigl_converge", samples=args.samples):
+            result = pc_align.icp_libigl_converge(
+                VA, FA.astype(np.int32), VB, FB.astype(np.int32),
+                args.samples, args.iters, args.rmse_tol, args.step_tol,
+                callback=PROFILER.icp_callback()
+            )
+        print("Stopped after %d iterations (converged: %s)" % (result.iterations, result.converged))
+        for k, (rmse, step) in enumerate(zip(result.rmse, result.step)):
+            print("  iter %2d  rmse %.6g  step %.3g" % (k, rmse, step))
+        R, t = result.R, result.t
+    else:
+        cache = ResultCache(args.result_cache) if args.result_cache is not None else None
+        cached = None
+        if cache is not None:
+            key = cache.key(args.mesh_a, args.mesh_b, "icp_libigl_from_paths",
+                            {"samples": args.samples, "iters": args.iters})
+            cached = cache.get_result(key)
+        if cached is not None:
+            print("Cached result")
+            R, t = cached["R"], cached["t"]
+        else:
+            with span("icp_libigl_from_paths", samples=args.samples):
+                R, t = pc_align.icp_libigl_from_paths(
+                    args.mesh_a, args.mesh_b, args.samples, args.iters
+                )
+            if cache is not None:
+                cache.put_result(key, {"R": np.asarray(R), "t": np.asarray(t)})
 
     np.set_printoptions(precision=6, suppress=True)
     print("Rotation matrix R (3x3):")
@@ -1,43 +1,112 @@
 #!/usr/bin/env python3
-import igl
+import argparse
+import numpy as np
 
 
 def rigid_alignment_numpy(X, P):
     """
     Compute best-fit rigid transform (rotation R, translation t)
-    that aligns points X to P: minimize || R*X_i + t - P_i ||^2
+    that aligns points X to P: minimize || X_i*R + t - P_i ||^2
+    (row vectors, same convention as igl.rigid_alignment)
     """
-    X_mean = X.mean(axis=0)
-    P_mean = P.mean(axis=0)
+    R, t = rigid_alignment_numpy_batch(X[None], P[None])
+    return R[0], t[0]
 
-    X_centered = X - X_mean
-    P_centered = P - P_mean
 
-    H = X_centered.T @ P_centered
+def rigid_alignment_numpy_batch(X, P):
+    """
+    Solve N Kabsch problems at once.
+    X, P: (N, M, 3) stacked point sets; returns R (N, 3, 3) and t (N, 1, 3)
+    such that X[k] @ R[k] + t[k] ~ P[k].
+    """
+    X_mean = X.mean(axis=1, keepdims=True)
+    P_mean = P.mean(axis=1, keepdims=True)
+
+    H = np.einsum("nmi,nmj->nij", X - X_mean, P - P_mean)
     U, S, Vt = np.linalg.svd(H)
-    R = Vt.T @ U.T
 
-    # Handle reflection
-    if np.linalg.det(R) < 0:
-        Vt[-1, :] *= -1
-        R = Vt.T @ U.T
+    # Handle reflection: flip the axis of the smallest singular value
+    d = np.sign(np.linalg.det(U @ Vt))
+    U[:, :, -1] *= d[:, None]
+    R = U @ Vt
 
     t = P_mean - X_mean @ R
     return R, t
 
 
-def rigid_align_meshes(path_a: str, path_b: str, iters: int = 10):
+def rotation_grid(n_axes: int = 12, n_angles: int = 8):
+    """
+    Rotations about n_axes directions spread over the sphere (Fibonacci
+    lattice) by n_angles angles each, plus the identity.
+    Returns (n_axes * (n_angles - 1) + 1, 3, 3) matrices in the row-vector
+    convention X @ R.
+    """
+    k = np.arange(n_axes) + 0.5
+    z = 1.0 - 2.0 * k / n_axes
+    phi = np.pi * (1.0 + 5.0 ** 0.5) * k
+    r = np.sqrt(1.0 - z * z)
+    axes = np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=1)
+    angles = 2.0 * np.pi * np.arange(1, n_angles) / n_angles
+
+    # Rodrigues' formula for every (axis, angle) pair
+    a = np.repeat(axes, len(angles), axis=0)
+    theta = np.tile(angles, n_axes)[:, None, None]
+    K = np.zeros((len(a), 3, 3))
+    K[:, 0, 1], K[:, 0, 2], K[:, 1, 2] = -a[:, 2], a[:, 1], -a[:, 0]
+    K -= K.transpose(0, 2, 1)
+    R = np.eye(3) + np.sin(theta) * K + (1.0 - np.cos(theta)) * (K @ K)
+    # Transpose from column-vector R @ x to the row-vector convention
+    return np.concatenate([np.eye(3)[None], R.transpose(0, 2, 1)])
+
+
+def rigid_align_meshes(
+    path_a: str,
+    path_b: str,
+    iters: int = 10,
+    rel_rmse_tol: float = 0.0,
+    step_tol: float = 0.0,
+    return_history: bool = False,
+):
+    """
+    ICP of mesh A's vertices onto mesh B for iters iterations. Optionally
+    stops early once the relative change of the RMS closest-point distance
+    drops below rel_rmse_tol, or once the RMS motion of the vertices in one
+    iteration, relative to B's bounding box diagonal, drops below step_tol
+    (0, the default, disables either test).
+    With return_history, also returns {"rmse": [...], "step": [...]} with
+    one entry per iteration.
+    """
+    import igl
     # Load meshes
     VA, FA = igl.read_triangle_mesh(path_a)
     VB, FB = igl.read_triangle_mesh(path_b)
-
+    return rigid_align_arrays(VA, VB, FB, iters, rel_rmse_tol, step_tol, return_history)
+
+
+def rigid_align_arrays(
+    VA,
+    VB,
+    FB,
+    iters: int = 10,
+    rel_rmse_tol: float = 0.0,
+    step_tol: float = 0.0,
+    return_history: bool = False,
+):
+    """rigid_align_meshes on loaded arrays: align the points VA to the mesh (VB, FB)."""
+    import igl
     # Target face normals for potential use with igl.rigid_alignment
     Z = np.array([1.0, 1.0, 1.0]) / np.sqrt(3.0)
     FN = igl.per_face_normals(VB, FB, Z)
 
+    # Build the closest-point tree on B once for all iterations
+    tree = igl.AABB()
+    tree.init(VB, FB)
+    diag = np.linalg.norm(VB.max(axis=0) - VB.min(axis=0)) or 1.0
+
     X = VA.copy()
     R_total = np.eye(3)
     t_total = np.zeros((1, 3))
+    history = {"rmse": [], "step": []}
 
     use_igl_rigid = hasattr(igl, "rigid_alignment")
     if not use_igl_rigid:
@@ -45,7 +114,7 @@ def rigid_align_meshes(path_a: str, path_b: str, iters: int = 10):
 
     for _ in range(max(1, iters)):
         # Closest points on mesh B for each vertex of current X
-        sqrD, I, C = igl.point_mesh_squared_distance(X, VB, FB)
+        sqrD, I, C = tree.squared_distance(VB, FB, X)
         if use_igl_rigid:
             # Use libigl binding if available
             Ncorr = FN[I, :]
@@ -55,11 +124,79 @@ def rigid_align_meshes(path_a: str, path_b: str, iters: int = 10):
             R_step, t_step = rigid_alignment_numpy(X, C)
 
         # Compose transform and update X
+        R_total = R_total @ R_step
+        t_total = t_total @ R_step + t_step
+        X_next = X @ R_step + t_step
+
+        rmse = np.sqrt(np.mean(sqrD))
+        step = np.sqrt(np.mean(np.sum((X_next - X) ** 2, axis=1))) / diag
+        rmse_prev = history["rmse"][-1] if history["rmse"] else None
+        history["rmse"].append(rmse)
+        history["step"].append(step)
+        X = X_next
+
+        if step < step_tol:
+            break
+        if rmse_prev and abs(rmse_prev - rmse) / rmse_prev < rel_rmse_tol:
+            break
+
+    if return_history:
+        return R_total, t_total, history
+    return R_total, t_total
+
+
+def rigid_align_meshes_multistart(
+    path_a: str,
+    path_b: str,
+    iters: int = 10,
+    rotations=None,
+    num_samples: int | None = 2000,
+    seed: int = 0,
+):
+    """
+    Run the NumPy ICP of rigid_align_meshes from many initial rotations at
+    once. Every hypothesis starts with the centroid of A moved onto the
+    centroid of B and rotated by rotations[k] (default: rotation_grid()).
+    All hypotheses share one closest-point query and one batched Kabsch
+    solve per iteration.
+    Returns the best (R, t) by final mean squared distance, and the scores
+    of all hypotheses.
+    """
+    import igl
+    VA, FA = igl.read_triangle_mesh(path_a)
+    VB, FB = igl.read_triangle_mesh(path_b)
+    if rotations is None:
+        rotations = rotation_grid()
+    R_total = np.array(rotations, dtype=np.float64)
+    n = len(R_total)
+
+    # Subsample the source vertices, the poses are only scored on these
+    if num_samples is not None and num_samples < len(VA):
+        rng = np.random.default_rng(seed)
+        VA_s = VA[rng.choice(len(VA), num_samples, replace=False)]
+    else:
+        VA_s = VA
+
+    tree = igl.AABB()
+    tree.init(VB, FB)
+
+    cA = VA_s.mean(axis=0)
+    cB = VB.mean(axis=0)
+    t_total = (cB - cA @ R_total)[:, None, :]
+    X = VA_s[None] @ R_total + t_total
+
+    for _ in range(max(1, iters)):
+        sqrD, I, C = tree.squared_distance(VB, FB, X.reshape(-1, 3))
+        R_step, t_step = rigid_alignment_numpy_batch(X, C.reshape(X.shape))
+
         R_total = R_total @ R_step
         t_total = t_total @ R_step + t_step
         X = X @ R_step + t_step
 
-    return R_total, t_total
+    sqrD = tree.squared_distance(VB, FB, X.reshape(-1, 3))[0]
+    scores = sqrD.reshape(n, -1).mean(axis=1)
+    best = np.argmin(scores)
+    return R_total[best], t_total[best], scores
 
 
 def main():
@@ -70,9 +207,33 @@ def main():
     parser.add_argument("mesh_b", type=str, help="Path to target mesh B")
     parser.add_argument("iters", type=int, nargs="?", default=10,
                         help="ICP iterations, default 10")
+    parser.add_argument("--rmse_tol", type=float, default=0.0,
+                        help="Stop when the relative RMSE change is below this, default 0 (off)")
+    parser.add_argument("--step_tol", type=float, default=0.0,
+                        help="Stop when the relative step size is below this, default 0 (off)")
+    parser.add_argument("--multistart", action="store_true",
+                        help="Run ICP from a grid of initial rotations and keep the best")
+    parser.add_argument("--axes", type=int, default=12,
+                        help="Rotation axes in the multistart grid, default 12")
+    parser.add_argument("--angles", type=int, default=8,
+                        help="Angles per axis in the multistart grid, default 8")
+    parser.add_argument("--samples", type=int, default=2000,
+                        help="Source vertices used per hypothesis in multistart, default 2000")
     args = parser.parse_args()
 
-    R, t = rigid_align_meshes(args.mesh_a, args.mesh_b, args.iters)
+    if args.multistart:
+        R, t, scores = rigid_align_meshes_multistart(
+            args.mesh_a, args.mesh_b, args.iters,
+            rotations=rotation_grid(args.axes, args.angles),
+            num_samples=args.samples)
+        print("Best of %d hypotheses, mean squared distance %g" % (len(scores), scores.min()))
+    else:
+        R, t, history = rigid_align_meshes(
+            args.mesh_a, args.mesh_b, args.iters,
+            args.rmse_tol, args.step_tol, return_history=True)
+        print("Stopped after %d iterations" % len(history["rmse"]))
+        for k, (rmse, step) in enumerate(zip(history["rmse"], history["step"])):
+            print("  iter %2d  rmse %.6g  step %.3g" % (k, rmse, step))
 
     np.set_printoptions(precision=6, suppress=True)
     print("Rotation R (3x3):")
@@ -1,7 +1,11 @@
-import open3d as o3d
 import copy
+import time
 from context import *
-from open3d_utils import print_rt_from_transform, load_mesh_as_point_cloud, load_mesh_subset_as_point_cloud
+o3d = LazyModule("open3d")
+from cache_utils import ArrayCache
+from open3d_utils import print_rt_from_transform, load_mesh_as_point_cloud, load_mesh_subset_as_point_cloud, SAMPLERS
+from libigl_rigid_algnment import rotation_grid
+from profiling import profiled
 
 
 def draw_registration_result(source, target, transformation):
@@ -34,6 +38,113 @@ def point_to_plane_icp(source, target, threshold):
     print_rt_from_transform(reg_p2l.transformation)
     draw_registration_result(source, target, reg_p2l.transformation)
 
+def pyramid_voxel_sizes(pcd, num_levels, finest=0.005):
+    """Voxel sizes from coarse to fine, halving per level down to finest * bbox diagonal."""
+    diag = np.linalg.norm(pcd.get_max_bound() - pcd.get_min_bound())
+    return [diag * finest * 2 ** (num_levels - 1 - k) for k in range(num_levels)]
+
+
+@profiled()
+def pyramid_icp(source, target, voxel_sizes, distance_multiplier=3.0,
+                max_iters=30, init=np.eye(4), point_to_plane=True):
+    """
+    Coarse-to-fine ICP: at each level, register the clouds downsampled to
+    voxel_sizes[k] with correspondence distance distance_multiplier * voxel,
+    starting from the previous level's transformation.
+    Returns the final registration result and the wall time of each level.
+    """
+    if point_to_plane:
+        estimation = o3d.pipelines.registration.TransformationEstimationPointToPlane()
+    else:
+        estimation = o3d.pipelines.registration.TransformationEstimationPointToPoint()
+    criteria = o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=max_iters)
+
+    transformation = np.asarray(init)
+    result = None
+    level_times = []
+    for voxel_size in voxel_sizes:
+        start = time.perf_counter()
+        source_down = source.voxel_down_sample(voxel_size)
+        target_down = target.voxel_down_sample(voxel_size)
+        if point_to_plane and not target_down.has_normals():
+            target_down.estimate_normals(
+                o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2.0, max_nn=30))
+        result = o3d.pipelines.registration.registration_icp(
+            source_down, target_down, distance_multiplier * voxel_size,
+            transformation, estimation, criteria)
+        transformation = result.transformation
+        level_times.append(time.perf_counter() - start)
+    return result, level_times
+
+
+@profiled()
+def refine_registration(source_down, target_down, init, distance_threshold, max_iters=30):
+    """
+    Point-to-plane ICP from init on clouds already downsampled with normals
+    (as returned by preprocess_point_cloud), with a correspondence distance
+    on the order of the voxel size instead of a wide threshold.
+    """
+    return o3d.pipelines.registration.registration_icp(
+        source_down, target_down, distance_threshold, np.asarray(init),
+        o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+        o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=max_iters))
+
+
+@profiled()
+def multistart_refine(source_down, target_down, distance_threshold, rotations=None,
+                      max_iters=30, probe_iters=5, probe_multiplier=5.0, inits=()):
+    """
+    refine_registration from many initial poses: the given inits plus the
+    source centroid moved onto the target centroid and rotated by each of
+    rotations (default: rotation_grid(6, 4)). Every start gets probe_iters
+    iterations with a probe_multiplier times wider correspondence distance,
+    so that starts further from the answer still converge toward it; the
+    best by fitness, then inlier RMSE, is refined with max_iters at
+    distance_threshold. Returns the refined result and the number of starts.
+    """
+    if rotations is None:
+        rotations = rotation_grid(6, 4)
+    c_src = source_down.get_center()
+    c_dst = target_down.get_center()
+    starts = [np.asarray(T) for T in inits]
+    for R in rotations:
+        # rotation_grid is in the row-vector convention, Open3D uses column vectors
+        T = np.eye(4)
+        T[:3, :3] = R.T
+        T[:3, 3] = c_dst - R.T @ c_src
+        starts.append(T)
+
+    best = None
+    for T in starts:
+        result = refine_registration(source_down, target_down, T,
+                                     probe_multiplier * distance_threshold, probe_iters)
+        if best is None or (result.fitness, -result.inlier_rmse) > (best.fitness, -best.inlier_rmse):
+            best = result
+    return refine_registration(source_down, target_down, best.transformation,
+                               distance_threshold, max_iters), len(starts)
+
+
+@profiled()
+def global_local_registration(source_down, target_down, init, distance_threshold,
+                              max_iters=30, min_fitness=0.3):
+    """
+    Refine a global (FGR/RANSAC) transformation init with point-to-plane
+    ICP on the same downsampled clouds. Only if the refined fitness is
+    below min_fitness, multistart_refine searches other initial poses
+    (keeping init as one of them).
+    Returns the result and the number of multi-start poses tried (0 if the
+    fallback did not run).
+    """
+    result = refine_registration(source_down, target_down, init, distance_threshold, max_iters)
+    num_starts = 0
+    if result.fitness < min_fitness:
+        fallback, num_starts = multistart_refine(
+            source_down, target_down, distance_threshold, max_iters=max_iters, inits=[init])
+        if fallback.fitness > result.fitness:
+            result = fallback
+    return result, num_starts
+
+
 # To run:
 # python open3d_icp.py ../data/mask.obj ../data/max_planck_face.obj
 def main():
@@ -48,10 +159,43 @@ def main():
         default=10000,
         help="Number of sampled points from mesh A per iteration (default 10000)",
     )
+    parser.add_argument(
+        "--sampler",
+        choices=["poisson"] + list(SAMPLERS),
+        default="poisson",
+        help="Surface sampler: Open3D Poisson disk, or the faster uniform / voxel / blue_noise",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the sampler")
+    parser.add_argument(
+        "--pyramid",
+        type=int,
+        default=0,
+        help="Number of coarse-to-fine levels (default 0, single level at full density)",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Cache sampled point clouds in this directory (default off)",
+    )
     args = parser.parse_args()
 
-    source = load_mesh_as_point_cloud(args.mesh_source, n_points=args.samples)
-    target = load_mesh_subset_as_point_cloud(args.mesh_target, n_points=args.samples)
+    cache = ArrayCache(args.cache_dir) if args.cache_dir is not None else None
+    source = load_mesh_as_point_cloud(args.mesh_source, n_points=args.samples, cache=cache,
+                                      sampler=args.sampler, seed=args.seed)
+    target = load_mesh_subset_as_point_cloud(args.mesh_target, n_points=args.samples, cache=cache,
+                                             sampler=args.sampler, seed=args.seed)
+
+    if args.pyramid > 0:
+        voxel_sizes = pyramid_voxel_sizes(target, args.pyramid)
+        result, level_times = pyramid_icp(source, target, voxel_sizes)
+        for k, (voxel_size, seconds) in enumerate(zip(voxel_sizes, level_times)):
+            print("level %d: voxel %.4g, %.3f s" % (k, voxel_size, seconds))
+        print(result)
+        print_rt_from_transform(result.transformation)
+        draw_registration_result(source, target, result.transformation)
+        return
+
     threshold = 5000
 
     print("Initial alignment")
@@ -1,17 +1,22 @@
-import open3d as o3d
 from context import *
-from open3d_utils import print_rt_from_transform, load_mesh_as_point_cloud, load_mesh_subset_as_point_cloud
+o3d = LazyModule("open3d")
+from cache_utils import ArrayCache
+from open3d_utils import print_rt_from_transform, load_mesh_as_point_cloud, load_mesh_subset_as_point_cloud, preprocess_point_cloud
+from open3d_utils import SAMPLERS
+from open3d_icp import global_local_registration
+from profiling import profiled
 
-def preprocess_point_cloud(pcd, voxel_size):
-    pcd_down = pcd.voxel_down_sample(voxel_size)
-    pcd_down.estimate_normals(
-        o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2.0,
-                                             max_nn=30))
-    pcd_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-        pcd_down,
-        o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 5.0,
-                                             max_nn=100))
-    return (pcd_down, pcd_fpfh)
+
+@profiled()
+def execute_fast_global_registration(src_down, dst_down, src_fpfh, dst_fpfh,
+                                     distance_threshold, max_iterations=64,
+                                     max_tuples=1000):
+    return o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
+        src_down, dst_down, src_fpfh, dst_fpfh,
+        o3d.pipelines.registration.FastGlobalRegistrationOption(
+            maximum_correspondence_distance=distance_threshold,
+            iteration_number=max_iterations,
+            maximum_tuple_count=max_tuples))
 
 
 # To run:
@@ -27,6 +32,13 @@ if __name__ == '__main__':
         default=10000,
         help="Number of sampled points from mesh A per iteration (default 10000)",
     )
+    parser.add_argument(
+        "--sampler",
+        choices=["poisson"] + list(SAMPLERS),
+        default="poisson",
+        help="Surface sampler: Open3D Poisson disk, or the faster uniform / voxel / blue_noise",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the sampler")
     parser.add_argument('--voxel_size',
                         type=float,
                         default=0.01,
@@ -47,35 +59,65 @@ if __name__ == '__main__':
         type=int,
         default=1000,
         help='max number of accepted tuples for correspondence filtering')
+    parser.add_argument('--no_refine',
+                        action='store_true',
+                        help='stop at the FGR result instead of refining it with point-to-plane ICP')
+    parser.add_argument('--min_fitness',
+                        type=float,
+                        default=0.3,
+                        help='try multiple initial rotations if the refined fitness is below this')
+    parser.add_argument('--headless',
+                        action='store_true',
+                        help='do not open a window with the result')
+    parser.add_argument('--cache_dir',
+                        type=str,
+                        default=None,
+                        help='cache sampled clouds and features in this directory')
+    parser.add_argument('--cache_size_mb',
+                        type=int,
+                        default=2048,
+                        help='size bound of the cache directory')
 
     args = parser.parse_args()
 
 
     voxel_size = args.voxel_size
     distance_threshold = args.distance_multiplier * voxel_size
+    cache = None
+    if args.cache_dir is not None:
+        cache = ArrayCache(args.cache_dir, max_bytes=args.cache_size_mb << 20)
 
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
     print('Reading inputs')
-    src = load_mesh_as_point_cloud(args.mesh_source, n_points=args.samples)
+    src = load_mesh_as_point_cloud(args.mesh_source, n_points=args.samples, cache=cache,
+                                   sampler=args.sampler, seed=args.seed)
     # dst = load_mesh_as_point_cloud(args.mesh_target, n_points=args.samples)
-    dst = load_mesh_subset_as_point_cloud(args.mesh_target, n_points=args.samples)
+    dst = load_mesh_subset_as_point_cloud(args.mesh_target, n_points=args.samples, cache=cache,
+                                          sampler=args.sampler, seed=args.seed)
 
     print('Downsampling inputs')
-    src_down, src_fpfh = preprocess_point_cloud(src, voxel_size)
-    dst_down, dst_fpfh = preprocess_point_cloud(dst, voxel_size)
+    src_down, src_fpfh = preprocess_point_cloud(src, voxel_size, cache=cache)
+    dst_down, dst_fpfh = preprocess_point_cloud(dst, voxel_size, cache=cache)
 
     print('Running FGR')
-    result = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
-        src_down, dst_down, src_fpfh, dst_fpfh,
-        o3d.pipelines.registration.FastGlobalRegistrationOption(
-            maximum_correspondence_distance=distance_threshold,
-            iteration_number=args.max_iterations,
-            maximum_tuple_count=args.max_tuples))
+    result = execute_fast_global_registration(
+        src_down, dst_down, src_fpfh, dst_fpfh, distance_threshold,
+        args.max_iterations, args.max_tuples)
+
+    if not args.no_refine:
+        print('FGR fitness %.4f, refining with point-to-plane ICP' % result.fitness)
+        result, num_starts = global_local_registration(
+            src_down, dst_down, result.transformation, distance_threshold,
+            min_fitness=args.min_fitness)
+        if num_starts:
+            print('Low fitness, tried %d initial poses' % num_starts)
+        print(result)
 
     print("Transformation is:")
     print(result.transformation, "\n")
     print_rt_from_transform(result.transformation)
 
-    src.paint_uniform_color([1, 0, 0])
-    dst.paint_uniform_color([0, 1, 0])
-    o3d.visualization.draw([src.transform(result.transformation), dst])
\ No newline at end of file
+    if not args.headless:
+        src.paint_uniform_color([1, 0, 0])
+        dst.paint_uniform_color([0, 1, 0])
+        o3d.visualization.draw([src.transform(result.transformation), dst])
\ No newline at end of file
@@ -1,7 +1,14 @@
-import open3d as o3d
+import time
 from context import *
+o3d = LazyModule("open3d")
 from copy import deepcopy
-from open3d_utils import print_rt_from_transform, load_mesh_as_point_cloud, load_mesh_subset_as_point_cloud
+from cache_utils import ArrayCache
+from open3d_utils import print_rt_from_transform, load_mesh_as_point_cloud, load_mesh_subset_as_point_cloud, preprocess_point_cloud
+from open3d_utils import transform_from_rt, SAMPLERS
+from libigl_rigid_algnment import rigid_alignment_numpy, rigid_alignment_numpy_batch
+from open3d_icp import global_local_registration
+from profiling import profiled
+from feature_matching import FeatureIndex, match_features
 
 def visualize_registration(src, dst, transformation=np.eye(4)):
     src_trans = deepcopy(src)
@@ -14,23 +21,236 @@ def visualize_registration(src, dst, transformation=np.eye(4)):
     o3d.visualization.draw([src_trans, dst_clone])
 
 
-def preprocess_point_cloud(pcd, voxel_size):
-    pcd_down = pcd.voxel_down_sample(voxel_size)
-    pcd_down.estimate_normals(
-        o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2.0,
-                                             max_nn=30))
-    pcd_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-        pcd_down,
-        o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 5.0,
-                                             max_nn=100),
+@profiled()
+def prefilter_correspondences(src_fpfh, dst_fpfh, ratio=0.9, mutual_filter=True, chunk_size=2048):
+    """
+    Putative correspondences (M, 2) of source to target point indices from
+    nearest feature neighbors, keeping only those that pass the ratio test
+    (nearest distance < ratio * second nearest) and, with mutual_filter,
+    whose target's nearest source feature is the source point itself.
+    Feature distances are computed by brute force, chunk_size source
+    features at a time, in one pass for both directions.
+    """
+    src = np.asarray(src_fpfh.data, dtype=np.float32).T
+    dst = np.asarray(dst_fpfh.data, dtype=np.float32).T
+    dst_norms = np.einsum("ij,ij->i", dst, dst)
+    nearest = np.empty(len(src), dtype=np.int64)
+    nearest_dist = np.empty(len(src), dtype=np.float32)
+    second_dist = np.empty(len(src), dtype=np.float32)
+    # Distance from every target feature to its nearest source feature
+    back_dist = np.full(len(dst), np.inf, dtype=np.float32)
+    rows = np.arange(chunk_size)
+    for start in range(0, len(src), chunk_size):
+        q = src[start:start + chunk_size]
+        r = rows[:len(q)]
+        d = q @ dst.T
+        d *= -2.0
+        d += dst_norms[None, :]
+        d += np.einsum("ij,ij->i", q, q)[:, None]
+        np.minimum(back_dist, d.min(axis=0), out=back_dist)
+
+        first = np.argmin(d, axis=1)
+        nearest[start:start + len(q)] = first
+        nearest_dist[start:start + len(q)] = d[r, first]
+        d[r, first] = np.inf
+        second_dist[start:start + len(q)] = d.min(axis=1)
+
+    # Squared distances: compare with ratio^2, clamp rounding below zero
+    keep = np.maximum(nearest_dist, 0.0) < ratio * ratio * np.maximum(second_dist, 0.0)
+    if mutual_filter:
+        # The source point is the nearest to its target, ties included
+        keep &= nearest_dist <= back_dist[nearest]
+    return np.stack([np.flatnonzero(keep), nearest[keep]], axis=1)
+
+
+@profiled()
+def adaptive_ransac(src_points, dst_points, distance_threshold, confidence=0.999,
+                    max_iterations=100000, time_budget=None, batch_size=256,
+                    edge_length_ratio=0.9, rng=None, chunk_size=1 << 18):
+    """
+    RANSAC over matched points src_points[i] ~ dst_points[i] (both (M, 3))
+    that stops as soon as the number of hypotheses reaches
+    log(1 - confidence) / log(1 - w^3) for the best inlier ratio w seen so
+    far, after max_iterations hypotheses, or once time_budget seconds have
+    passed. Hypotheses are drawn, checked for consistent edge lengths and
+    scored batch_size at a time with vectorized Kabsch solves, against at
+    most chunk_size (hypothesis, correspondence) pairs at once. The time
+    budget is also checked between chunks; a batch cut short is dropped.
+    Returns a 4x4 transform (column vectors) fitted to the inliers of the
+    best hypothesis, the inlier mask and stats: hypotheses drawn, hypotheses
+    evaluated (passing the edge check), inlier ratio, seconds and the
+    reason for stopping.
+    """
+    start = time.perf_counter()
+    rng = np.random.default_rng() if rng is None else rng
+    m = len(src_points)
+    stats = {"correspondences": m, "hypotheses": 0, "evaluated": 0, "inlier_ratio": 0.0,
+             "seconds": 0.0, "stopped": "max_iterations"}
+    best_mask = np.zeros(m, dtype=bool)
+    if m < 3:
+        stats["stopped"] = "too_few_correspondences"
+        return np.eye(4), best_mask, stats
+
+    required = max_iterations
+    threshold2 = distance_threshold ** 2
+    while stats["hypotheses"] < min(required, max_iterations):
+        if time_budget is not None and time.perf_counter() - start > time_budget:
+            stats["stopped"] = "time_budget"
+            break
+        n = min(batch_size, max_iterations - stats["hypotheses"])
+        sample = rng.integers(0, m, size=(n, 3))
+        stats["hypotheses"] += n
+
+        # Edge length check, as CorrespondenceCheckerBasedOnEdgeLength
+        X, P = src_points[sample], dst_points[sample]
+        ex = np.linalg.norm(X - np.roll(X, 1, axis=1), axis=2)
+        ep = np.linalg.norm(P - np.roll(P, 1, axis=1), axis=2)
+        ok = np.all((ex > edge_length_ratio * ep) & (ep > edge_length_ratio * ex), axis=1)
+        if not np.any(ok):
+            continue
+        R, t = rigid_alignment_numpy_batch(X[ok], P[ok])
+        stats["evaluated"] += len(R)
+
+        # Inlier counts per hypothesis, rows correspondences at a time, so
+        # the (hypotheses, rows, 3) temporaries stay below chunk_size rows
+        counts = np.zeros(len(R), dtype=np.int64)
+        rows = max(1, chunk_size // len(R))
+        for i0 in range(0, m, rows):
+            if time_budget is not None and time.perf_counter() - start > time_budget:
+                break
+            residual = np.sum((src_points[None, i0:i0 + rows] @ R + t - dst_points[None, i0:i0 + rows]) ** 2,
+                              axis=2)
+            counts += np.count_nonzero(residual < threshold2, axis=1)
+        else:
+            k = np.argmax(counts)
+            if counts[k] <= best_mask.sum():
+                continue
+            best_mask = np.sum((src_points @ R[k] + t[k] - dst_points) ** 2, axis=1) < threshold2
+            w = counts[k] / m
+            if w >= 1.0:
+                required = 0
+            else:
+                required = int(np.ceil(np.log(1.0 - confidence) / np.log(1.0 - w ** 3)))
+    else:
+        if stats["hypotheses"] >= required:
+            stats["stopped"] = "confidence"
+
+    stats["inlier_ratio"] = float(best_mask.mean())
+    if best_mask.sum() < 3:
+        stats["seconds"] = time.perf_counter() - start
+        return np.eye(4), best_mask, stats
+    R, t = rigid_alignment_numpy(src_points[best_mask], dst_points[best_mask])
+    stats["seconds"] = time.perf_counter() - start
+    # Row-vector X @ R + t to the column-vector 4x4 of Open3D
+    return transform_from_rt(R, t), best_mask, stats
+
+
+@profiled()
+def adaptive_ransac_registration(src_down, dst_down, src_fpfh, dst_fpfh, distance_threshold,
+                                 mutual_filter=True, ratio=0.9, max_iterations=100000,
+                                 confidence=0.999, time_budget=None, rng=None, index=None,
+                                 src_index=None):
+    """
+    adaptive_ransac on prefilter_correspondences of the FPFH features, or
+    with index (a feature_matching.FeatureIndex of dst_fpfh) on the
+    approximate match_features, which reuses src_index (one of src_fpfh),
+    if given, for mutual_filter. Returns the registration result on the
+    downsampled clouds and the RANSAC stats, with the prefiltering
+    included in seconds.
+    """
+    start = time.perf_counter()
+    if index is None:
+        corres = prefilter_correspondences(src_fpfh, dst_fpfh, ratio, mutual_filter)
+    else:
+        corres = match_features(src_fpfh if src_index is None else src_index, index, 1, ratio,
+                                mutual_filter)
+    src_points = np.asarray(src_down.points)[corres[:, 0]]
+    dst_points = np.asarray(dst_down.points)[corres[:, 1]]
+    if time_budget is not None:
+        time_budget = max(0.0, time_budget - (time.perf_counter() - start))
+    T, _, stats = adaptive_ransac(src_points, dst_points, distance_threshold, confidence,
+                                  max_iterations, time_budget, rng=rng)
+    result = o3d.pipelines.registration.evaluate_registration(
+        src_down, dst_down, distance_threshold, T)
+    stats["seconds"] = time.perf_counter() - start
+    return result, stats
+
+
+@profiled()
+def execute_ransac_registration(src_down, dst_down, src_fpfh, dst_fpfh,
+                                distance_threshold, method="from_correspondences",
+                                mutual_filter=False, max_iterations=100000,
+                                confidence=0.999, index=None, ratio=None,
+                                feature_index=False, src_index=None):
+    """
+    Open3D RANSAC on FPFH features: "from_features" matches them inside
+    Open3D, "from_correspondences" on exact nearest-neighbor matches and
+    "adaptive" runs adaptive_ransac_registration. With index (a
+    feature_matching.FeatureIndex of dst_fpfh) or feature_index (build
+    one), the last two match with the approximate match_features instead,
+    reusing src_index (a FeatureIndex of src_fpfh), if given, for
+    mutual_filter. ratio is the ratio test threshold of the matches
+    (default: off for from_correspondences, 0.9 for adaptive).
+    """
+    if index is None and feature_index and method != "from_features":
+        index = FeatureIndex(dst_fpfh)
+    checkers = [
+        o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
+        o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(
+            distance_threshold),
+    ]
+    criteria = o3d.pipelines.registration.RANSACConvergenceCriteria(
+        max_iterations, confidence)
+    estimation = o3d.pipelines.registration.TransformationEstimationPointToPoint(False)
+
+    if method == "from_features":
+        return o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
+            src_down,
+            dst_down,
+            src_fpfh,
+            dst_fpfh,
+            mutual_filter=mutual_filter,
+            max_correspondence_distance=distance_threshold,
+            estimation_method=estimation,
+            ransac_n=3,
+            checkers=checkers,
+            criteria=criteria,
+        )
+
+    if method == "adaptive":
+        return adaptive_ransac_registration(
+            src_down, dst_down, src_fpfh, dst_fpfh, distance_threshold,
+            mutual_filter=mutual_filter, ratio=0.9 if ratio is None else ratio,
+            max_iterations=max_iterations, confidence=confidence, index=index,
+            src_index=src_index)[0]
+
+    ratio = 1.0 if ratio is None else ratio
+    if index is not None:
+        # Nearest neighbors from the approximate index instead of brute force
+        matches = match_features(src_fpfh if src_index is None else src_index, index, ratio=ratio,
+                                 mutual_filter=mutual_filter)
+        corres = o3d.utility.Vector2iVector(matches.astype(np.int32))
+    elif ratio < 1.0:
+        corres = o3d.utility.Vector2iVector(
+            prefilter_correspondences(src_fpfh, dst_fpfh, ratio, mutual_filter).astype(np.int32))
+    else:
+        corres = o3d.pipelines.registration.correspondences_from_features(
+            src_fpfh, dst_fpfh, mutual_filter)
+    return o3d.pipelines.registration.registration_ransac_based_on_correspondence(
+        src_down,
+        dst_down,
+        corres,
+        max_correspondence_distance=distance_threshold,
+        estimation_method=estimation,
+        ransac_n=3,
+        checkers=checkers,
+        criteria=criteria,
     )
-    return (pcd_down, pcd_fpfh)
+
 
 # To run:
 # python open3d_registration_ransac.py ../data/mask.obj ../data/max_planck_face.obj 
 if __name__ == "__main__":
-    pcd_data = o3d.data.DemoICPPointClouds()
-
     # yapf: disable
     parser = argparse.ArgumentParser(
         "Global point cloud registration example with RANSAC"
@@ -43,6 +263,13 @@ if __name__ == "__main__":
         default=10000,
         help="Number of sampled points from mesh A per iteration (default 10000)",
     )
+    parser.add_argument(
+        "--sampler",
+        choices=["poisson"] + list(SAMPLERS),
+        default="poisson",
+        help="Surface sampler: Open3D Poisson disk, or the faster uniform / voxel / blue_noise",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the sampler")
     parser.add_argument(
         "--voxel_size", type=float, default=0.01,
         help="voxel size in meter used to downsample inputs",
@@ -65,7 +292,42 @@ if __name__ == "__main__":
         help="whether to use mutual filter for putative correspondences",
     )
     parser.add_argument(
-        "--method", choices=["from_features", "from_correspondences"], default="from_correspondences"
+        "--method", choices=["from_features", "from_correspondences", "adaptive"],
+        default="from_correspondences",
+        help="RANSAC variant (register.py's ransac stage defaults to adaptive with the mutual filter)",
+    )
+    parser.add_argument(
+        "--ratio", type=float, default=None,
+        help="feature ratio test threshold for putative correspondences "
+        "(default 0.9 for adaptive, 1 = off for from_correspondences)",
+    )
+    parser.add_argument(
+        "--feature_index", action="store_true",
+        help="match features with the approximate feature_matching.FeatureIndex instead of brute force",
+    )
+    parser.add_argument(
+        "--time_budget", type=float, default=None,
+        help="adaptive: stop drawing hypotheses after this many seconds",
+    )
+    parser.add_argument(
+        "--no_refine", action="store_true",
+        help="stop at the RANSAC result instead of refining it with point-to-plane ICP",
+    )
+    parser.add_argument(
+        "--min_fitness", type=float, default=0.3,
+        help="try multiple initial rotations if the refined fitness is below this",
+    )
+    parser.add_argument(
+        "--headless", action="store_true",
+        help="do not open a window with the result",
+    )
+    parser.add_argument(
+        "--cache_dir", type=str, default=None,
+        help="cache sampled clouds and features in this directory",
+    )
+    parser.add_argument(
+        "--cache_size_mb", type=int, default=2048,
+        help="size bound of the cache directory",
     )
     # yapf: enable
 
@@ -73,70 +335,51 @@ if __name__ == "__main__":
 
     voxel_size = args.voxel_size
     distance_threshold = args.distance_multiplier * voxel_size
+    cache = None
+    if args.cache_dir is not None:
+        cache = ArrayCache(args.cache_dir, max_bytes=args.cache_size_mb << 20)
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
 
     print("Reading inputs")
-    src = load_mesh_as_point_cloud(args.mesh_source, n_points=args.samples)
+    src = load_mesh_as_point_cloud(args.mesh_source, n_points=args.samples, cache=cache,
+                                   sampler=args.sampler, seed=args.seed)
     # dst = load_mesh_as_point_cloud(args.mesh_target, n_points=args.samples)
-    dst = load_mesh_subset_as_point_cloud(args.mesh_target, n_points=args.samples)
+    dst = load_mesh_subset_as_point_cloud(args.mesh_target, n_points=args.samples, cache=cache,
+                                          sampler=args.sampler, seed=args.seed)
 
     print("Downsampling inputs")
-    src_down, src_fpfh = preprocess_point_cloud(src, voxel_size)
-    dst_down, dst_fpfh = preprocess_point_cloud(dst, voxel_size)
-
-    if args.method == "from_features":
-        print("Running RANSAC from features")
-        result = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
-            src_down,
-            dst_down,
-            src_fpfh,
-            dst_fpfh,
-            mutual_filter=args.mutual_filter,
-            max_correspondence_distance=distance_threshold,
-            estimation_method=o3d.pipelines.registration.
-            TransformationEstimationPointToPoint(False),
-            ransac_n=3,
-            checkers=[
-                o3d.pipelines.registration.
-                CorrespondenceCheckerBasedOnEdgeLength(0.9),
-                o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(
-                    distance_threshold),
-            ],
-            criteria=o3d.pipelines.registration.RANSACConvergenceCriteria(
-                args.max_iterations, args.confidence),
-        )
-        visualize_registration(src, dst, result.transformation)
-
-    elif args.method == "from_correspondences":
-        print("Running RANSAC from correspondences")
-        # Mimic importing customized external features (e.g. learned FCGF features) in numpy
-        # shape: (feature_dim, num_features)
-        src_fpfh_np = np.asarray(src_fpfh.data).copy()
-        dst_fpfh_np = np.asarray(dst_fpfh.data).copy()
-
-        src_fpfh_import = o3d.pipelines.registration.Feature()
-        src_fpfh_import.data = src_fpfh_np
+    src_down, src_fpfh = preprocess_point_cloud(src, voxel_size, cache=cache)
+    dst_down, dst_fpfh = preprocess_point_cloud(dst, voxel_size, cache=cache)
 
-        dst_fpfh_import = o3d.pipelines.registration.Feature()
-        dst_fpfh_import.data = dst_fpfh_np
-
-        corres = o3d.pipelines.registration.correspondences_from_features(
-            src_fpfh_import, dst_fpfh_import, args.mutual_filter)
-        result = o3d.pipelines.registration.registration_ransac_based_on_correspondence(
-            src_down,
-            dst_down,
-            corres,
-            max_correspondence_distance=distance_threshold,
-            estimation_method=o3d.pipelines.registration.
-            TransformationEstimationPointToPoint(False),
-            ransac_n=3,
-            checkers=[
-                o3d.pipelines.registration.
-                CorrespondenceCheckerBasedOnEdgeLength(0.9),
-                o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(
-                    distance_threshold),
-            ],
-            criteria=o3d.pipelines.registration.RANSACConvergenceCriteria(
-                args.max_iterations, args.confidence),
-        )
+    print("Running RANSAC %s" % args.method.replace("_", " "))
+    start = time.perf_counter()
+    if args.method == "adaptive":
+        result, stats = adaptive_ransac_registration(
+            src_down, dst_down, src_fpfh, dst_fpfh, distance_threshold,
+            mutual_filter=args.mutual_filter, ratio=0.9 if args.ratio is None else args.ratio,
+            max_iterations=args.max_iterations, confidence=args.confidence,
+            time_budget=args.time_budget,
+            index=FeatureIndex(dst_fpfh) if args.feature_index else None)
+        print("%d correspondences, %d hypotheses (%d evaluated), inlier ratio %.3f, stopped by %s" % (
+            stats["correspondences"], stats["hypotheses"], stats["evaluated"],
+            stats["inlier_ratio"], stats["stopped"]))
+    else:
+        result = execute_ransac_registration(
+            src_down, dst_down, src_fpfh, dst_fpfh, distance_threshold,
+            method=args.method, mutual_filter=args.mutual_filter,
+            max_iterations=args.max_iterations, confidence=args.confidence,
+            ratio=args.ratio, feature_index=args.feature_index)
+    print("RANSAC took %.3f s" % (time.perf_counter() - start))
+    if not args.no_refine:
+        print("RANSAC fitness %.4f, refining with point-to-plane ICP" % result.fitness)
+        result, num_starts = global_local_registration(
+            src_down, dst_down, result.transformation, distance_threshold,
+            min_fitness=args.min_fitness)
+        if num_starts:
+            print("Low fitness, tried %d initial poses" % num_starts)
+        print(result)
+    print("Transformation is:")
+    print(result.transformation, "\n")
+    print_rt_from_transform(result.transformation)
+    if not args.headless:
         visualize_registration(src, dst, result.transformation)
\ No newline at end of file
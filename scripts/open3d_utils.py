@@ -1,76 +1,237 @@
+from __future__ import annotations
 from context import *
-import open3d as o3d
-import plydata
+o3d = LazyModule("open3d")
+from ply_io import read_ply
+from cache_utils import ArrayCache, file_hash, array_hash, make_key
+from profiling import profiled, span
 
+@profiled()
 def load_ply(file_name):
-    ply_data = PlyData.read(file_name)
-    vertices = ply_data["vertex"]
-    vertices = np.vstack([vertices["x"], vertices["y"], vertices["z"]]).T
-    data = {"vertices": vertices}
+    """
+    Load vertices, triangles and the quality-based vertex/face selections
+    of a PLY file. Binary files are memory-mapped by ply_io.read_ply and
+    only x, y, z, vertex_indices and quality are read; other files go
+    through plyfile.
+    """
+    properties = {"vertex": ["x", "y", "z", "quality"], "face": ["vertex_indices", "quality"]}
+    try:
+        ply = read_ply(file_name, properties)
+    except NotImplementedError:
+        ply = load_ply_plyfile(file_name, properties)
+    vertex, face = ply["vertex"], ply["face"]
 
-    faces = np.vstack(ply_data["face"]["vertex_indices"])
-    data["faces"] = faces
+    vertices = np.empty((len(vertex["x"]), 3))
+    for k, axis in enumerate("xyz"):
+        vertices[:, k] = vertex[axis]
+    data = {"vertices": vertices}
+    data["faces"] = np.ascontiguousarray(face["vertex_indices"], dtype=np.int32)
 
-    try:
-        vertex_quality = np.vstack(ply_data["vertex"]["quality"])
-        vertex_selection = np.float32(vertex_quality > 0)
-        data["vertex_selection"] = vertex_selection
-    except ValueError:
+    if "quality" in vertex:
+        data["vertex_selection"] = np.float32(vertex["quality"] > 0)[:, None]
+    else:
         data["vertex_selection"] = None
         print("The ply file %s does not contain quality property for vertex selection." % file_name)
 
-    try:
-        face_quality = np.vstack(ply_data["face"]["quality"])
-        face_selection = np.float32(face_quality > 0)
-        data["face_selection"] = face_selection
-    except ValueError:
+    if "quality" in face:
+        data["face_selection"] = np.float32(face["quality"] > 0)[:, None]
+    else:
         data["face_selection"] = None
         print("The ply file %s does not contain quality property for face selection." % file_name)
 
     return data
 
 
-def extract_selected_mesh(data):
+def load_ply_plyfile(file_name, properties):
+    """read_ply equivalent for ASCII or non-triangle PLY files."""
+    from plyfile import PlyData
+    ply_data = PlyData.read(file_name)
+    data = {}
+    for name, props in properties.items():
+        element = ply_data[name]
+        names = element.data.dtype.names
+        data[name] = {}
+        for p in props:
+            if p not in names:
+                continue
+            column = element[p]
+            if column.dtype == object:
+                column = np.vstack(column)
+            data[name][p] = column
+    return data
+
+
+def extract_selected_arrays(data):
+    """
+    Vertices and faces of the selected part of a mesh loaded by load_ply.
+    Faces are selected by face_selection if present, otherwise by having
+    all three vertices in vertex_selection; unused vertices are dropped
+    and face indices remapped. Returns (vertices, faces), or the full mesh
+    if there is no selection annotation.
+    """
     vertices = data["vertices"]
     faces = data["faces"]
     vsel = data["vertex_selection"]
     fsel = data["face_selection"]
 
     if fsel is not None:
-        selected_faces = faces[fsel[:, 0] > 0]
-        selected_vertices_idx = np.unique(selected_faces.flatten())
-        selected_vertices = vertices[selected_vertices_idx]
-        # Remap indices for Open3D
-        index_map = np.zeros(len(vertices), dtype=int)
-        index_map[selected_vertices_idx] = np.arange(len(selected_vertices))
-        remapped_faces = np.array([[index_map[i] for i in f] for f in selected_faces])
-        mesh = o3d.geometry.TriangleMesh(
-            o3d.utility.Vector3dVector(selected_vertices),
-            o3d.utility.Vector3iVector(remapped_faces),
-        )
+        face_mask = np.ravel(fsel) > 0
     elif vsel is not None:
-        selected_vertices = vertices[vsel[:, 0] > 0]
-        mask = np.isin(faces, np.where(vsel[:, 0] > 0)[0]).all(axis=1)
-        remapped_faces = faces[mask]
-        selected_vertices_idx = np.unique(remapped_faces.flatten())
-        selected_vertices = vertices[selected_vertices_idx]
-        index_map = np.zeros(len(vertices), dtype=int)
-        index_map[selected_vertices_idx] = np.arange(len(selected_vertices))
-        remapped_faces = np.array([[index_map[i] for i in f] for f in remapped_faces])
-        mesh = o3d.geometry.TriangleMesh(
-            o3d.utility.Vector3dVector(selected_vertices),
-            o3d.utility.Vector3iVector(remapped_faces),
-        )
+        face_mask = (np.ravel(vsel) > 0)[faces].all(axis=1)
     else:
-        print("No selection annotation found, using full mesh.")
-        mesh = o3d.geometry.TriangleMesh(
-            o3d.utility.Vector3dVector(vertices),
-            o3d.utility.Vector3iVector(faces),
-        )
+        return vertices, faces
+
+    selected_faces = faces[face_mask]
+    # Keep used vertices in their original order and remap indices for Open3D
+    used = np.zeros(len(vertices), dtype=bool)
+    used[selected_faces.ravel()] = True
+    index_map = np.cumsum(used, dtype=np.int64) - 1
+    return vertices[used], index_map[selected_faces].astype(np.int32)
 
+
+@profiled()
+def extract_selected_mesh(data):
+    if data["face_selection"] is None and data["vertex_selection"] is None:
+        print("No selection annotation found, using full mesh.")
+    vertices, faces = extract_selected_arrays(data)
+    mesh = o3d.geometry.TriangleMesh(
+        o3d.utility.Vector3dVector(vertices),
+        o3d.utility.Vector3iVector(faces),
+    )
     return mesh
 
 
+def sample_mesh_arrays(vertices, faces, n_points, seed=None):
+    """
+    Area-weighted uniform samples on a triangle mesh given as arrays.
+    Returns (points, normals), normals being the unit normals of the sampled faces.
+    """
+    rng = np.random.default_rng(seed)
+    a, b, c = (vertices[faces[:, k]] for k in range(3))
+    cross = np.cross(b - a, c - a)
+    area2 = np.linalg.norm(cross, axis=1)
+    f = rng.choice(len(faces), size=n_points, p=area2 / area2.sum())
+    # Uniform barycentric coordinates by folding the unit square
+    u, v = rng.random((2, n_points))
+    fold = u + v > 1.0
+    u[fold], v[fold] = 1.0 - u[fold], 1.0 - v[fold]
+    points = a[f] + u[:, None] * (b[f] - a[f]) + v[:, None] * (c[f] - a[f])
+    normals = cross[f] / np.maximum(area2[f], np.finfo(float).tiny)[:, None]
+    return points, normals
+
+
+def _one_per_cell(points, cell_size, order):
+    """Indices of the first point in order of each occupied cubic cell, in that order."""
+    keys = np.floor(points[order] / cell_size).astype(np.int64)
+    keys -= keys.min(axis=0)
+    # One integer per cell: unique on rows of keys is many times slower
+    flat = np.ravel_multi_index(keys.T, keys.max(axis=0) + 1)
+    _, first = np.unique(flat, return_index=True)
+    return order[np.sort(first)]
+
+
+def _fit_count(rng, keep, n_points):
+    """Randomly thin the kept indices to n_points."""
+    if len(keep) > n_points:
+        keep = keep[np.sort(rng.choice(len(keep), n_points, replace=False))]
+    return keep
+
+
+def _surface_area(vertices, faces):
+    a, b, c = (vertices[faces[:, k]] for k in range(3))
+    return 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1).sum()
+
+
+def sample_mesh_voxel(vertices, faces, n_points, seed=None, oversample=4):
+    """
+    Voxel-grid sampling: oversample uniformly, keep one random sample per
+    voxel and thin to n_points. Gives an even density with none of the
+    clumping of uniform samples. The voxel size starts at
+    sqrt(area / n_points) and shrinks until there are n_points voxels.
+    """
+    rng = np.random.default_rng(seed)
+    points, normals = sample_mesh_arrays(vertices, faces, oversample * n_points, rng)
+    order = rng.permutation(len(points))
+    cell = np.sqrt(_surface_area(vertices, faces) / n_points)
+    for _ in range(5):
+        keep = _one_per_cell(points, cell, order)
+        if len(keep) >= n_points:
+            break
+        cell *= 0.9 * np.sqrt(len(keep) / n_points)
+    keep = _fit_count(rng, keep, n_points)
+    return points[keep], normals[keep]
+
+
+def sample_mesh_blue_noise(vertices, faces, n_points, seed=None, oversample=3):
+    """
+    Approximate Poisson-disk (blue noise) sampling, vectorized. Uniform
+    candidates in random order are reduced to one per cell of size r / sqrt(3)
+    (two points in one cell are closer than r), then of every remaining
+    pair closer than r the later one is dropped. This drops more points
+    than sequential dart throwing would, and r is shrunk until n_points
+    remain. Unlike sample_points_poisson_disk there is no elimination
+    loop over a KD-tree.
+    """
+    from scipy.spatial import cKDTree
+    rng = np.random.default_rng(seed)
+    points, normals = sample_mesh_arrays(vertices, faces, oversample * n_points, rng)
+    order = rng.permutation(len(points))
+    # Half the spacing of n_points in a hexagonal packing of the area; the
+    # pair pruning keeps about half of what dart throwing would at one radius
+    r = 0.5 * np.sqrt(2.0 * _surface_area(vertices, faces) / (np.sqrt(3.0) * n_points))
+    for _ in range(5):
+        # keep is in candidate order, so the larger index of a pair is the later point
+        keep = _one_per_cell(points, r / np.sqrt(3.0), order)
+        pairs = cKDTree(points[keep]).query_pairs(r, output_type="ndarray")
+        dropped = np.zeros(len(keep), dtype=bool)
+        dropped[pairs.max(axis=1)] = True
+        keep = np.sort(keep[~dropped])
+        if len(keep) >= n_points:
+            break
+        r *= 0.95 * np.sqrt(len(keep) / n_points)
+    keep = _fit_count(rng, keep, n_points)
+    return points[keep], normals[keep]
+
+
+# name: function(vertices, faces, n_points, seed) -> (points, normals)
+SAMPLERS = {
+    "uniform": sample_mesh_arrays,
+    "voxel": sample_mesh_voxel,
+    "blue_noise": sample_mesh_blue_noise,
+}
+
+
+def sample_mesh(mesh: o3d.geometry.TriangleMesh, n_points, sampler="poisson",
+                seed=None) -> o3d.geometry.PointCloud:
+    """
+    Sample a point cloud with normals on mesh with one of SAMPLERS, or
+    with Open3D's sample_points_poisson_disk for "poisson". Open3D has no
+    per-call seed, so a seed for "poisson" reseeds its global random
+    generator (o3d.utility.random.seed), which every later random Open3D
+    call in the process then continues from; with seed None it is left alone.
+    """
+    if sampler == "poisson":
+        if seed is not None:
+            o3d.utility.random.seed(seed)
+        if not mesh.has_vertex_normals():
+            mesh.compute_vertex_normals()
+        return mesh.sample_points_poisson_disk(number_of_points=n_points, init_factor=5)
+    if sampler not in SAMPLERS:
+        raise ValueError("Unknown sampler %s, expected one of %s" % (sampler, ["poisson"] + list(SAMPLERS)))
+    points, normals = SAMPLERS[sampler](
+        np.asarray(mesh.vertices), np.asarray(mesh.triangles), n_points, seed)
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    pcd.normals = o3d.utility.Vector3dVector(normals)
+    return pcd
+
+
+def sample_selected_point_cloud(data, n_points, seed=None) -> o3d.geometry.PointCloud:
+    """Sample the selected part of a load_ply mesh directly, without building a TriangleMesh."""
+    points, normals = sample_mesh_arrays(*extract_selected_arrays(data), n_points, seed)
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    pcd.normals = o3d.utility.Vector3dVector(normals)
+    return pcd
+
+
 def print_rt_from_transform(T):
     """
     Given a 4x4 transformation matrix T,
@@ -89,36 +250,149 @@ def print_rt_from_transform(T):
     print(np.array2string(t, precision=6, suppress_small=True))
 
 
+def transform_from_rt(R, t):
+    """4x4 transform (column vectors) from the row-vector R, t used by libigl: X @ R + t."""
+    T = np.eye(4)
+    T[:3, :3] = np.asarray(R).T
+    T[:3, 3] = np.ravel(t)
+    return T
+
+
+def rt_from_transform(T):
+    """Row-vector R (3x3), t (3,) of a 4x4 transform, inverse of transform_from_rt."""
+    T = np.asarray(T)
+    return T[:3, :3].T.copy(), T[:3, 3].copy()
+
+
+@profiled()
+def load_mesh_arrays(path, subset=True):
+    """
+    (V, F) of a mesh as float64 / int32 arrays; for PLY files only the
+    selected part, unless subset is False.
+    """
+    if subset and os.path.splitext(path)[1].lower() == ".ply":
+        return extract_selected_arrays(load_ply(path))
+    mesh = o3d.io.read_triangle_mesh(path)
+    if mesh.is_empty():
+        raise ValueError(f"Failed to load mesh: {path}")
+    return np.asarray(mesh.vertices), np.asarray(mesh.triangles, dtype=np.int32)
+
+
+def point_cloud_to_arrays(pcd: o3d.geometry.PointCloud) -> dict[str, np.ndarray]:
+    arrays = {"points": np.asarray(pcd.points)}
+    if pcd.has_normals():
+        arrays["normals"] = np.asarray(pcd.normals)
+    return arrays
+
+
+def point_cloud_from_arrays(arrays: dict[str, np.ndarray]) -> o3d.geometry.PointCloud:
+    # Open3D copies into its own storage and refuses read-only (memory-mapped) arrays
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.array(arrays["points"])))
+    if "normals" in arrays:
+        pcd.normals = o3d.utility.Vector3dVector(np.array(arrays["normals"]))
+    return pcd
+
+
+@profiled()
 def load_mesh_subset_as_point_cloud(
     path: str,
     n_points: int = 50000,
     voxel_size: float | None = None,
     estimate_normals: bool = True,
+    cache: ArrayCache | None = None,
+    sampler: str = "poisson",
+    seed: int | None = None,
 ) -> tuple[o3d.geometry.PointCloud, o3d.geometry.TriangleMesh]:
 
+    if cache is not None:
+        with span("cache_get"):
+            # Unseeded Poisson keys stay those of the caches written before samplers were selectable
+            params = (n_points,) if sampler == "poisson" and seed is None else (n_points, sampler, seed)
+            key = make_key("load_mesh_subset_as_point_cloud", file_hash(path), *params)
+            arrays = cache.get(key)
+        if arrays is not None:
+            return point_cloud_from_arrays(arrays)
+
     ext = os.path.splitext(path)[1].lower()
     if ext == ".ply":
         data = load_ply(path)                     
         mesh = extract_selected_mesh(data)        
     else:
-        mesh = o3d.io.read_triangle_mesh(path)
-
-    if not mesh.has_vertex_normals():
-        mesh.compute_vertex_normals()
-    if not mesh.has_triangle_normals():
-        mesh.compute_triangle_normals()
+        with span("read_triangle_mesh"):
+            mesh = o3d.io.read_triangle_mesh(path)
 
-    pcd = mesh.sample_points_poisson_disk(n_points)
+    with span("sample_mesh", sampler=sampler, n_points=n_points):
+        pcd = sample_mesh(mesh, n_points, sampler, seed)
 
+    if cache is not None:
+        with span("cache_put"):
+            cache.put(key, point_cloud_to_arrays(pcd))
     return pcd
 
-def load_mesh_as_point_cloud(path: str, n_points: int = 200000) -> o3d.geometry.PointCloud:
-    """Load a mesh and sample a dense point cloud on its surface."""
-    mesh = o3d.io.read_triangle_mesh(path)
+@profiled()
+def load_mesh_as_point_cloud(
+    path: str, n_points: int = 200000, cache: ArrayCache | None = None,
+    sampler: str = "poisson", seed: int | None = None,
+) -> o3d.geometry.PointCloud:
+    """
+    Load a mesh and sample a dense point cloud on its surface with
+    sample_mesh. Poisson disk sampling gives better coverage than uniform,
+    "voxel" and "blue_noise" come close at a fraction of its cost.
+    """
+    if cache is not None:
+        with span("cache_get"):
+            params = (n_points,) if sampler == "poisson" and seed is None else (n_points, sampler, seed)
+            key = make_key("load_mesh_as_point_cloud", file_hash(path), *params)
+            arrays = cache.get(key)
+        if arrays is not None:
+            return point_cloud_from_arrays(arrays)
+
+    with span("read_triangle_mesh"):
+        mesh = o3d.io.read_triangle_mesh(path)
     if mesh.is_empty():
         raise ValueError(f"Failed to load mesh: {path}")
-    if not mesh.has_vertex_normals():
-        mesh.compute_vertex_normals()
-    # Poisson disk sampling gives better coverage than uniform
-    pcd = mesh.sample_points_poisson_disk(number_of_points=n_points, init_factor=5)
+    with span("sample_mesh", sampler=sampler, n_points=n_points):
+        pcd = sample_mesh(mesh, n_points, sampler, seed)
+
+    if cache is not None:
+        with span("cache_put"):
+            cache.put(key, point_cloud_to_arrays(pcd))
     return pcd
+
+
+@profiled()
+def preprocess_point_cloud(pcd, voxel_size, cache: ArrayCache | None = None):
+    """
+    Downsample pcd to voxel_size, estimate normals and compute FPFH features.
+    With a cache, results are keyed by the points of pcd and the radii.
+    """
+    normal_radius, feature_radius = voxel_size * 2.0, voxel_size * 5.0
+    if cache is not None:
+        with span("cache_get"):
+            key = make_key("preprocess_point_cloud", array_hash(np.asarray(pcd.points)),
+                           voxel_size, normal_radius, feature_radius)
+            arrays = cache.get(key)
+        if arrays is not None:
+            pcd_fpfh = o3d.pipelines.registration.Feature()
+            pcd_fpfh.data = np.array(arrays.pop("fpfh"))
+            return (point_cloud_from_arrays(arrays), pcd_fpfh)
+
+    with span("voxel_down_sample", voxel_size=voxel_size) as attrs:
+        pcd_down = pcd.voxel_down_sample(voxel_size)
+        attrs["points"] = len(pcd_down.points)
+    with span("estimate_normals"):
+        pcd_down.estimate_normals(
+            o3d.geometry.KDTreeSearchParamHybrid(radius=normal_radius,
+                                                 max_nn=30))
+    with span("compute_fpfh_feature"):
+        pcd_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
+            pcd_down,
+            o3d.geometry.KDTreeSearchParamHybrid(radius=feature_radius,
+                                                 max_nn=100))
+
+    if cache is not None:
+        with span("cache_put"):
+            arrays = point_cloud_to_arrays(pcd_down)
+            arrays["fpfh"] = np.asarray(pcd_fpfh.data)
+            cache.put(key, arrays)
+    return (pcd_down, pcd_fpfh)
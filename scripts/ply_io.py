@@ -0,0 +1,111 @@
+import os
+import numpy as np
+
+PLY_TYPES = {
+    "char": "i1", "int8": "i1",
+    "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2",
+    "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4",
+    "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4",
+    "double": "f8", "float64": "f8",
+}
+
+
+def read_ply_header(f):
+    """
+    Parse the header of an open PLY file.
+    Returns (format, elements, header_size) where elements is a list of
+    (name, count, properties) and each property is (name, type) for scalars
+    or (name, (count_type, item_type)) for lists.
+    """
+    if f.readline().strip() != b"ply":
+        raise ValueError("Not a PLY file")
+    fmt = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("Unexpected end of PLY header")
+        words = line.decode("ascii").split()
+        if not words or words[0] in ("comment", "obj_info"):
+            continue
+        if words[0] == "format":
+            fmt = words[1]
+        elif words[0] == "element":
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == "property":
+            if words[1] == "list":
+                elements[-1][2].append((words[4], (words[2], words[3])))
+            else:
+                elements[-1][2].append((words[2], words[1]))
+        elif words[0] == "end_header":
+            return fmt, elements, f.tell()
+
+
+def element_dtype(properties, endian, list_length):
+    """
+    Structured dtype of one element record, with every list property
+    holding list_length items (e.g. 3 for triangles).
+    """
+    fields = []
+    for name, ptype in properties:
+        if isinstance(ptype, tuple):
+            count_type, item_type = ptype
+            fields.append((name + "_count", endian + PLY_TYPES[count_type]))
+            fields.append((name, endian + PLY_TYPES[item_type], (list_length,)))
+        else:
+            fields.append((name, endian + PLY_TYPES[ptype]))
+    return np.dtype(fields)
+
+
+def read_ply(path, properties, face_size=3, mmap=True):
+    """
+    Read selected properties of a binary PLY file without per-record Python
+    objects. Element blocks are memory-mapped as fixed-stride records;
+    list properties (e.g. face vertex_indices) must all have face_size
+    items. properties maps element names to the property names to return,
+    e.g. {"vertex": ["x", "y", "z"], "face": ["vertex_indices"]}.
+    Returns {element: {property: array}} with properties the file does not
+    have left out. Raises NotImplementedError for ASCII files and variable
+    length lists, and ValueError for files shorter than their header says.
+    """
+    with open(path, "rb") as f:
+        fmt, elements, offset = read_ply_header(f)
+    if fmt == "binary_little_endian":
+        endian = "<"
+    elif fmt == "binary_big_endian":
+        endian = ">"
+    else:
+        raise NotImplementedError("Only binary PLY files are supported, got %s" % fmt)
+
+    size = os.path.getsize(path)
+    data = {}
+    remaining = set(properties)
+    for name, count, props in elements:
+        if not remaining:
+            break
+        dtype = element_dtype(props, endian, face_size)
+        if offset + count * dtype.itemsize > size:
+            # With lists, shorter lists than face_size also end up here
+            if any(isinstance(ptype, tuple) for _, ptype in props):
+                raise NotImplementedError(
+                    "Element %s does not fit in %s as lists of length %d" % (name, path, face_size))
+            raise ValueError("%s is truncated: element %s needs %d bytes at offset %d, the file has %d"
+                             % (path, name, count * dtype.itemsize, offset, size))
+        if count > 0:
+            block = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+        else:
+            block = np.zeros(0, dtype=dtype)
+        # Fixed-stride records are only valid if every list has face_size items
+        for p, ptype in props:
+            if isinstance(ptype, tuple) and not np.all(block[p + "_count"] == face_size):
+                raise NotImplementedError(
+                    "Element %s has lists that are not of length %d" % (name, face_size))
+        if name in remaining:
+            wanted = [p for p in properties[name] if p in dtype.names]
+            data[name] = {p: block[p] if mmap else np.array(block[p]) for p in wanted}
+            remaining.discard(name)
+        offset += count * dtype.itemsize
+    return data
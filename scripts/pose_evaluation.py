@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Vectorized scoring of many rigid poses of one source cloud against one
+target cloud. The target KD-tree is built once (PoseEvaluator) and every
+pose is scored with the metrics of Open3D's evaluate_registration (fitness,
+inlier RMSE) plus an optional chamfer distance. Poses are transformed and
+queried in chunks of at most chunk_size points, so thousands of candidate
+poses or registration results can be ranked without a copy of the cloud
+per pose.
+"""
+import time
+from context import *
+from profiling import profiled
+
+
+def transform_points(points, transforms, out=None) -> np.ndarray:
+    """
+    (N, 3) points moved by a (4, 4) transform (column vectors, as Open3D)
+    to (N, 3), or by a stack of (K, 4, 4) transforms to (K, N, 3). out may
+    be a preallocated result, or points itself to transform in place.
+    """
+    T = np.asarray(transforms, dtype=np.float64)
+    if T.ndim == 2:
+        out = np.matmul(points, T[:3, :3].T, out=out)
+        out += T[:3, 3]
+        return out
+    out = np.matmul(points, T[:, :3, :3].transpose(0, 2, 1), out=out)
+    out += T[:, None, :3, 3]
+    return out
+
+
+def inverse_transforms(transforms) -> np.ndarray:
+    """Inverses of a stack of (K, 4, 4) rigid transforms."""
+    T = np.asarray(transforms, dtype=np.float64)
+    inv = np.zeros_like(T)
+    R_inv = T[:, :3, :3].transpose(0, 2, 1)
+    inv[:, :3, :3] = R_inv
+    inv[:, :3, 3] = -np.einsum("kij,kj->ki", R_inv, T[:, :3, 3])
+    inv[:, 3, 3] = 1.0
+    return inv
+
+
+def nearest_statistics(tree, points, transforms, max_distance, truncation=np.inf,
+                       chunk_size=1 << 20, workers=-1):
+    """
+    For each of the (K, 4, 4) transforms: the number of moved points within
+    max_distance of their nearest point in tree, the sum of those squared
+    distances and the sum of all squared distances clamped to truncation.
+    Searches stop at max(max_distance, truncation), which makes poses far
+    from the target much cheaper than an unbounded search.
+    """
+    k, n = len(transforms), len(points)
+    count = np.zeros(k, dtype=np.int64)
+    inlier_sq = np.zeros(k)
+    total_sq = np.zeros(k)
+    if n == 0:
+        return count, inlier_sq, total_sq
+    rows = min(n, chunk_size)
+    poses = max(1, chunk_size // rows)
+    threshold2 = max_distance * max_distance
+    bound = max(max_distance, truncation)
+    for k0 in range(0, k, poses):
+        T = transforms[k0:k0 + poses]
+        for i0 in range(0, n, rows):
+            moved = transform_points(points[i0:i0 + rows], T)
+            d = tree.query(moved.reshape(-1, 3), workers=workers, distance_upper_bound=bound)[0]
+            d2 = d.reshape(moved.shape[:2]) ** 2
+            # Inliers from the exact distances, only the total is clamped
+            inliers = d2 < threshold2
+            count[k0:k0 + len(T)] += inliers.sum(axis=1)
+            inlier_sq[k0:k0 + len(T)] += np.where(inliers, d2, 0.0).sum(axis=1)
+            total_sq[k0:k0 + len(T)] += np.minimum(d2, truncation * truncation).sum(axis=1)
+    return count, inlier_sq, total_sq
+
+
+class PoseEvaluator:
+    """
+    Scores poses of source clouds against one target cloud whose KD-tree
+    is built once. evaluate() gives, per pose, the fitness (fraction of
+    source points within max_distance of the target) and the inlier RMSE,
+    as evaluate_registration, and with chamfer=True the sum of the RMS
+    nearest-neighbor distances both ways (the target is then moved by the
+    inverse poses onto a KD-tree of the source). Exact chamfer distances of
+    poses far from the target are slow; a finite chamfer_truncation clamps
+    each distance, as in utility.chamfer_distance, and bounds the search.
+    """
+
+    def __init__(self, target_points, leafsize=16):
+        from scipy.spatial import cKDTree
+        self.points = np.ascontiguousarray(target_points, dtype=np.float64)
+        self.tree = cKDTree(self.points, leafsize=leafsize)
+
+    def __len__(self):
+        return len(self.points)
+
+    @profiled("PoseEvaluator.evaluate")
+    def evaluate(self, source_points, transforms, max_distance, chamfer=False,
+                 chamfer_truncation=np.inf, chunk_size=1 << 20,
+                 workers=-1) -> dict[str, np.ndarray]:
+        """
+        Metrics of source_points (N, 3) moved by each of transforms (K, 4, 4),
+        or by one (4, 4): a dict of fitness, inlier_rmse and, with chamfer,
+        chamfer arrays of shape (K,), or floats for a single transform.
+        """
+        source_points = np.ascontiguousarray(source_points, dtype=np.float64)
+        T = np.asarray(transforms, dtype=np.float64)
+        single = T.ndim == 2
+        T = T.reshape(-1, 4, 4)
+        count, inlier_sq, total_sq = nearest_statistics(
+            self.tree, source_points, T, max_distance,
+            chamfer_truncation if chamfer else max_distance, chunk_size, workers)
+        n = max(len(source_points), 1)
+        metrics = {
+            "fitness": count / n,
+            "inlier_rmse": np.sqrt(inlier_sq / np.maximum(count, 1)),
+        }
+        if chamfer:
+            from scipy.spatial import cKDTree
+            source_tree = cKDTree(source_points)
+            back_sq = nearest_statistics(source_tree, self.points, inverse_transforms(T), 0.0,
+                                         chamfer_truncation, chunk_size, workers)[2]
+            metrics["chamfer"] = np.sqrt(total_sq / n) + np.sqrt(back_sq / max(len(self), 1))
+        if single:
+            return {name: float(v[0]) for name, v in metrics.items()}
+        return metrics
+
+    def rank(self, source_points, transforms, max_distance, **kwargs) -> np.ndarray:
+        """Indices of transforms from best to worst by fitness, then inlier RMSE."""
+        metrics = self.evaluate(source_points, transforms, max_distance, **kwargs)
+        return np.lexsort((metrics["inlier_rmse"], -metrics["fitness"]))
+
+
+def main():
+    from open3d_utils import load_mesh_as_point_cloud, load_mesh_subset_as_point_cloud, SAMPLERS
+
+    parser = argparse.ArgumentParser(
+        description="Re-score registration results (register.py --npz) against their targets"
+    )
+    parser.add_argument("results", type=str, help="NPZ with source, target and (N, 4, 4) transformation")
+    parser.add_argument("--samples", type=int, default=10000, help="Points sampled per mesh")
+    parser.add_argument("--sampler", choices=["poisson"] + list(SAMPLERS), default="poisson")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed of the sampler (default: as register.py, 0 except for poisson)")
+    parser.add_argument("--max_distance", type=float, default=0.05,
+                        help="Inlier distance as a fraction of the target bounding box diagonal")
+    parser.add_argument("--chamfer", action="store_true", help="Also compute chamfer distances")
+    parser.add_argument("--worst", type=int, default=10, help="Print this many lowest-fitness results")
+    parser.add_argument("--output", type=str, default=None, help="Write the results with the new metrics as NPZ")
+    args = parser.parse_args()
+
+    if args.seed is None and args.sampler != "poisson":
+        args.seed = 0
+    data = dict(np.load(args.results))
+    transforms = data["transformation"].reshape(-1, 4, 4)
+    metrics = {"fitness": np.zeros(len(transforms)), "inlier_rmse": np.zeros(len(transforms))}
+    if args.chamfer:
+        metrics["chamfer"] = np.zeros(len(transforms))
+    start = time.perf_counter()
+    sources = {}
+    for target_path in np.unique(data["target"]):
+        target = load_mesh_subset_as_point_cloud(str(target_path), n_points=args.samples,
+                                                 sampler=args.sampler, seed=args.seed)
+        evaluator = PoseEvaluator(np.asarray(target.points))
+        diagonal = np.linalg.norm(target.get_max_bound() - target.get_min_bound())
+        rows = np.flatnonzero(data["target"] == target_path)
+        for source_path in np.unique(data["source"][rows]):
+            # Results of the same source against this target are scored in one call
+            same = rows[data["source"][rows] == source_path]
+            if source_path not in sources:
+                # Sources are registered whole, only targets are cropped to their selection
+                sources[source_path] = np.asarray(load_mesh_as_point_cloud(
+                    str(source_path), n_points=args.samples, sampler=args.sampler, seed=args.seed).points)
+            scored = evaluator.evaluate(sources[source_path], transforms[same],
+                                        args.max_distance * diagonal, chamfer=args.chamfer)
+            for name, values in scored.items():
+                metrics[name][same] = values
+    print("Scored %d results in %.3f s" % (len(transforms), time.perf_counter() - start))
+
+    for k in np.argsort(metrics["fitness"])[:args.worst]:
+        print("%s -> %s fitness %.4f rmse %.4g%s" % (
+            data["source"][k], data["target"][k], metrics["fitness"][k], metrics["inlier_rmse"][k],
+            " chamfer %.4g" % metrics["chamfer"][k] if args.chamfer else ""))
+    if args.output is not None:
+        np.savez(args.output, **dict(data, **metrics))
+
+
+# To run:
+# python pose_evaluation.py results.npz --chamfer --worst 20 --output rescored.npz
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Nested timing spans for profiling registration runs without attaching a
+profiler. Instrumented functions open spans on the module's profiler,
+which is off by default and costs one attribute check per span then.
+
+    import profiling
+    profiling.enable()
+    ...  # load, preprocess, register
+    profiling.PROFILER.print_summary()
+    profiling.PROFILER.export("profile.json", format="chrome")  # chrome://tracing, Perfetto
+
+Setting PC_ALIGN_PROFILE=path enables the profiler at import and exports
+at exit (Chrome trace if the path ends with .trace.json, span list
+otherwise); {pid} in the path is replaced by the process id, so worker
+processes write separate files.
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    Records spans (name, start, duration, nesting, thread, attributes).
+    Spans nest per thread: a span opened inside another one is its child.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.spans = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+    def record(self, name, start, seconds, depth=None, **attrs):
+        """Add a finished span; start is a time.perf_counter() value."""
+        if depth is None:
+            depth = len(self._stack())
+        span = {"name": name, "start": start - self._origin, "seconds": seconds, "depth": depth,
+                "pid": os.getpid(), "thread": threading.get_ident(), "attrs": attrs}
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        Time the body as a child of the enclosing span. Yields the
+        attributes dict, so results can be attached to the span.
+        """
+        if not self.enabled:
+            yield attrs
+            return
+        stack = self._stack()
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            self.record(name, start, seconds, len(stack), **attrs)
+
+    def icp_callback(self, name="icp iteration"):
+        """
+        Callback for pc_align ICPOptions.callback / icp_libigl(callback=)
+        recording each native ICP iteration, with its sampling,
+        closest-point and solve times as children, under the current span.
+        Returns None when disabled, which turns the callback off.
+        """
+        if not self.enabled:
+            return None
+
+        def callback(it):
+            end = time.perf_counter()
+            depth = len(self._stack())
+            start = end - it.seconds
+            self.record(name, start, it.seconds, depth,
+                        iteration=it.iteration, rmse=it.rmse, step=it.step)
+            for part, seconds in (("sample", it.sample_seconds),
+                                  ("closest_points", it.closest_point_seconds),
+                                  ("solve", it.solve_seconds)):
+                self.record(part, start, seconds, depth + 1)
+                start += seconds
+
+        return callback
+
+    def summary(self):
+        """{name: {"count", "seconds"}} over all spans, by total time."""
+        totals = {}
+        for span in self.spans:
+            entry = totals.setdefault(span["name"], {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += span["seconds"]
+        return dict(sorted(totals.items(), key=lambda item: -item[1]["seconds"]))
+
+    def print_summary(self):
+        print("%-36s %8s %12s" % ("span", "count", "total [s]"))
+        for name, entry in self.summary().items():
+            print("%-36s %8d %12.4f" % (name, entry["count"], entry["seconds"]))
+
+    def chrome_trace(self):
+        """Spans as Chrome trace events ("X" complete events in microseconds)."""
+        events = []
+        # Parents before children at equal timestamps
+        for span in sorted(self.spans, key=lambda s: (s["start"], s["depth"])):
+            events.append({"name": span["name"], "ph": "X", "ts": span["start"] * 1e6,
+                           "dur": span["seconds"] * 1e6, "pid": span["pid"],
+                           "tid": span["thread"], "args": span["attrs"]})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path, format="json"):
+        """Write the spans and summary ("json") or a Chrome trace ("chrome")."""
+        if format == "chrome":
+            data = self.chrome_trace()
+        elif format == "json":
+            data = {"spans": sorted(self.spans, key=lambda s: s["start"]), "summary": self.summary()}
+        else:
+            raise ValueError("Unknown profile format %s, expected 'json' or 'chrome'" % format)
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1, default=str)
+
+
+PROFILER = Profiler(enabled=False)
+
+
+def enable(enabled: bool = True) -> Profiler:
+    PROFILER.enabled = enabled
+    return PROFILER
+
+
+def span(name, **attrs):
+    """PROFILER.span(name, **attrs)."""
+    return PROFILER.span(name, **attrs)
+
+
+def profiled(name=None):
+    """Decorator opening a span named name (default: the function name) around each call."""
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            with PROFILER.span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _export_at_exit(path):
+    path = path.replace("{pid}", str(os.getpid()))
+    PROFILER.export(path, format="chrome" if path.endswith(".trace.json") else "json")
+
+
+if os.environ.get("PC_ALIGN_PROFILE"):
+    enable()
+    atexit.register(_export_at_exit, os.environ["PC_ALIGN_PROFILE"])
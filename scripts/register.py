@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import json
+import time
+from context import *
+from cache_utils import ArrayCache, ResultCache
+from registration_engine import RegistrationEngine, GLOBAL_STAGES, LOCAL_STAGES, DEFAULT_PARAMS, PARAM_TYPES
+import profiling
+
+
+def read_manifest(path):
+    """
+    (source, target) pairs from a manifest: either a JSON list of
+    {"source": ..., "target": ...} objects, or a text file with one
+    whitespace-separated "source target" pair per line (# starts a comment).
+    Relative paths are relative to the manifest's directory.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        if path.endswith(".json"):
+            pairs = [(p["source"], p["target"]) for p in json.load(f)]
+        else:
+            pairs = []
+            for line in f:
+                words = line.split("#", 1)[0].split()
+                if not words:
+                    continue
+                if len(words) != 2:
+                    raise ValueError("Expected 'source target' in %s, got: %s" % (path, line.strip()))
+                pairs.append(tuple(words))
+    return [tuple(os.path.normpath(os.path.join(base, p)) for p in pair) for pair in pairs]
+
+
+def to_json(result):
+    result = dict(result)
+    if "transformation" in result:
+        result["transformation"] = np.asarray(result["transformation"]).tolist()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Headless registration of one pair or a manifest of pairs"
+    )
+    parser.add_argument("mesh_source", type=str, nargs="?", help="Path to source mesh A")
+    parser.add_argument("mesh_target", type=str, nargs="?", help="Path to target mesh B")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="JSON or text file listing source/target pairs")
+    parser.add_argument("--global_stage", choices=list(GLOBAL_STAGES) + ["none"], default="fgr")
+    parser.add_argument("--local_stage", choices=list(LOCAL_STAGES) + ["none"], default="refine_icp")
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON")
+    parser.add_argument("--npz", type=str, default=None,
+                        help="Write stacked (N, 4, 4) transformations and metrics as NPZ")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Cache sampled clouds and features in this directory")
+    parser.add_argument("--result_cache", type=str, default=None,
+                        help="Reuse results of pairs registered before with the same meshes, "
+                             "stages and parameters, stored in this directory")
+    parser.add_argument("--result_cache_mb", type=int, default=64,
+                        help="Size bound of the result cache, least recently used results are dropped")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Write timing spans of loading, preprocessing and each stage to this file")
+    parser.add_argument("--profile_format", choices=["json", "chrome"], default="json",
+                        help="Span list with a summary, or Chrome trace events (chrome://tracing, Perfetto)")
+    parser.add_argument("--visualize", action="store_true",
+                        help="Show each result in a window (blocks until closed)")
+    parser.add_argument("--serve", action="store_true",
+                        help="Stay up and register jobs (JSON lines, see registration_server) "
+                             "from stdin, or from --socket")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="With --serve, listen on this Unix socket (see registration_client.py)")
+    parser.add_argument("--max_engines", type=int, default=4,
+                        help="With --serve, keep the targets of this many (stages, params) "
+                             "combinations, least recently used first dropped")
+    for name, default in DEFAULT_PARAMS.items():
+        if isinstance(default, bool):
+            parser.add_argument("--" + name, action=argparse.BooleanOptionalAction, default=default)
+        else:
+            parser.add_argument("--" + name, default=default,
+                                type=type(default) if default is not None else PARAM_TYPES.get(name, float))
+    args = parser.parse_args()
+
+    cache = ArrayCache(args.cache_dir) if args.cache_dir is not None else None
+    result_cache = (ResultCache(args.result_cache, args.result_cache_mb << 20)
+                    if args.result_cache is not None else None)
+    params = {name: getattr(args, name) for name in DEFAULT_PARAMS}
+    if args.serve:
+        from registration_server import RegistrationServer, warm_up
+        seconds = warm_up()
+        print("Preloaded %s" % ", ".join("%s (%.2f s)" % item for item in seconds.items()),
+              file=sys.stderr)
+        server = RegistrationServer(args.global_stage, args.local_stage, cache, result_cache,
+                                    max_engines=args.max_engines, **params)
+        if args.socket is not None:
+            try:
+                server.serve_socket(args.socket)
+            except FileExistsError as e:
+                sys.exit("register.py: %s" % e)
+        else:
+            server.serve_stdin()
+        return
+
+    if args.manifest is not None:
+        pairs = read_manifest(args.manifest)
+    elif args.mesh_source and args.mesh_target:
+        pairs = [(args.mesh_source, args.mesh_target)]
+    else:
+        parser.error("give mesh_source and mesh_target, or --manifest")
+    if args.profile is not None:
+        profiling.enable()
+
+    engine = RegistrationEngine(
+        global_stage=None if args.global_stage == "none" else args.global_stage,
+        local_stage=None if args.local_stage == "none" else args.local_stage,
+        cache=cache, result_cache=result_cache, **params)
+
+    results = []
+    start = time.perf_counter()
+    for k, (source, target) in enumerate(pairs):
+        try:
+            result = engine.register(source, target)
+        except Exception as e:
+            result = {"source": source, "target": target, "error": repr(e)}
+            print("[%d/%d] %s -> %s failed: %r" % (k + 1, len(pairs), source, target, e))
+        else:
+            print("[%d/%d] %s -> %s fitness %.4f rmse %.4g chamfer %.4g %.3f s%s" % (
+                k + 1, len(pairs), source, target, result["fitness"], result["inlier_rmse"],
+                result["chamfer"], result["seconds"], " (cached)" if result["cached"] else ""))
+            if args.visualize:
+                from open3d_icp import draw_registration_result
+                draw_registration_result(engine.mesh(source, subset=False).pcd, engine.mesh(target).pcd,
+                                         result["transformation"])
+        results.append(result)
+    print("Registered %d pairs in %.3f s" % (len(pairs), time.perf_counter() - start))
+
+    if len(pairs) == 1 and "transformation" in results[0]:
+        np.set_printoptions(precision=6, suppress=True)
+        print(np.asarray(results[0]["transformation"]))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([to_json(r) for r in results], f, indent=1)
+    if args.npz is not None:
+        ok = [r for r in results if "transformation" in r]
+        np.savez(args.npz,
+                 source=np.array([r["source"] for r in ok]),
+                 target=np.array([r["target"] for r in ok]),
+                 transformation=np.array([r["transformation"] for r in ok]).reshape(-1, 4, 4),
+                 fitness=np.array([r["fitness"] for r in ok]),
+                 inlier_rmse=np.array([r["inlier_rmse"] for r in ok]),
+                 chamfer=np.array([r["chamfer"] for r in ok]))
+    if args.profile is not None:
+        profiling.PROFILER.print_summary()
+        profiling.PROFILER.export(args.profile, args.profile_format)
+
+
+# To run:
+# python register.py ../data/mask.obj ../data/max_planck_face2.ply --output result.json
+# python register.py --manifest pairs.txt --global_stage ransac --local_stage libigl_icp --npz results.npz
+# python register.py ../data/mask.obj ../data/max_planck_face2.ply --profile trace.json --profile_format chrome
+# python register.py --serve --socket /tmp/pc_align.sock  (then registration_client.py /tmp/pc_align.sock ...)
+if __name__ == "__main__":
+    main()
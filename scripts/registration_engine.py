@@ -0,0 +1,418 @@
+from __future__ import annotations
+import time
+from context import *
+o3d = LazyModule("open3d")
+from cache_utils import ArrayCache, ResultCache
+from open3d_utils import (load_mesh_arrays, load_mesh_as_point_cloud, load_mesh_subset_as_point_cloud,
+                          preprocess_point_cloud,
+                          transform_from_rt, rt_from_transform, point_cloud_to_arrays,
+                          point_cloud_from_arrays)
+from open3d_registration_fgr import execute_fast_global_registration
+from open3d_registration_ransac import execute_ransac_registration, adaptive_ransac_registration
+from libigl_rigid_algnment import rigid_align_arrays
+from open3d_icp import global_local_registration
+from feature_matching import FeatureIndex
+from pose_evaluation import PoseEvaluator
+from tiled_target import TiledTarget, is_tiled_target, tiled_icp
+from profiling import PROFILER, span
+
+
+class MeshData:
+    """
+    A mesh and everything derived from it, computed on first use and kept:
+    vertex/face arrays, the sampled point cloud, downsampled clouds with
+    normals and FPFH features per voxel size, and the libigl ICP target.
+    One instance is shared by every pair and stage that uses the mesh.
+    A path to a tiled target (tiled_target.py) is opened as a TiledTarget;
+    its sampled cloud is then the overview, and there are no mesh arrays.
+    With subset, a PLY file is reduced to its selected part, as targets
+    are; sources use the whole mesh (subset=False).
+    """
+
+    def __init__(self, path, n_points=10000, cache: ArrayCache | None = None,
+                 sampler="poisson", seed=None, subset=True):
+        self.path = path
+        self.subset = subset
+        self.n_points = n_points
+        self.cache = cache
+        self.sampler = sampler
+        self.seed = seed
+        self._arrays = None
+        self._pcd = None
+        self._features = {}
+        self._feature_indices = {}
+        self._evaluator = None
+        self._icp_target = None
+        self._tiled = None
+
+    @property
+    def tiled(self) -> TiledTarget | None:
+        """The TiledTarget at path, None for a mesh file."""
+        if self._tiled is None and is_tiled_target(self.path):
+            self._tiled = TiledTarget(self.path)
+        return self._tiled
+
+    @property
+    def arrays(self):
+        """(V, F), with subset for PLY files only the selected part."""
+        if self._arrays is None:
+            if self.tiled is not None:
+                raise ValueError("%s is a tiled target without whole-mesh arrays, "
+                                 "register against it with the tiled_icp local stage" % self.path)
+            self._arrays = load_mesh_arrays(self.path, self.subset)
+        return self._arrays
+
+    @property
+    def pcd(self) -> o3d.geometry.PointCloud:
+        if self._pcd is None and self.tiled is not None:
+            self._pcd = self.tiled.overview_cloud()
+        if self._pcd is None:
+            load = load_mesh_subset_as_point_cloud if self.subset else load_mesh_as_point_cloud
+            self._pcd = load(self.path, n_points=self.n_points, cache=self.cache,
+                             sampler=self.sampler, seed=self.seed)
+        return self._pcd
+
+    @property
+    def diagonal(self) -> float:
+        return float(np.linalg.norm(self.pcd.get_max_bound() - self.pcd.get_min_bound()))
+
+    def features(self, voxel_size):
+        """(downsampled cloud with normals, FPFH features) for voxel_size."""
+        if voxel_size not in self._features:
+            self._features[voxel_size] = preprocess_point_cloud(self.pcd, voxel_size, cache=self.cache)
+        return self._features[voxel_size]
+
+    @property
+    def evaluator(self) -> PoseEvaluator:
+        """PoseEvaluator (KD-tree) of the sampled cloud, to score poses against this mesh."""
+        if self._evaluator is None:
+            self._evaluator = PoseEvaluator(np.asarray(self.pcd.points))
+        return self._evaluator
+
+    def feature_index(self, voxel_size) -> FeatureIndex:
+        """Nearest-neighbor index of the FPFH features for voxel_size (for sources: of the mutual filter)."""
+        if voxel_size not in self._feature_indices:
+            self._feature_indices[voxel_size] = FeatureIndex(self.features(voxel_size)[1])
+        return self._feature_indices[voxel_size]
+
+    def export_arrays(self, voxel_size=None) -> dict[str, np.ndarray]:
+        """
+        The mesh arrays, sampled cloud and (with voxel_size) downsampled
+        cloud and FPFH features as plain arrays, see from_arrays.
+        """
+        # Workers map a tiled target's files themselves
+        arrays = {} if self.tiled is not None else dict(zip(("V", "F"), self.arrays))
+        arrays.update({"pcd_" + k: a for k, a in point_cloud_to_arrays(self.pcd).items()})
+        if voxel_size is not None:
+            down, fpfh = self.features(voxel_size)
+            arrays.update({"down_" + k: a for k, a in point_cloud_to_arrays(down).items()})
+            arrays["fpfh"] = np.asarray(fpfh.data)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, path, arrays, n_points=10000, voxel_size=None, subset=True):
+        """MeshData with everything export_arrays produced already filled in."""
+        mesh = cls(path, n_points, subset=subset)
+        if "V" in arrays:
+            mesh._arrays = (arrays["V"], arrays["F"])
+        mesh._pcd = point_cloud_from_arrays(
+            {k[4:]: a for k, a in arrays.items() if k.startswith("pcd_")})
+        if voxel_size is not None and "fpfh" in arrays:
+            fpfh = o3d.pipelines.registration.Feature()
+            fpfh.data = np.array(arrays["fpfh"])
+            down = point_cloud_from_arrays(
+                {k[5:]: a for k, a in arrays.items() if k.startswith("down_")})
+            mesh._features[voxel_size] = (down, fpfh)
+        return mesh
+
+    @property
+    def icp_target(self):
+        """pc_align.ICPTarget with the AABB tree of this mesh."""
+        if self._icp_target is None:
+            V, F = self.arrays
+            with span("build_icp_target"):
+                self._icp_target = pc_align.ICPTarget(V, F)
+        return self._icp_target
+
+
+# Stages take (engine, source MeshData, target MeshData, initial 4x4 transform)
+# and return (4x4 transform, info dict). Transforms map source to target,
+# column-vector convention as in Open3D.
+
+def fgr_stage(engine, source, target, init):
+    voxel_size = engine.voxel_size(target)
+    src_down, src_fpfh = source.features(voxel_size)
+    dst_down, dst_fpfh = target.features(voxel_size)
+    result = execute_fast_global_registration(
+        src_down, dst_down, src_fpfh, dst_fpfh,
+        engine.params["distance_multiplier"] * voxel_size,
+        engine.params["fgr_iterations"], engine.params["fgr_max_tuples"])
+    return result.transformation, {"fitness": result.fitness, "inlier_rmse": result.inlier_rmse}
+
+
+def ransac_stage(engine, source, target, init):
+    voxel_size = engine.voxel_size(target)
+    src_down, src_fpfh = source.features(voxel_size)
+    dst_down, dst_fpfh = target.features(voxel_size)
+    distance_threshold = engine.params["distance_multiplier"] * voxel_size
+    # Built once per target and voxel size, reused by every source
+    index = target.feature_index(voxel_size) if engine.params["feature_index"] else None
+    # The reverse index of the mutual filter, kept as long as the source is
+    src_index = (source.feature_index(voxel_size)
+                 if index is not None and engine.params["mutual_filter"] else None)
+    if engine.params["ransac_method"] == "adaptive":
+        result, info = adaptive_ransac_registration(
+            src_down, dst_down, src_fpfh, dst_fpfh, distance_threshold,
+            mutual_filter=engine.params["mutual_filter"],
+            ratio=0.9 if engine.params["ransac_ratio"] is None else engine.params["ransac_ratio"],
+            max_iterations=engine.params["ransac_iterations"],
+            confidence=engine.params["ransac_confidence"],
+            time_budget=engine.params["ransac_time_budget"], index=index, src_index=src_index)
+        # The stage's seconds also count computing features on first use
+        info["ransac_seconds"] = info.pop("seconds")
+    else:
+        result = execute_ransac_registration(
+            src_down, dst_down, src_fpfh, dst_fpfh, distance_threshold,
+            method=engine.params["ransac_method"],
+            mutual_filter=engine.params["mutual_filter"],
+            max_iterations=engine.params["ransac_iterations"],
+            confidence=engine.params["ransac_confidence"], index=index,
+            ratio=engine.params["ransac_ratio"], src_index=src_index)
+        info = {}
+    info.update(fitness=result.fitness, inlier_rmse=result.inlier_rmse)
+    return result.transformation, info
+
+
+def open3d_icp_stage(engine, source, target, init):
+    result = o3d.pipelines.registration.registration_icp(
+        source.pcd, target.pcd, engine.icp_distance(target), init,
+        o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+        o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=engine.params["icp_iterations"]))
+    return result.transformation, {"fitness": result.fitness, "inlier_rmse": result.inlier_rmse}
+
+
+def refine_icp_stage(engine, source, target, init):
+    # Same downsampled clouds and normals as the global stage, threshold ~ voxel size
+    voxel_size = engine.voxel_size(target)
+    src_down, _ = source.features(voxel_size)
+    dst_down, _ = target.features(voxel_size)
+    result, num_starts = global_local_registration(
+        src_down, dst_down, init, engine.params["distance_multiplier"] * voxel_size,
+        engine.params["icp_iterations"], engine.params["min_fitness"])
+    return result.transformation, {"fitness": result.fitness, "inlier_rmse": result.inlier_rmse,
+                                   "multistart": num_starts}
+
+
+def libigl_icp_stage(engine, source, target, init):
+    VA, FA = source.arrays
+    options = pc_align.ICPOptions()
+    options.num_samples = engine.params["icp_samples"]
+    options.max_iters = engine.params["icp_iterations"]
+    options.R0, options.t0 = rt_from_transform(init)
+    options.metric = getattr(pc_align.ICPMetric, engine.params["icp_metric"])
+    options.kernel = getattr(pc_align.ICPKernel, engine.params["icp_kernel"])
+    options.trim_fraction = engine.params["icp_trim_fraction"]
+    options.fixed_samples = engine.params["icp_fixed_samples"]
+    # One child span per native iteration while profiling
+    options.callback = PROFILER.icp_callback()
+    icp_target = target.icp_target
+    with span("icp_libigl", samples=options.num_samples) as attrs:
+        result = icp_target.icp(VA, FA, options)
+        attrs["iterations"] = result.iterations
+    return result.transform, {
+        "iterations": result.iterations, "converged": result.converged,
+        "rmse": result.rmse[-1] if result.rmse else None}
+
+
+def numpy_icp_stage(engine, source, target, init):
+    VA, _ = source.arrays
+    VB, FB = target.arrays
+    R0, t0 = rt_from_transform(init)
+    R, t, history = rigid_align_arrays(
+        VA @ R0 + t0, VB, FB.astype(np.int64), engine.params["icp_iterations"], return_history=True)
+    return transform_from_rt(R0 @ R, t0 @ R + t), {
+        "iterations": len(history["rmse"]), "rmse": history["rmse"][-1]}
+
+
+def tiled_icp_stage(engine, source, target, init):
+    """Point-to-plane ICP against a tiled target, paging in the tiles around the source."""
+    if target.tiled is None:
+        raise ValueError("tiled_icp needs a tiled target (tiled_target.py), got %s" % target.path)
+    info = tiled_icp(target.tiled, np.asarray(source.pcd.points), init, engine.icp_distance(target),
+                     engine.params["icp_samples"], engine.params["icp_iterations"])
+    return info.pop("transformation"), info
+
+
+GLOBAL_STAGES = {"fgr": fgr_stage, "ransac": ransac_stage}
+LOCAL_STAGES = {"refine_icp": refine_icp_stage, "open3d_icp": open3d_icp_stage,
+                "libigl_icp": libigl_icp_stage, "numpy_icp": numpy_icp_stage,
+                "tiled_icp": tiled_icp_stage}
+
+# Command line types of the parameters whose default is None (float otherwise)
+PARAM_TYPES = {"sample_seed": int}
+
+DEFAULT_PARAMS = {
+    "samples": 10000,
+    # Surface sampler, "poisson" or one of open3d_utils.SAMPLERS, and its
+    # seed; None = 0 for SAMPLERS, and for "poisson" unseeded, leaving
+    # Open3D's global random generator alone (see open3d_utils.sample_mesh)
+    "sampler": "poisson",
+    "sample_seed": None,
+    # Voxel size for FGR/RANSAC; None = voxel_fraction * target bounding box diagonal
+    "voxel_size": None,
+    "voxel_fraction": 0.01,
+    "distance_multiplier": 1.5,
+    "fgr_iterations": 64,
+    "fgr_max_tuples": 1000,
+    # "adaptive", or Open3D's "from_features" / "from_correspondences".
+    # The engine defaults to adaptive RANSAC on mutually filtered matches;
+    # open3d_registration_ransac.py keeps Open3D's from_correspondences on
+    # all matches unless given --method adaptive --mutual_filter
+    "ransac_method": "adaptive",
+    "ransac_iterations": 100000,
+    "ransac_confidence": 0.999,
+    # Seconds for drawing adaptive RANSAC hypotheses; None = no bound
+    "ransac_time_budget": None,
+    # Ratio test of the feature matches; None = 0.9 for adaptive, off for
+    # from_correspondences, as open3d_registration_ransac.py --ratio
+    "ransac_ratio": None,
+    # Keep only matches that are each other's nearest neighbor
+    "mutual_filter": True,
+    # Match features with the approximate feature_matching.FeatureIndex
+    # of the target, built once per target, instead of brute force (adaptive
+    # and from_correspondences RANSAC)
+    "feature_index": False,
+    # ICP correspondence distance; None = icp_fraction * diagonal after a
+    # global stage, the whole diagonal without one
+    "icp_distance": None,
+    "icp_fraction": 0.05,
+    "icp_iterations": 30,
+    "icp_samples": 2000,
+    # libigl_icp: "point_to_plane" / "point_to_point", robust kernel
+    # "none" / "huber" / "tukey", fraction of pairs kept by trimming and
+    # whether the source is sampled once instead of every iteration
+    "icp_metric": "point_to_plane",
+    "icp_kernel": "none",
+    "icp_trim_fraction": 1.0,
+    "icp_fixed_samples": False,
+    # refine_icp falls back to multi-start below this fitness
+    "min_fitness": 0.3,
+}
+
+
+class RegistrationEngine:
+    """
+    Runs an optional global stage (FGR/RANSAC) followed by an optional local
+    stage (ICP seeded by the global result) on pairs of meshes. Meshes are loaded
+    and preprocessed once per path and shared between pairs and stages,
+    so registering many sources against one target prepares the target once.
+    Stages are looked up by name in GLOBAL_STAGES / LOCAL_STAGES, which can
+    be extended with functions of the same signature. With a result_cache,
+    a pair already registered with the same stages and params is not
+    loaded or registered again.
+    """
+
+    def __init__(self, global_stage: str | None = "fgr", local_stage: str | None = "refine_icp",
+                 cache: ArrayCache | None = None, result_cache: ResultCache | None = None,
+                 **params):
+        for name, stages in ((global_stage, GLOBAL_STAGES), (local_stage, LOCAL_STAGES)):
+            if name is not None and name not in stages:
+                raise ValueError("Unknown stage %s, expected one of %s" % (name, list(stages)))
+        unknown = set(params) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise ValueError("Unknown parameters %s" % sorted(unknown))
+        self.global_stage = global_stage
+        self.local_stage = local_stage
+        self.cache = cache
+        self.result_cache = result_cache
+        self.params = dict(DEFAULT_PARAMS, **params)
+        self.meshes = {}
+
+    def mesh(self, path, subset=True) -> MeshData:
+        """The MeshData of path as a target, or with subset=False as a source."""
+        key = (os.path.abspath(path), subset)
+        if key not in self.meshes:
+            sampler, seed = self.params["sampler"], self.params["sample_seed"]
+            if seed is None and sampler != "poisson":
+                seed = 0
+            self.meshes[key] = MeshData(path, self.params["samples"], self.cache, sampler, seed, subset)
+        return self.meshes[key]
+
+    def add_mesh(self, mesh: MeshData) -> None:
+        """Use an already prepared MeshData for its path and role."""
+        self.meshes[(os.path.abspath(mesh.path), mesh.subset)] = mesh
+
+    def drop_source(self, path) -> None:
+        """Forget the source MeshData of path, e.g. once its only pair is registered."""
+        self.meshes.pop((os.path.abspath(path), False), None)
+
+    def voxel_size(self, target: MeshData) -> float:
+        if self.params["voxel_size"] is not None:
+            return self.params["voxel_size"]
+        return self.params["voxel_fraction"] * target.diagonal
+
+    def icp_distance(self, target: MeshData) -> float:
+        if self.params["icp_distance"] is not None:
+            return self.params["icp_distance"]
+        if self.global_stage is None:
+            return target.diagonal
+        return self.params["icp_fraction"] * target.diagonal
+
+    def register(self, source_path, target_path, init=None) -> dict:
+        """
+        Register one pair. Returns a dict with the final 4x4 transformation,
+        its fitness / inlier RMSE / chamfer distance on the sampled clouds,
+        per-stage info and timings, and whether it came from the result cache.
+        """
+        key = None
+        if self.result_cache is not None:
+            key = self.result_cache.key(
+                source_path, target_path, (self.global_stage, self.local_stage),
+                dict(self.params, init=None if init is None else np.asarray(init, dtype=np.float64).tolist()))
+            cached = self.result_cache.get_result(key)
+            if cached is not None:
+                return dict(cached, source=source_path, target=target_path, cached=True)
+        source = self.mesh(source_path, subset=False)
+        target = self.mesh(target_path)
+        T = np.eye(4) if init is None else np.asarray(init, dtype=np.float64)
+        result = {"source": source_path, "target": target_path, "stages": []}
+        with span("register", source=source_path, target=target_path):
+            start = time.perf_counter()
+            stages = [(self.global_stage, GLOBAL_STAGES), (self.local_stage, LOCAL_STAGES)]
+            for name, registry in stages:
+                if name is None:
+                    continue
+                stage_start = time.perf_counter()
+                with span(name + "_stage"):
+                    T, info = registry[name](self, source, target, T)
+                T = np.asarray(T)
+                info.update(stage=name, seconds=time.perf_counter() - stage_start)
+                result["stages"].append(info)
+
+            with span("evaluate_registration"):
+                evaluation = target.evaluator.evaluate(
+                    np.asarray(source.pcd.points), T, self.icp_distance(target), chamfer=True)
+        result.update(transformation=T, seconds=time.perf_counter() - start, **evaluation)
+        if key is not None:
+            self.result_cache.put_result(key, result)
+        result["cached"] = False
+        return result
+
+    def evaluate_poses(self, source_path, target_path, transforms, max_distance=None,
+                       chamfer=False) -> dict[str, np.ndarray]:
+        """
+        Fitness, inlier RMSE (and chamfer) arrays of the sampled source cloud
+        under each of the (K, 4, 4) transforms against the target, e.g. to
+        rank candidate poses. max_distance defaults to the ICP distance.
+        """
+        target = self.mesh(target_path)
+        if max_distance is None:
+            max_distance = self.icp_distance(target)
+        return target.evaluator.evaluate(np.asarray(self.mesh(source_path, subset=False).pcd.points),
+                                         np.asarray(transforms).reshape(-1, 4, 4), max_distance,
+                                         chamfer=chamfer)
+
+    def register_many(self, pairs):
+        """Register (source, target) pairs in order, yielding one result per pair."""
+        for source_path, target_path in pairs:
+            yield self.register(source_path, target_path)
@@ -0,0 +1,173 @@
+"""
+Warm-process registration. A RegistrationServer imports the backends once,
+keeps the targets it has prepared, and answers jobs given as one JSON
+object per line, on stdin or on a Unix domain socket (register.py --serve).
+registration_client.py submits jobs over the socket without importing any
+of the backends.
+
+Job:   {"source": path, "target": path, "init": 4x4 (optional),
+        "global_stage": ..., "local_stage": ..., "params": {...} (optional)}
+Reply: the result as written by register.py --output, or {"error": ...}.
+{"command": "ping"} replies with the server's state, {"command": "shutdown"}
+stops it.
+"""
+import json
+import socket
+import stat
+import time
+import traceback
+from collections import OrderedDict
+from context import *
+from registration_engine import RegistrationEngine
+from register import to_json
+
+BACKENDS = ["open3d", "scipy.spatial", "pc_align_bindings"]
+
+
+def warm_up(names=BACKENDS) -> dict[str, float]:
+    """Import the modules in names now rather than on the first job; returns seconds per module."""
+    seconds = {}
+    for name in names:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print("Not preloading %s: %s" % (name, e), file=sys.stderr)
+            continue
+        seconds[name] = time.perf_counter() - start
+    return seconds
+
+
+def remove_stale_socket(path) -> None:
+    """
+    Unlink path if it is a socket no server accepts connections on, left
+    by a server that did not shut down. Raises FileExistsError if path is
+    anything else or a server is still listening on it.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError("%s exists and is not a socket" % path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+    raise FileExistsError("A server is already listening on %s" % path)
+
+
+class RegistrationServer:
+    """
+    Registers jobs with one RegistrationEngine per distinct (stages, params)
+    of the jobs, so targets stay prepared between jobs. Each engine keeps its
+    own targets, so only the max_engines most recently used engines are
+    kept. Sources are dropped after their job, as in batch_register. Jobs
+    are handled one at a time.
+    """
+
+    def __init__(self, global_stage="fgr", local_stage="refine_icp", cache=None,
+                 result_cache=None, max_engines=4, **params):
+        self.defaults = {"global_stage": global_stage, "local_stage": local_stage, "params": params}
+        self.cache = cache
+        self.result_cache = result_cache
+        self.max_engines = max_engines
+        self.engines = OrderedDict()
+        self.jobs = 0
+        self.running = True
+        self.started = time.time()
+
+    def engine(self, job) -> RegistrationEngine:
+        global_stage = job.get("global_stage", self.defaults["global_stage"])
+        local_stage = job.get("local_stage", self.defaults["local_stage"])
+        params = dict(self.defaults["params"], **job.get("params", {}))
+        key = json.dumps([global_stage, local_stage, params], sort_keys=True)
+        if key in self.engines:
+            self.engines.move_to_end(key)
+        else:
+            self.engines[key] = RegistrationEngine(
+                None if global_stage == "none" else global_stage,
+                None if local_stage == "none" else local_stage,
+                cache=self.cache, result_cache=self.result_cache, **params)
+            while len(self.engines) > self.max_engines:
+                self.engines.popitem(last=False)
+        return self.engines[key]
+
+    def handle(self, job: dict) -> dict:
+        if not isinstance(job, dict):
+            return {"error": "Invalid job: expected a JSON object, got %s" % type(job).__name__}
+        command = job.get("command", "register")
+        if command == "ping":
+            return {"ok": True, "pid": os.getpid(), "jobs": self.jobs, "engines": len(self.engines),
+                    "uptime": time.time() - self.started}
+        if command == "shutdown":
+            self.running = False
+            return {"ok": True}
+        if command != "register":
+            return {"error": "Unknown command %r" % command}
+        try:
+            engine = self.engine(job)
+            result = engine.register(job["source"], job["target"], job.get("init"))
+        except Exception:
+            result = {"source": job.get("source"), "target": job.get("target"),
+                      "error": traceback.format_exc()}
+        else:
+            engine.drop_source(job["source"])
+        self.jobs += 1
+        return to_json(result)
+
+    def serve_lines(self, lines, write) -> None:
+        """Answer each JSON line of lines with write(reply line) until shutdown or the end."""
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                reply = {"error": "Invalid job: %s" % e}
+            else:
+                reply = self.handle(job)
+            write(json.dumps(reply) + "\n")
+            if not self.running:
+                break
+
+    def serve_stdin(self) -> None:
+        # Replies go to the original stdout; anything else the pipeline
+        # prints, including native code, goes to stderr
+        sys.stdout.flush()
+        out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+        def write(reply):
+            out.write(reply)
+            out.flush()
+
+        self.serve_lines(sys.stdin, write)
+        out.close()
+
+    def serve_socket(self, path) -> None:
+        """
+        Accept connections on a Unix socket at path, each sending any number
+        of jobs. A stale socket at path is replaced (see remove_stale_socket).
+        """
+        remove_stale_socket(path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(path)
+            server.listen()
+            print("Listening on %s" % path, file=sys.stderr, flush=True)
+            try:
+                while self.running:
+                    connection, _ = server.accept()
+                    with connection, connection.makefile("rw", encoding="utf-8") as f:
+                        def write(reply):
+                            f.write(reply)
+                            f.flush()
+                        try:
+                            self.serve_lines(f, write)
+                        except OSError:
+                            # The client went away
+                            pass
+            finally:
+                os.unlink(path)
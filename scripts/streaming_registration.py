@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Register a sequence of partial scans frame by frame. Each frame starts from
+the previous pose (optionally extrapolated with a constant velocity) and is
+aligned with point-to-plane ICP against a map made of the target and the
+frames registered so far. The map's nearest-neighbor index grows with each
+frame instead of being rebuilt.
+"""
+import glob
+import json
+import time
+from context import *
+o3d = LazyModule("open3d")
+from open3d_utils import load_mesh_as_point_cloud, point_cloud_to_arrays
+
+# Voxel keys are raveled into one int64 on a grid of 2^20 voxels per axis
+# centered on the origin
+_KEY_OFFSET = 1 << 19
+_KEY_DIMS = (1 << 20,) * 3
+
+
+class IncrementalIndex:
+    """
+    Nearest-neighbor index over points with normals that new points can be
+    added to. Points are thinned to one per voxel_size voxel. Added points
+    go into a new KD-tree, and trees are merged like a binary counter
+    (a tree is merged into the previous one once it is at least half its
+    size), so there are O(log n) trees and each point is re-indexed
+    O(log n) times. Trees larger than max_tree_points are never merged,
+    which bounds the worst-case cost of one add. Occupied voxels are kept
+    as a sorted array of raveled keys, within 2^19 voxels of the origin.
+    """
+
+    def __init__(self, voxel_size, max_tree_points=1 << 20):
+        self.voxel_size = voxel_size
+        self.max_tree_points = max_tree_points
+        self.levels = []  # [(tree, points, normals)], oldest and largest first
+        self._voxels = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return sum(len(points) for _, points, _ in self.levels)
+
+    def add(self, points, normals):
+        """Add the points whose voxel is not occupied yet; returns how many were added."""
+        from scipy.spatial import cKDTree
+        keys = np.floor(points / self.voxel_size).astype(np.int64) + _KEY_OFFSET
+        # One integer per voxel, as open3d_utils._one_per_cell
+        flat, first = np.unique(np.ravel_multi_index(keys.T, _KEY_DIMS), return_index=True)
+        at = np.searchsorted(self._voxels, flat)
+        occupied = self._voxels[np.minimum(at, len(self._voxels) - 1)] == flat \
+            if len(self._voxels) else np.zeros(len(flat), dtype=bool)
+        if occupied.all():
+            return 0
+        # flat is sorted, so inserting at the search positions keeps _voxels sorted
+        self._voxels = np.insert(self._voxels, at[~occupied], flat[~occupied])
+        new = np.sort(first[~occupied])
+        points, normals = points[new], normals[new]
+
+        while self.levels and len(self.levels[-1][1]) <= 2 * len(points) \
+                and len(self.levels[-1][1]) + len(points) <= self.max_tree_points:
+            _, old_points, old_normals = self.levels.pop()
+            points = np.concatenate([old_points, points])
+            normals = np.concatenate([old_normals, normals])
+        self.levels.append((cKDTree(points), points, normals))
+        return len(new)
+
+    def query(self, P, max_distance=np.inf):
+        """
+        Nearest indexed point of each row of P within max_distance.
+        Returns (distances, points, normals); rows without a neighbor have
+        distance inf.
+        """
+        dist = np.full(len(P), np.inf)
+        nearest = np.zeros((len(P), 3))
+        nearest_normals = np.zeros((len(P), 3))
+        for tree, points, normals in self.levels:
+            d, i = tree.query(P, k=1, distance_upper_bound=max_distance)
+            closer = d < dist
+            dist[closer] = d[closer]
+            nearest[closer] = points[i[closer]]
+            nearest_normals[closer] = normals[i[closer]]
+        return dist, nearest, nearest_normals
+
+
+def point_to_plane_step(X, P, N):
+    """
+    4x4 transform (column vectors) minimizing sum(((T x - p) . n)^2) over
+    the pairs, linearized in the rotation.
+    """
+    A = np.concatenate([np.cross(X, N), N], axis=1)
+    b = np.einsum("ij,ij->i", P - X, N)
+    u = np.linalg.lstsq(A, b, rcond=None)[0]
+    omega, t = u[:3], u[3:]
+    angle = np.linalg.norm(omega)
+    T = np.eye(4)
+    if angle > 0:
+        axis = omega / angle
+        K = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+        T[:3, :3] = np.eye(3) + np.sin(angle) * K + (1 - np.cos(angle)) * K @ K
+    T[:3, 3] = t
+    return T
+
+
+def frame_arrays(frame, normal_radius):
+    """(points, normals) of an Open3D cloud or (N, 3) array, estimating normals if missing."""
+    if isinstance(frame, np.ndarray):
+        frame = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(frame))
+    if not frame.has_normals():
+        frame.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=normal_radius, max_nn=30))
+    arrays = point_cloud_to_arrays(frame)
+    return arrays["points"], arrays["normals"]
+
+
+class StreamingRegistrar:
+    """
+    Registers frames one at a time into a common (target) coordinate frame.
+    Each frame starts from the last pose, or with constant_velocity from the
+    last pose moved again by the last frame-to-frame motion, and runs at
+    most max_iterations point-to-plane ICP iterations on num_samples of its
+    points (fewer if time_budget seconds run out), so the cost per frame is
+    bounded. The map starts from the target points/normals, if given, and
+    with update_map every registered frame is added to it. A frame whose
+    ICP ends with a fitness below min_fitness is not registered: it is
+    neither added to the map nor used to predict the next pose.
+    """
+
+    def __init__(self, voxel_size, target=None, max_distance=None, num_samples=2000,
+                 max_iterations=20, rel_rmse_tol=1e-4, time_budget=None,
+                 constant_velocity=True, update_map=True, min_fitness=0.3, seed=0):
+        self.voxel_size = voxel_size
+        self.max_distance = 3.0 * voxel_size if max_distance is None else max_distance
+        self.num_samples = num_samples
+        self.max_iterations = max_iterations
+        self.rel_rmse_tol = rel_rmse_tol
+        self.time_budget = time_budget
+        self.constant_velocity = constant_velocity
+        self.update_map = update_map
+        self.min_fitness = min_fitness
+        self.rng = np.random.default_rng(seed)
+        self.index = IncrementalIndex(voxel_size)
+        if target is not None:
+            self.index.add(*frame_arrays(target, 2.0 * voxel_size))
+        self.poses = []
+
+    def predict(self):
+        """Initial pose for the next frame, from the registered frames."""
+        if not self.poses:
+            return np.eye(4)
+        if self.constant_velocity and len(self.poses) >= 2:
+            motion = np.linalg.inv(self.poses[-2]) @ self.poses[-1]
+            return self.poses[-1] @ motion
+        return self.poses[-1]
+
+    def register_frame(self, frame, init=None) -> dict:
+        """
+        Register one frame (Open3D cloud or (N, 3) points) from init, or
+        from predict(). Returns a dict with the 4x4 transformation from
+        the frame into the map, fitness and inlier RMSE of the samples,
+        iterations, seconds, whether the map was empty and whether the
+        frame was registered (see min_fitness); the first frame into an
+        empty map always is.
+        """
+        start = time.perf_counter()
+        points, normals = frame_arrays(frame, 2.0 * self.voxel_size)
+        T = self.predict() if init is None else np.asarray(init, dtype=np.float64)
+        result = {"iterations": 0, "fitness": 0.0, "inlier_rmse": 0.0, "empty_map": len(self.index) == 0}
+        failed = False
+
+        if not result["empty_map"]:
+            if len(points) > self.num_samples:
+                X0 = points[self.rng.choice(len(points), self.num_samples, replace=False)]
+            else:
+                X0 = points
+            rmse_prev = None
+            for _ in range(self.max_iterations):
+                X = X0 @ T[:3, :3].T + T[:3, 3]
+                dist, P, N = self.index.query(X, self.max_distance)
+                found = np.isfinite(dist)
+                result["iterations"] += 1
+                result["fitness"] = float(found.mean())
+                if found.sum() < 6:
+                    failed = True
+                    break
+                result["inlier_rmse"] = float(np.sqrt(np.mean(dist[found] ** 2)))
+                T = point_to_plane_step(X[found], P[found], N[found]) @ T
+                if rmse_prev is not None and abs(rmse_prev - result["inlier_rmse"]) <= \
+                        self.rel_rmse_tol * rmse_prev:
+                    break
+                rmse_prev = result["inlier_rmse"]
+                if self.time_budget is not None and time.perf_counter() - start > self.time_budget:
+                    break
+
+        result["registered"] = result["empty_map"] or (not failed and result["fitness"] >= self.min_fitness)
+        if result["registered"]:
+            if self.update_map:
+                self.index.add(points @ T[:3, :3].T + T[:3, 3], normals @ T[:3, :3].T)
+            self.poses.append(T)
+        result.update(transformation=T, seconds=time.perf_counter() - start)
+        return result
+
+    def stream(self, frames):
+        """Register frames as they come, yielding one result per frame."""
+        for frame in frames:
+            yield self.register_frame(frame)
+
+
+def read_frames(paths, n_points):
+    """Point clouds from .pcd/.xyz/.pts files, or sampled from meshes."""
+    for path in paths:
+        if os.path.splitext(path)[1] in (".pcd", ".xyz", ".xyzn", ".pts"):
+            yield o3d.io.read_point_cloud(path)
+        else:
+            yield load_mesh_as_point_cloud(path, n_points=n_points)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Register a sequence of scans frame by frame"
+    )
+    parser.add_argument("frames", type=str, nargs="+",
+                        help="Frame files in order, or one directory (sorted by name)")
+    parser.add_argument("--target", type=str, default=None,
+                        help="Mesh to start the map from (default: the first frame)")
+    parser.add_argument("--voxel_size", type=float, required=True,
+                        help="Map resolution; ICP correspondences within 3 voxels")
+    parser.add_argument("--samples", type=int, default=10000, help="Points sampled per mesh frame")
+    parser.add_argument("--icp_samples", type=int, default=2000, help="Frame points used by ICP")
+    parser.add_argument("--max_iterations", type=int, default=20)
+    parser.add_argument("--time_budget", type=float, default=None, help="Seconds per frame")
+    parser.add_argument("--no_velocity", action="store_true",
+                        help="Start each frame from the last pose, without constant-velocity prediction")
+    parser.add_argument("--min_fitness", type=float, default=0.3,
+                        help="Frames whose ICP ends below this fitness are not registered")
+    parser.add_argument("--fixed_map", action="store_true",
+                        help="Register against the target only, do not add frames to the map")
+    parser.add_argument("--output", type=str, default=None, help="Write poses as JSON")
+    args = parser.parse_args()
+
+    paths = args.frames
+    if len(paths) == 1 and os.path.isdir(paths[0]):
+        paths = sorted(glob.glob(os.path.join(paths[0], "*")))
+    target = None
+    if args.target is not None:
+        target = load_mesh_as_point_cloud(args.target, n_points=args.samples)
+
+    registrar = StreamingRegistrar(
+        args.voxel_size, target, num_samples=args.icp_samples,
+        max_iterations=args.max_iterations, time_budget=args.time_budget,
+        constant_velocity=not args.no_velocity, update_map=not args.fixed_map,
+        min_fitness=args.min_fitness)
+    results = []
+    for path, result in zip(paths, registrar.stream(read_frames(paths, args.samples))):
+        print("%s: %2d iterations, fitness %.3f, rmse %.4g, %.1f ms, map %d points%s" % (
+            os.path.basename(path), result["iterations"], result["fitness"],
+            result["inlier_rmse"], 1000 * result["seconds"], len(registrar.index),
+            "" if result["registered"] else ", not registered"))
+        results.append(dict(result, frame=path, transformation=result["transformation"].tolist()))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+# To run:
+# python streaming_registration.py ../data/frames --voxel_size 0.01 --output poses.json
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Out-of-core targets. build_tiled_target partitions a large reference mesh
+once into a grid of spatial tiles (faces by centroid) and writes, per tile,
+its vertices, faces and area-weighted surface samples with normals,
+concatenated into .npy files, plus each tile's bounding box and a small
+overview sample of the whole mesh. TiledTarget memory-maps those files and
+copies in only the tiles whose bounding boxes overlap the region asked
+for, so several processes can register against one target while the
+operating system shares and pages the mapped files.
+"""
+import json
+import shutil
+import time
+import uuid
+from context import *
+from cache_utils import file_hash
+from open3d_utils import load_mesh_arrays, sample_mesh_arrays, point_cloud_from_arrays
+from streaming_registration import point_to_plane_step
+from profiling import profiled, span
+
+META = "meta.json"
+ARRAYS = ["vertices", "faces", "points", "normals", "tile_min", "tile_max",
+          "vertex_offsets", "face_offsets", "point_offsets", "overview_points", "overview_normals"]
+
+
+def is_tiled_target(path) -> bool:
+    return os.path.isfile(os.path.join(path, META))
+
+
+@profiled()
+def build_tiled_target(mesh_path, out_dir, tile_size=None, tiles_per_axis=8, n_points=1000000,
+                       overview_points=20000, seed=0) -> str:
+    """
+    Write the tiled target of a mesh to out_dir. Tiles are cubes of
+    tile_size (default: the longest bounding box side / tiles_per_axis);
+    n_points surface samples are spread over the tiles by area. The mesh is
+    read once here; the result is written to a temporary directory and
+    renamed into place. An existing out_dir is replaced only if it is a
+    tiled target itself; it is renamed aside, the new one renamed in and
+    only then deleted, so readers never find out_dir half written or
+    deleted. Returns out_dir.
+    """
+    if os.path.lexists(out_dir) and not is_tiled_target(out_dir):
+        raise FileExistsError("%s exists and is not a tiled target, not replacing it" % out_dir)
+    V, F = load_mesh_arrays(mesh_path)
+    V = np.asarray(V, dtype=np.float64)
+    F = np.asarray(F, dtype=np.int64)
+    lo, hi = V.min(axis=0), V.max(axis=0)
+    if tile_size is None:
+        tile_size = float((hi - lo).max()) / tiles_per_axis
+    centroids = (V[F[:, 0]] + V[F[:, 1]] + V[F[:, 2]]) / 3.0
+    cells = np.floor((centroids - lo) / tile_size).astype(np.int64)
+    del centroids
+    keys = np.ravel_multi_index(cells.T, cells.max(axis=0) + 1)
+    order = np.argsort(keys, kind="stable")
+    starts = np.flatnonzero(np.r_[True, keys[order][1:] != keys[order][:-1]])
+    bounds = np.r_[starts, len(order)]
+    area2 = np.linalg.norm(np.cross(V[F[:, 1]] - V[F[:, 0]], V[F[:, 2]] - V[F[:, 0]]), axis=1)
+
+    rng = np.random.default_rng(seed)
+    tiles = {name: [] for name in ("vertices", "faces", "points", "normals", "tile_min", "tile_max")}
+    counts = {"vertex": [0], "face": [0], "point": [0]}
+    for k in range(len(starts)):
+        faces = order[bounds[k]:bounds[k + 1]]
+        used, local = np.unique(F[faces], return_inverse=True)
+        Vt, Ft = V[used], local.reshape(-1, 3).astype(np.int32)
+        tile_area = area2[faces].sum()
+        n = int(round(n_points * tile_area / area2.sum())) if tile_area > 0 else 0
+        points, normals = sample_mesh_arrays(Vt, Ft, n, rng) if n > 0 else (np.zeros((0, 3)),) * 2
+        for name, a in (("vertices", Vt), ("faces", Ft), ("points", points), ("normals", normals),
+                        ("tile_min", Vt.min(axis=0)), ("tile_max", Vt.max(axis=0))):
+            tiles[name].append(a)
+        for name, a in (("vertex", Vt), ("face", Ft), ("point", points)):
+            counts[name].append(counts[name][-1] + len(a))
+    overview = sample_mesh_arrays(V, F, overview_points, rng)
+
+    arrays = {name: (np.stack(a) if name.startswith("tile_") else np.concatenate(a))
+              for name, a in tiles.items()}
+    arrays.update({name + "_offsets": np.array(c, dtype=np.int64) for name, c in counts.items()})
+    arrays["overview_points"], arrays["overview_normals"] = overview
+    meta = {
+        "format": 1,
+        "source": os.path.abspath(mesh_path),
+        "source_hash": file_hash(mesh_path),
+        "tile_size": tile_size,
+        "origin": lo.tolist(),
+        "num_tiles": len(starts),
+        "num_vertices": len(V),
+        "num_faces": len(F),
+        "num_points": int(counts["point"][-1]),
+        "seed": seed,
+    }
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    tmp = os.path.join(parent, ".tmp-" + uuid.uuid4().hex)
+    os.makedirs(tmp)
+    for name, a in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), a)
+    with open(os.path.join(tmp, META), "w") as f:
+        json.dump(meta, f, indent=1)
+    old = None
+    if os.path.lexists(out_dir):
+        if not is_tiled_target(out_dir):
+            shutil.rmtree(tmp)
+            raise FileExistsError("%s exists and is not a tiled target, not replacing it" % out_dir)
+        old = os.path.join(parent, ".old-" + uuid.uuid4().hex)
+        os.rename(out_dir, old)
+    os.rename(tmp, out_dir)
+    if old is not None:
+        shutil.rmtree(old)
+    return out_dir
+
+
+class TiledTarget:
+    """
+    A target written by build_tiled_target, opened without reading it.
+    activate(lo, hi) makes the tiles whose bounding boxes overlap the box
+    [lo, hi] resident (copied out of the mapped files) and indexes their
+    samples in one KD-tree for query(). Tiles are only paged in when the
+    box is no longer covered; tiles outside the new box are then dropped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            self.meta = json.load(f)
+        self.arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+                       for name in ARRAYS}
+        self.tile_min = np.array(self.arrays["tile_min"])
+        self.tile_max = np.array(self.arrays["tile_max"])
+        self.active = np.zeros(0, dtype=np.int64)
+        self.resident = {}  # tile -> (points, normals)
+        self.tiles_paged = 0
+        self._tree = None
+        self._points = self._normals = np.zeros((0, 3))
+
+    def __len__(self):
+        return self.meta["num_tiles"]
+
+    @property
+    def diagonal(self) -> float:
+        return float(np.linalg.norm(self.tile_max.max(axis=0) - self.tile_min.min(axis=0)))
+
+    @property
+    def resident_points(self) -> int:
+        return len(self._points)
+
+    def overlapping(self, lo, hi) -> np.ndarray:
+        """Indices of the tiles whose bounding boxes overlap the box [lo, hi]."""
+        return np.flatnonzero(np.all(self.tile_min <= hi, axis=1) & np.all(self.tile_max >= lo, axis=1))
+
+    def _slice(self, name, offsets, k):
+        o = self.arrays[offsets]
+        return self.arrays[name][o[k]:o[k + 1]]
+
+    def activate(self, lo, hi) -> bool:
+        """Page in the tiles overlapping [lo, hi] if needed; returns whether the tile set changed."""
+        from scipy.spatial import cKDTree
+        needed = self.overlapping(lo, hi)
+        if self._tree is not None and np.isin(needed, self.active).all():
+            return False
+        with span("activate_tiles", tiles=len(needed)):
+            for k in set(self.resident) - set(needed.tolist()):
+                del self.resident[k]
+            for k in needed.tolist():
+                if k not in self.resident:
+                    self.resident[k] = (np.array(self._slice("points", "point_offsets", k)),
+                                        np.array(self._slice("normals", "point_offsets", k)))
+                    self.tiles_paged += 1
+            self.active = needed
+            if len(needed):
+                self._points = np.concatenate([self.resident[k][0] for k in needed.tolist()])
+                self._normals = np.concatenate([self.resident[k][1] for k in needed.tolist()])
+            else:
+                self._points = self._normals = np.zeros((0, 3))
+            self._tree = cKDTree(self._points) if len(self._points) else None
+        return True
+
+    def query(self, P, max_distance=np.inf):
+        """
+        Nearest resident sample of each row of P within max_distance, as
+        IncrementalIndex.query: (distances, points, normals), inf without one.
+        """
+        if self._tree is None:
+            return np.full(len(P), np.inf), np.zeros((len(P), 3)), np.zeros((len(P), 3))
+        dist, i = self._tree.query(P, k=1, distance_upper_bound=max_distance)
+        found = np.isfinite(dist)
+        points = np.zeros((len(P), 3))
+        normals = np.zeros((len(P), 3))
+        points[found] = self._points[i[found]]
+        normals[found] = self._normals[i[found]]
+        return dist, points, normals
+
+    def region_mesh(self, lo, hi):
+        """(V, F) of the tiles overlapping [lo, hi], e.g. for pc_align.ICPTarget(V, F)."""
+        V, F, offset = [], [], 0
+        for k in self.overlapping(lo, hi).tolist():
+            Vt = self._slice("vertices", "vertex_offsets", k)
+            V.append(np.array(Vt))
+            F.append(np.array(self._slice("faces", "face_offsets", k)) + offset)
+            offset += len(Vt)
+        if not V:
+            return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int32)
+        return np.concatenate(V), np.concatenate(F).astype(np.int32)
+
+    def overview_cloud(self):
+        """Open3D cloud of the overview samples with normals, for global registration."""
+        return point_cloud_from_arrays({"points": self.arrays["overview_points"],
+                                        "normals": self.arrays["overview_normals"]})
+
+
+@profiled()
+def tiled_icp(target: TiledTarget, source_points, init=None, max_distance=None, num_samples=2000,
+              max_iterations=30, rel_rmse_tol=1e-4, seed=0) -> dict:
+    """
+    Point-to-plane ICP of source_points (N, 3) against a TiledTarget. Every
+    iteration activates the tiles overlapping the moved samples' bounding
+    box grown by max_distance, so closest points are the same as against
+    the whole target while only the tiles around the current pose are in
+    memory. Returns a dict with the 4x4 transformation, fitness and inlier
+    RMSE of the samples, iterations, tiles paged in, resident tiles and
+    points, and seconds.
+    """
+    start = time.perf_counter()
+    max_distance = 0.05 * target.diagonal if max_distance is None else max_distance
+    T = np.eye(4) if init is None else np.asarray(init, dtype=np.float64)
+    X0 = np.asarray(source_points, dtype=np.float64)
+    if len(X0) > num_samples:
+        X0 = X0[np.random.default_rng(seed).choice(len(X0), num_samples, replace=False)]
+    paged = target.tiles_paged
+    result = {"iterations": 0, "fitness": 0.0, "inlier_rmse": 0.0}
+    rmse_prev = None
+    for _ in range(max_iterations):
+        X = X0 @ T[:3, :3].T + T[:3, 3]
+        target.activate(X.min(axis=0) - max_distance, X.max(axis=0) + max_distance)
+        dist, P, N = target.query(X, max_distance)
+        found = np.isfinite(dist)
+        result["iterations"] += 1
+        result["fitness"] = float(found.mean())
+        if found.sum() < 6:
+            break
+        result["inlier_rmse"] = float(np.sqrt(np.mean(dist[found] ** 2)))
+        T = point_to_plane_step(X[found], P[found], N[found]) @ T
+        if rmse_prev is not None and abs(rmse_prev - result["inlier_rmse"]) <= rel_rmse_tol * rmse_prev:
+            break
+        rmse_prev = result["inlier_rmse"]
+    result.update(transformation=T, tiles_paged=target.tiles_paged - paged, tiles=len(target.active),
+                  resident_points=target.resident_points, seconds=time.perf_counter() - start)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a tiled, memory-mapped target from a large mesh, or describe one"
+    )
+    parser.add_argument("mesh", type=str, help="Mesh to tile, or a tiled target directory to describe")
+    parser.add_argument("output", type=str, nargs="?", help="Tiled target directory to write")
+    parser.add_argument("--tile_size", type=float, default=None,
+                        help="Tile side length (default: longest bounding box side / --tiles_per_axis)")
+    parser.add_argument("--tiles_per_axis", type=int, default=8)
+    parser.add_argument("--points", type=int, default=1000000, help="Surface samples over all tiles")
+    parser.add_argument("--overview_points", type=int, default=20000,
+                        help="Samples of the whole mesh, for global registration")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.output is not None:
+        start = time.perf_counter()
+        build_tiled_target(args.mesh, args.output, args.tile_size, args.tiles_per_axis,
+                           args.points, args.overview_points, args.seed)
+        print("Built %s in %.3f s" % (args.output, time.perf_counter() - start))
+    target = TiledTarget(args.output or args.mesh)
+    print(json.dumps(target.meta, indent=1))
+    sizes = np.diff(target.arrays["point_offsets"])
+    print("points per tile: min %d, median %d, max %d" % (sizes.min(), np.median(sizes), sizes.max()))
+
+
+# To run:
+# python tiled_target.py ../data/max_planck_face2.ply /tmp/face.tiles --tiles_per_axis 8
+# python register.py ../data/mask.obj /tmp/face.tiles --local_stage tiled_icp
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,413 @@
 // icp_bindings.cpp
+#include <pybind11/functional.h>
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 
 #include <Eigen/Core>
+#include <cstdint>
+#include <string>
+#include <utility>
+#include <vector>
 
 #include "icp_libigl.h"
+#include "icp_target.h"
+#include "parallel_for.h"
 
 namespace py = pybind11;
 
-#include <pybind11/pybind11.h>
-namespace py = pybind11;
+// Stack per-source (R, t) into (N, 3, 3) and (N, 3) arrays
+static std::pair<py::array_t<double>, py::array_t<double>> stack_rt(
+    const std::vector<Eigen::Matrix3d>& Rs,
+    const std::vector<Eigen::Vector3d>& ts) {
+  const py::ssize_t n = static_cast<py::ssize_t>(Rs.size());
+  py::array_t<double> R_out({n, py::ssize_t(3), py::ssize_t(3)});
+  py::array_t<double> t_out({n, py::ssize_t(3)});
+  auto R = R_out.mutable_unchecked<3>();
+  auto t = t_out.mutable_unchecked<2>();
+  for (py::ssize_t k = 0; k < n; ++k) {
+    for (int i = 0; i < 3; ++i) {
+      for (int j = 0; j < 3; ++j) {
+        R(k, i, j) = Rs[k](i, j);
+      }
+      t(k, i) = ts[k](i);
+    }
+  }
+  return {R_out, t_out};
+}
+
+// Vertices are used in place if they are a C-contiguous (N, 3) float32 or
+// float64 array. Anything else is converted to float64 only with copy=True,
+// with a warning, so copies never happen silently.
+static py::array vertex_array(const py::array& V, const char* name,
+                              bool copy) {
+  if (V.ndim() == 2 && (V.flags() & py::array::c_style) &&
+      (py::isinstance<py::array_t<double>>(V) ||
+       py::isinstance<py::array_t<float>>(V))) {
+    return V;
+  }
+  if (!copy) {
+    throw py::type_error(std::string(name) +
+                         " must be a C-contiguous (N, 3) float32 or float64 array; "
+                         "pass copy=True to convert it");
+  }
+  if (PyErr_WarnEx(PyExc_RuntimeWarning,
+                   (std::string("Copying ") + name + " to float64").c_str(),
+                   1) != 0) {
+    throw py::error_already_set();
+  }
+  py::array converted =
+      py::array_t<double, py::array::c_style | py::array::forcecast>::ensure(
+          V);
+  if (!converted || converted.ndim() != 2) {
+    throw py::type_error(std::string(name) + " must be an (N, 3) array");
+  }
+  return converted;
+}
+
+// Faces as vertex_array, for int32 or int64 (converted to int32)
+static py::array face_array(const py::array& F, const char* name, bool copy) {
+  if (F.ndim() == 2 && (F.flags() & py::array::c_style) &&
+      (py::isinstance<py::array_t<std::int32_t>>(F) ||
+       py::isinstance<py::array_t<std::int64_t>>(F))) {
+    return F;
+  }
+  if (!copy) {
+    throw py::type_error(std::string(name) +
+                         " must be a C-contiguous (N, 3) int32 or int64 array; "
+                         "pass copy=True to convert it");
+  }
+  if (PyErr_WarnEx(PyExc_RuntimeWarning,
+                   (std::string("Copying ") + name + " to int32").c_str(),
+                   1) != 0) {
+    throw py::error_already_set();
+  }
+  py::array converted = py::array_t<std::int32_t, py::array::c_style |
+                                                      py::array::forcecast>::
+      ensure(F);
+  if (!converted || converted.ndim() != 2) {
+    throw py::type_error(std::string(name) + " must be an (N, 3) array");
+  }
+  return converted;
+}
+
+template <typename T>
+static RowMatrixXRef<T> row_matrix_view(const py::array& a) {
+  return Eigen::Map<const RowMatrixX<T>>(static_cast<const T*>(a.data()),
+                                         a.shape(0), a.shape(1));
+}
+
+// A mesh checked by vertex_array / face_array, with its dtypes looked up
+// while the GIL is held so views of it can be taken without the GIL
+namespace {
+struct MeshArrays {
+  py::array V;
+  py::array F;
+  bool f64;
+  bool i64;
+
+  MeshArrays(const py::array& V_, const py::array& F_, const char* V_name,
+             const char* F_name, bool copy)
+      : V(vertex_array(V_, V_name, copy)),
+        F(face_array(F_, F_name, copy)),
+        f64(py::isinstance<py::array_t<double>>(V)),
+        i64(py::isinstance<py::array_t<std::int64_t>>(F)) {}
+};
+}  // namespace
+
+// Call fn(V, F) with zero-copy RowMatrixXRef views of mesh, for whichever
+// dtypes it has. Only the array buffers are read, so this needs no GIL.
+template <typename Fn>
+static auto visit_mesh_views(const MeshArrays& mesh, Fn&& fn) {
+  const py::array& V = mesh.V;
+  const py::array& F = mesh.F;
+  if (mesh.f64) {
+    return mesh.i64 ? fn(row_matrix_view<double>(V),
+                         row_matrix_view<std::int64_t>(F))
+                    : fn(row_matrix_view<double>(V),
+                         row_matrix_view<std::int32_t>(F));
+  }
+  return mesh.i64
+             ? fn(row_matrix_view<float>(V), row_matrix_view<std::int64_t>(F))
+             : fn(row_matrix_view<float>(V), row_matrix_view<std::int32_t>(F));
+}
+
+// visit_mesh_views with the GIL released during fn; mesh is kept alive by
+// the caller
+template <typename Fn>
+static auto with_mesh_views(const MeshArrays& mesh, Fn&& fn) {
+  py::gil_scoped_release release;
+  return visit_mesh_views(mesh, std::forward<Fn>(fn));
+}
+
+// Meshes of a batch as MeshArrays, checked before any work starts
+static std::vector<MeshArrays> mesh_batch(const std::vector<py::array>& Vs,
+                                          const std::vector<py::array>& Fs,
+                                          const char* V_name,
+                                          const char* F_name, bool copy) {
+  if (Vs.size() != Fs.size()) {
+    throw py::value_error(std::string(V_name) + " and " + F_name +
+                          " must have the same length");
+  }
+  std::vector<MeshArrays> meshes;
+  meshes.reserve(Vs.size());
+  for (size_t i = 0; i < Vs.size(); ++i) {
+    meshes.emplace_back(Vs[i], Fs[i], V_name, F_name, copy);
+  }
+  return meshes;
+}
+
+// The fixed iteration count of igl::iterative_closest_point
+static ICPOptions fixed_iterations(int num_samples, int max_iters) {
+  ICPOptions options;
+  options.num_samples = num_samples;
+  options.max_iters = max_iters;
+  options.rel_rmse_tol = 0;
+  options.step_tol = 0;
+  return options;
+}
+
+// Build an ICPTarget from arrays of any of the accepted dtypes; the target
+// always owns a copy, so other layouts are converted without a warning
+static ICPTarget make_target(const py::array& VB, const py::array& FB) {
+  const MeshArrays mesh(VB, FB, "VB", "FB", true);
+  return with_mesh_views(mesh, [](const auto& V, const auto& F) {
+    return ICPTarget(V, F);
+  });
+}
 
 PYBIND11_MODULE(pc_align_bindings, m) {
-  m.doc() = "ICP wrapper over libigl::iterative_closest_point";
+  m.doc() =
+      "ICP of triangle meshes: the loop of libigl::iterative_closest_point "
+      "reimplemented on a reusable target (ICPTarget) with early "
+      "termination, robust kernels and trimming; icp_libigl_from_paths runs "
+      "libigl::iterative_closest_point itself";
 
-  m.def("icp_libigl", &icp_libigl, py::arg("VA"), py::arg("FA"), py::arg("VB"),
-        py::arg("FB"), py::arg("num_samples") = 2000,
-        py::arg("max_iters") = 30);
+  // Native calls release the GIL so Python threads can overlap registrations.
+  // Mesh arrays are read in place (see vertex_array / face_array). Python
+  // ICP callbacks take the GIL back for each call (pybind11/functional.h).
+  m.def(
+      "icp_libigl",
+      [](const py::array& VA, const py::array& FA, const py::array& VB,
+         const py::array& FB, int num_samples, int max_iters, bool copy,
+         const std::function<void(const ICPIteration&)>& callback) {
+        const MeshArrays source(VA, FA, "VA", "FA", copy);
+        const ICPTarget target = make_target(VB, FB);
+        ICPOptions options = fixed_iterations(num_samples, max_iters);
+        options.callback = callback;
+        const ICPResult result =
+            with_mesh_views(source, [&](const auto& V, const auto& F) {
+              return target.icp(V, F, options);
+            });
+        return std::make_pair(result.R, result.t);
+      },
+      py::arg("VA"), py::arg("FA"), py::arg("VB"), py::arg("FB"),
+      py::arg("num_samples") = 2000, py::arg("max_iters") = 30,
+      py::arg("copy") = false, py::arg("callback") = nullptr,
+      "ICP of mesh A to mesh B; returns (R, t) with VA @ R + t ~ B. "
+      "callback, if given, is called with an ICPIteration after every "
+      "iteration");
 
   m.def("icp_libigl_from_paths", &icp_libigl_from_paths, py::arg("mesh_a_path"),
         py::arg("mesh_b_path"), py::arg("num_samples") = 2000,
-        py::arg("max_iters") = 30);
+        py::arg("max_iters") = 30, py::call_guard<py::gil_scoped_release>());
+
+  py::enum_<ICPMetric>(m, "ICPMetric")
+      .value("point_to_plane", ICPMetric::PointToPlane)
+      .value("point_to_point", ICPMetric::PointToPoint);
+
+  py::enum_<ICPKernel>(m, "ICPKernel", "Robust weighting of sample pairs")
+      .value("none", ICPKernel::None)
+      .value("huber", ICPKernel::Huber)
+      .value("tukey", ICPKernel::Tukey);
+
+  py::class_<ICPIteration>(m, "ICPIteration",
+                           "Progress and timings of one ICP iteration")
+      .def_readonly("iteration", &ICPIteration::iteration)
+      .def_readonly("rmse", &ICPIteration::rmse)
+      .def_readonly("step", &ICPIteration::step)
+      .def_readonly("seconds", &ICPIteration::seconds)
+      .def_readonly("sample_seconds", &ICPIteration::sample_seconds)
+      .def_readonly("closest_point_seconds",
+                    &ICPIteration::closest_point_seconds)
+      .def_readonly("solve_seconds", &ICPIteration::solve_seconds);
+
+  py::class_<ICPOptions>(m, "ICPOptions", "Settings of the ICP loop")
+      .def(py::init<>())
+      .def_readwrite("num_samples", &ICPOptions::num_samples)
+      .def_readwrite("max_iters", &ICPOptions::max_iters)
+      .def_readwrite("rel_rmse_tol", &ICPOptions::rel_rmse_tol,
+                     "Stop once the relative RMSE change is below this")
+      .def_readwrite("step_tol", &ICPOptions::step_tol,
+                     "Stop once the RMS sample motion / target bbox "
+                     "diagonal is below this")
+      .def_readwrite("max_distance", &ICPOptions::max_distance,
+                     "Ignore sample pairs farther apart than this (0 = off)")
+      .def_readwrite("R0", &ICPOptions::R0)
+      .def_readwrite("t0", &ICPOptions::t0)
+      .def_readwrite("metric", &ICPOptions::metric)
+      .def_readwrite("kernel", &ICPOptions::kernel)
+      .def_readwrite("kernel_scale", &ICPOptions::kernel_scale,
+                     "Kernel width (0 = from the median residual)")
+      .def_readwrite("trim_fraction", &ICPOptions::trim_fraction,
+                     "Keep this fraction of pairs with the smallest "
+                     "residuals (1 = all)")
+      .def_readwrite("fixed_samples", &ICPOptions::fixed_samples,
+                     "Sample the source once instead of every iteration")
+      .def_readwrite("seed", &ICPOptions::seed,
+                     "Seed of the source sampling (0 = nondeterministic)")
+      .def_readwrite("callback", &ICPOptions::callback,
+                     "Called with an ICPIteration after every iteration "
+                     "(None = off)");
+
+  py::class_<ICPResult>(m, "ICPResult",
+                        "Transform and per-iteration history of an ICP run")
+      .def_readonly("R", &ICPResult::R)
+      .def_readonly("t", &ICPResult::t)
+      .def_readonly("rmse", &ICPResult::rmse)
+      .def_readonly("step", &ICPResult::step)
+      .def_readonly("converged", &ICPResult::converged)
+      .def_readonly("level_seconds", &ICPResult::level_seconds)
+      .def_readonly("level_iterations", &ICPResult::level_iterations)
+      .def_property_readonly("iterations", &ICPResult::iterations)
+      .def_property_readonly("transform", &ICPResult::transform,
+                             "R and t as one 4x4 matrix for column vectors "
+                             "(Open3D convention)");
+
+  m.def(
+      "icp_libigl_converge",
+      [](const py::array& VA, const py::array& FA, const py::array& VB,
+         const py::array& FB, int num_samples, int max_iters,
+         double rel_rmse_tol, double step_tol, bool copy,
+         const std::function<void(const ICPIteration&)>& callback) {
+        const MeshArrays source(VA, FA, "VA", "FA", copy);
+        const ICPTarget target = make_target(VB, FB);
+        ICPOptions options;
+        options.num_samples = num_samples;
+        options.max_iters = max_iters;
+        options.rel_rmse_tol = rel_rmse_tol;
+        options.step_tol = step_tol;
+        options.callback = callback;
+        return with_mesh_views(source, [&](const auto& V, const auto& F) {
+          return target.icp(V, F, options);
+        });
+      },
+      py::arg("VA"), py::arg("FA"), py::arg("VB"), py::arg("FB"),
+      py::arg("num_samples") = 2000, py::arg("max_iters") = 30,
+      py::arg("rel_rmse_tol") = 1e-4, py::arg("step_tol") = 1e-5,
+      py::arg("copy") = false, py::arg("callback") = nullptr,
+      "icp_libigl with early termination; returns an ICPResult");
+
+  m.def(
+      "icp_libigl_batch",
+      [](const std::vector<py::array>& VAs, const std::vector<py::array>& FAs,
+         const std::vector<py::array>& VBs, const std::vector<py::array>& FBs,
+         int num_samples, int max_iters, int num_threads, bool copy) {
+        const std::vector<MeshArrays> sources =
+            mesh_batch(VAs, FAs, "VAs", "FAs", copy);
+        const std::vector<MeshArrays> targets =
+            mesh_batch(VBs, FBs, "VBs", "FBs", true);
+        if (targets.size() != sources.size()) {
+          throw py::value_error(
+              "VAs, FAs, VBs and FBs must have the same length");
+        }
+        const ICPOptions options = fixed_iterations(num_samples, max_iters);
+        std::vector<Eigen::Matrix3d> Rs(sources.size());
+        std::vector<Eigen::Vector3d> ts(sources.size());
+        {
+          py::gil_scoped_release release;
+          parallel_for(sources.size(), num_threads, [&](size_t i) {
+            const ICPTarget target = visit_mesh_views(
+                targets[i],
+                [](const auto& V, const auto& F) { return ICPTarget(V, F); });
+            const ICPResult result = visit_mesh_views(
+                sources[i], [&](const auto& V, const auto& F) {
+                  return target.icp(V, F, options);
+                });
+            Rs[i] = result.R;
+            ts[i] = result.t;
+          });
+        }
+        return stack_rt(Rs, ts);
+      },
+      py::arg("VAs"), py::arg("FAs"), py::arg("VBs"), py::arg("FBs"),
+      py::arg("num_samples") = 2000, py::arg("max_iters") = 30,
+      py::arg("num_threads") = 0, py::arg("copy") = false,
+      "Run icp_libigl on independent pairs over num_threads native threads "
+      "(0 = all cores); returns R (N, 3, 3) and t (N, 3) in input order");
+
+  py::class_<ICPTarget>(m, "ICPTarget",
+                        "Target mesh with a persistent AABB tree, for "
+                        "aligning many sources against one target")
+      .def(py::init(&make_target), py::arg("VB"), py::arg("FB"))
+      .def_static("from_path", &ICPTarget::from_path, py::arg("mesh_b_path"))
+      .def_property_readonly("V", &ICPTarget::V)
+      .def_property_readonly("F", &ICPTarget::F)
+      .def_property_readonly("diagonal", &ICPTarget::diagonal,
+                             "Bounding box diagonal of the target")
+      .def(
+          "align",
+          [](const ICPTarget& self, const py::array& VA, const py::array& FA,
+             int num_samples, int max_iters, bool copy) {
+            const MeshArrays source(VA, FA, "VA", "FA", copy);
+            const ICPOptions options = fixed_iterations(num_samples, max_iters);
+            const ICPResult result =
+                with_mesh_views(source, [&](const auto& V, const auto& F) {
+                  return self.icp(V, F, options);
+                });
+            return std::make_pair(result.R, result.t);
+          },
+          py::arg("VA"), py::arg("FA"), py::arg("num_samples") = 2000,
+          py::arg("max_iters") = 30, py::arg("copy") = false,
+          "Align one source mesh; returns (R, t) with VA @ R + t ~ target")
+      .def(
+          "icp",
+          [](const ICPTarget& self, const py::array& VA, const py::array& FA,
+             const ICPOptions& options, bool copy) {
+            const MeshArrays source(VA, FA, "VA", "FA", copy);
+            return with_mesh_views(source, [&](const auto& V, const auto& F) {
+              return self.icp(V, F, options);
+            });
+          },
+          py::arg("VA"), py::arg("FA"), py::arg("options") = ICPOptions(),
+          py::arg("copy") = false)
+      .def(
+          "icp_pyramid",
+          [](const ICPTarget& self, const py::array& VA, const py::array& FA,
+             const std::vector<ICPOptions>& levels, bool copy) {
+            const MeshArrays source(VA, FA, "VA", "FA", copy);
+            return with_mesh_views(source, [&](const auto& V, const auto& F) {
+              return self.icp_pyramid(V, F, levels);
+            });
+          },
+          py::arg("VA"), py::arg("FA"), py::arg("levels"),
+          py::arg("copy") = false,
+          "Coarse-to-fine ICP, one ICPOptions per level")
+      .def(
+          "align_batch",
+          [](const ICPTarget& self, const std::vector<py::array>& VAs,
+             const std::vector<py::array>& FAs, int num_samples,
+             int max_iters, int num_threads, bool copy) {
+            const std::vector<MeshArrays> sources =
+                mesh_batch(VAs, FAs, "VAs", "FAs", copy);
+            const ICPOptions options = fixed_iterations(num_samples, max_iters);
+            std::vector<Eigen::Matrix3d> Rs(sources.size());
+            std::vector<Eigen::Vector3d> ts(sources.size());
+            {
+              // The tree and normals are only read, so threads can share them
+              py::gil_scoped_release release;
+              parallel_for(sources.size(), num_threads, [&](size_t i) {
+                const ICPResult result = visit_mesh_views(
+                    sources[i], [&](const auto& V, const auto& F) {
+                      return self.icp(V, F, options);
+                    });
+                Rs[i] = result.R;
+                ts[i] = result.t;
+              });
+            }
+            return stack_rt(Rs, ts);
+          },
+          py::arg("VAs"), py::arg("FAs"), py::arg("num_samples") = 2000,
+          py::arg("max_iters") = 30, py::arg("num_threads") = 0,
+          py::arg("copy") = false,
+          "Align a list of source meshes; returns R (N, 3, 3) and t (N, 3)");
 }
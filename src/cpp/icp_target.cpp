@@ -0,0 +1,395 @@
+#include "icp_target.h"
+
+#include <Eigen/Geometry>
+#include <Eigen/SVD>
+#include <algorithm>
+#include <chrono>
+#include <cmath>
+#include <random>
+
+namespace {
+
+// Median of the values (copied, since nth_element reorders)
+double median(Eigen::VectorXd values) {
+  const Eigen::Index mid = values.size() / 2;
+  std::nth_element(values.data(), values.data() + mid,
+                   values.data() + values.size());
+  return values(mid);
+}
+
+// Per-pair weights from the absolute residuals r: zero for pairs cut by
+// trim_fraction, then the Huber or Tukey IRLS weight
+Eigen::VectorXd robust_weights(const Eigen::VectorXd& r,
+                               const ICPOptions& options) {
+  Eigen::VectorXd w = Eigen::VectorXd::Ones(r.size());
+  if (options.trim_fraction < 1) {
+    const Eigen::Index keep = std::max<Eigen::Index>(
+        3, static_cast<Eigen::Index>(std::ceil(options.trim_fraction *
+                                               r.size())));
+    if (keep < r.size()) {
+      Eigen::VectorXd sorted = r;
+      std::nth_element(sorted.data(), sorted.data() + keep - 1,
+                       sorted.data() + sorted.size());
+      const double cutoff = sorted(keep - 1);
+      w = (r.array() <= cutoff).cast<double>();
+    }
+  }
+  if (options.kernel == ICPKernel::None) {
+    return w;
+  }
+
+  // Tuning constants for 95% efficiency under Gaussian noise
+  const double tuning = options.kernel == ICPKernel::Huber ? 1.345 : 4.685;
+  double c = options.kernel_scale;
+  if (c <= 0) {
+    c = tuning * 1.4826 * median(r);
+  }
+  if (c <= 0) {
+    // More than half the residuals are exactly zero: nothing to downweight
+    return w;
+  }
+  for (Eigen::Index k = 0; k < r.size(); ++k) {
+    if (options.kernel == ICPKernel::Huber) {
+      w(k) *= r(k) <= c ? 1.0 : c / r(k);
+    } else {
+      const double u = r(k) / c;
+      w(k) *= u < 1 ? (1 - u * u) * (1 - u * u) : 0.0;
+    }
+  }
+  return w;
+}
+
+// Weighted Kabsch: R, t minimizing sum_k w_k |X_k * R + t - P_k|^2 (row
+// vectors, as igl::rigid_alignment)
+void weighted_point_to_point(const Eigen::MatrixXd& X,
+                             const Eigen::MatrixXd& P,
+                             const Eigen::VectorXd& w, Eigen::Matrix3d& R,
+                             Eigen::RowVector3d& t) {
+  const double wsum = w.sum();
+  const Eigen::RowVector3d X_mean = (w.transpose() * X) / wsum;
+  const Eigen::RowVector3d P_mean = (w.transpose() * P) / wsum;
+  const Eigen::Matrix3d H = (X.rowwise() - X_mean).transpose() *
+                            w.asDiagonal() * (P.rowwise() - P_mean);
+  Eigen::JacobiSVD<Eigen::Matrix3d> svd(H,
+                                        Eigen::ComputeFullU | Eigen::ComputeFullV);
+  Eigen::Matrix3d U = svd.matrixU();
+  // Handle reflection: flip the axis of the smallest singular value
+  if ((U * svd.matrixV().transpose()).determinant() < 0) {
+    U.col(2) *= -1;
+  }
+  R = U * svd.matrixV().transpose();
+  t = P_mean - X_mean * R;
+}
+
+// Weighted point-to-plane: R, t minimizing
+// sum_k w_k ((X_k * R + t - P_k) . N_k)^2, linearized in the rotation
+void weighted_point_to_plane(const Eigen::MatrixXd& X,
+                             const Eigen::MatrixXd& P,
+                             const Eigen::MatrixXd& N,
+                             const Eigen::VectorXd& w, Eigen::Matrix3d& R,
+                             Eigen::RowVector3d& t) {
+  // Unknowns (omega, t) of x + omega x x + t, rows [x x n, n]
+  Eigen::Matrix<double, 6, 6> AtA = Eigen::Matrix<double, 6, 6>::Zero();
+  Eigen::Matrix<double, 6, 1> Atb = Eigen::Matrix<double, 6, 1>::Zero();
+  for (Eigen::Index k = 0; k < X.rows(); ++k) {
+    if (w(k) <= 0) {
+      continue;
+    }
+    const Eigen::Vector3d x = X.row(k).transpose();
+    const Eigen::Vector3d n = N.row(k).transpose();
+    Eigen::Matrix<double, 6, 1> a;
+    a << x.cross(n), n;
+    const double b = (P.row(k) - X.row(k)).dot(N.row(k));
+    AtA += w(k) * a * a.transpose();
+    Atb += w(k) * b * a;
+  }
+  const Eigen::Matrix<double, 6, 1> u = AtA.ldlt().solve(Atb);
+  const Eigen::Vector3d omega = u.head<3>();
+  const double angle = omega.norm();
+  // Column-vector rotation R_col x, so the row-vector R is its transpose
+  Eigen::Matrix3d R_col = Eigen::Matrix3d::Identity();
+  if (angle > 0) {
+    R_col = Eigen::AngleAxisd(angle, omega / angle).toRotationMatrix();
+  }
+  R = R_col.transpose();
+  t = u.tail<3>().transpose();
+}
+
+// Cumulative face areas of (V, F) normalized to end at 1, for sampling
+// faces proportionally to their area. Rigid motions keep areas, so this is
+// computed once per ICP run.
+template <typename Scalar, typename Index>
+std::vector<double> face_area_cdf(const RowMatrixXRef<Scalar>& V,
+                                  const RowMatrixXRef<Index>& F) {
+  std::vector<double> cdf(F.rows());
+  double total = 0;
+  for (Eigen::Index f = 0; f < F.rows(); ++f) {
+    const Eigen::RowVector3d a = V.row(F(f, 0)).template cast<double>();
+    const Eigen::RowVector3d b = V.row(F(f, 1)).template cast<double>();
+    const Eigen::RowVector3d c = V.row(F(f, 2)).template cast<double>();
+    total += 0.5 * (b - a).cross(c - a).norm();
+    cdf[f] = total;
+  }
+  if (total <= 0) {
+    throw std::runtime_error("Source mesh has zero area");
+  }
+  for (double& v : cdf) {
+    v /= total;
+  }
+  return cdf;
+}
+
+// n points uniformly distributed on (V, F): a face by area, then uniform
+// barycentric coordinates, as igl::random_points_on_mesh
+template <typename Scalar, typename Index>
+Eigen::MatrixXd sample_on_mesh(const RowMatrixXRef<Scalar>& V,
+                               const RowMatrixXRef<Index>& F,
+                               const std::vector<double>& cdf, int n,
+                               std::mt19937& urbg) {
+  std::uniform_real_distribution<double> uniform(0.0, 1.0);
+  Eigen::MatrixXd X(n, 3);
+  for (int k = 0; k < n; ++k) {
+    const auto it = std::upper_bound(cdf.begin(), cdf.end(), uniform(urbg));
+    const Eigen::Index f =
+        std::min<Eigen::Index>(it - cdf.begin(), F.rows() - 1);
+    double u = uniform(urbg);
+    double v = uniform(urbg);
+    if (u + v > 1) {
+      u = 1 - u;
+      v = 1 - v;
+    }
+    X.row(k) = (1 - u - v) * V.row(F(f, 0)).template cast<double>() +
+               u * V.row(F(f, 1)).template cast<double>() +
+               v * V.row(F(f, 2)).template cast<double>();
+  }
+  return X;
+}
+
+}  // namespace
+
+ICPTarget::ICPTarget(const Eigen::MatrixXd& VB, const Eigen::MatrixXi& FB)
+    : VB_(VB), FB_(FB) {
+  init();
+}
+
+template <typename Scalar, typename Index>
+ICPTarget::ICPTarget(const RowMatrixXRef<Scalar>& VB,
+                     const RowMatrixXRef<Index>& FB)
+    : VB_(VB.template cast<double>()), FB_(FB.template cast<int>()) {
+  init();
+}
+
+void ICPTarget::init() {
+  if (VB_.cols() != 3) {
+    throw std::runtime_error("Meshes must have V.cols()==3");
+  }
+  if (FB_.cols() != 3) {
+    throw std::runtime_error("Triangle meshes required (F.cols()==3)");
+  }
+  tree_.init(VB_, FB_);
+  igl::per_face_normals(VB_, FB_, NB_);
+  diag_ = (VB_.colwise().maxCoeff() - VB_.colwise().minCoeff()).norm();
+}
+
+ICPTarget ICPTarget::from_path(const std::string& path_b) {
+  Eigen::MatrixXd VB;
+  Eigen::MatrixXi FB;
+  if (!igl::read_triangle_mesh(path_b, VB, FB)) {
+    throw std::runtime_error("Failed to read mesh B: " + path_b);
+  }
+  return ICPTarget(VB, FB);
+}
+
+ICPResult ICPTarget::icp(const Eigen::MatrixXd& VA, const Eigen::MatrixXi& FA,
+                         const ICPOptions& options) const {
+  const RowMatrixX<double> VA_row = VA;
+  const RowMatrixX<int> FA_row = FA;
+  return icp<double, int>(VA_row, FA_row, options);
+}
+
+template <typename Scalar, typename Index>
+ICPResult ICPTarget::icp(const RowMatrixXRef<Scalar>& VA,
+                         const RowMatrixXRef<Index>& FA,
+                         const ICPOptions& options) const {
+  if (VA.cols() != 3) {
+    throw std::runtime_error("Meshes must have V.cols()==3");
+  }
+  if (FA.cols() != 3) {
+    throw std::runtime_error("Triangle meshes required (F.cols()==3)");
+  }
+  if (options.trim_fraction <= 0 || options.trim_fraction > 1) {
+    throw std::runtime_error("trim_fraction must be in (0, 1]");
+  }
+
+  ICPResult result;
+  Eigen::Matrix3d R = options.R0;
+  Eigen::RowVector3d t = options.t0.transpose();
+  const double scale = diag_ > 0 ? diag_ : 1.0;
+  std::mt19937 urbg(options.seed != 0 ? options.seed : std::random_device{}());
+  // igl::rigid_alignment is the unweighted point-to-plane solve of
+  // igl::iterative_closest_point, the other cases need weights
+  const bool weighted = options.metric != ICPMetric::PointToPlane ||
+                        options.kernel != ICPKernel::None ||
+                        options.trim_fraction < 1;
+
+  // Samples are drawn on VA as it is and then moved to the current pose,
+  // which has the same distribution as sampling the moved mesh
+  const std::vector<double> cdf = face_area_cdf<Scalar, Index>(VA, FA);
+  Eigen::MatrixXd X0;
+  using Clock = std::chrono::steady_clock;
+  const auto seconds_since = [](Clock::time_point start) {
+    return std::chrono::duration<double>(Clock::now() - start).count();
+  };
+  for (int iter = 0; iter < options.max_iters; ++iter) {
+    ICPIteration progress;
+    progress.iteration = iter;
+    const auto iter_start = Clock::now();
+    if (iter == 0 || !options.fixed_samples) {
+      X0 = sample_on_mesh<Scalar, Index>(VA, FA, cdf, options.num_samples,
+                                         urbg);
+    }
+    Eigen::MatrixXd X = (X0 * R).rowwise() + t;
+    progress.sample_seconds = seconds_since(iter_start);
+
+    // Closest points and their face normals on the target
+    Eigen::VectorXd sqrD;
+    Eigen::VectorXi J;
+    Eigen::MatrixXd P;
+    const auto query_start = Clock::now();
+    tree_.squared_distance(VB_, FB_, X, sqrD, J, P);
+    progress.closest_point_seconds = seconds_since(query_start);
+
+    // Drop pairs beyond max_distance
+    if (options.max_distance > 0) {
+      const double max_sqr = options.max_distance * options.max_distance;
+      Eigen::Index kept = 0;
+      for (Eigen::Index k = 0; k < sqrD.size(); ++k) {
+        if (sqrD(k) <= max_sqr) {
+          X.row(kept) = X.row(k);
+          P.row(kept) = P.row(k);
+          J(kept) = J(k);
+          sqrD(kept) = sqrD(k);
+          ++kept;
+        }
+      }
+      if (kept < 3) {
+        break;
+      }
+      X.conservativeResize(kept, Eigen::NoChange);
+      P.conservativeResize(kept, Eigen::NoChange);
+      J.conservativeResize(kept);
+      sqrD.conservativeResize(kept);
+    }
+
+    Eigen::MatrixXd N(J.size(), 3);
+    for (Eigen::Index k = 0; k < J.size(); ++k) {
+      N.row(k) = NB_.row(J(k));
+    }
+
+    Eigen::Matrix3d Rup;
+    Eigen::RowVector3d tup;
+    const auto solve_start = Clock::now();
+    if (!weighted) {
+      igl::rigid_alignment(X, P, N, Rup, tup);
+    } else {
+      const Eigen::VectorXd residuals =
+          options.metric == ICPMetric::PointToPlane
+              ? ((X - P).cwiseProduct(N)).rowwise().sum().cwiseAbs().eval()
+              : sqrD.cwiseSqrt().eval();
+      const Eigen::VectorXd w = robust_weights(residuals, options);
+      if ((w.array() > 0).count() < 3) {
+        break;
+      }
+      if (options.metric == ICPMetric::PointToPlane) {
+        weighted_point_to_plane(X, P, N, w, Rup, tup);
+      } else {
+        weighted_point_to_point(X, P, w, Rup, tup);
+      }
+    }
+    R = (R * Rup).eval();
+    t = (t * Rup + tup).eval();
+    progress.solve_seconds = seconds_since(solve_start);
+
+    const double rmse = std::sqrt(sqrD.mean());
+    const Eigen::MatrixXd motion = ((X * Rup).rowwise() + tup) - X;
+    const double step =
+        std::sqrt(motion.rowwise().squaredNorm().mean()) / scale;
+    const double rmse_prev =
+        result.rmse.empty() ? -1.0 : result.rmse.back();
+    result.rmse.push_back(rmse);
+    result.step.push_back(step);
+    if (options.callback) {
+      progress.rmse = rmse;
+      progress.step = step;
+      progress.seconds = seconds_since(iter_start);
+      options.callback(progress);
+    }
+
+    if (step < options.step_tol ||
+        (rmse_prev > 0 &&
+         std::abs(rmse_prev - rmse) / rmse_prev < options.rel_rmse_tol)) {
+      result.converged = true;
+      break;
+    }
+  }
+  result.R = R;
+  result.t = t.transpose();
+  return result;
+}
+
+ICPResult ICPTarget::icp_pyramid(const Eigen::MatrixXd& VA,
+                                 const Eigen::MatrixXi& FA,
+                                 const std::vector<ICPOptions>& levels) const {
+  const RowMatrixX<double> VA_row = VA;
+  const RowMatrixX<int> FA_row = FA;
+  return icp_pyramid<double, int>(VA_row, FA_row, levels);
+}
+
+template <typename Scalar, typename Index>
+ICPResult ICPTarget::icp_pyramid(const RowMatrixXRef<Scalar>& VA,
+                                 const RowMatrixXRef<Index>& FA,
+                                 const std::vector<ICPOptions>& levels) const {
+  ICPResult result;
+  if (!levels.empty()) {
+    result.R = levels.front().R0;
+    result.t = levels.front().t0;
+  }
+  for (const ICPOptions& level : levels) {
+    ICPOptions options = level;
+    options.R0 = result.R;
+    options.t0 = result.t;
+
+    const auto start = std::chrono::steady_clock::now();
+    ICPResult level_result = icp<Scalar, Index>(VA, FA, options);
+    const std::chrono::duration<double> elapsed =
+        std::chrono::steady_clock::now() - start;
+
+    result.R = level_result.R;
+    result.t = level_result.t;
+    result.converged = level_result.converged;
+    result.rmse.insert(result.rmse.end(), level_result.rmse.begin(),
+                       level_result.rmse.end());
+    result.step.insert(result.step.end(), level_result.step.begin(),
+                       level_result.step.end());
+    result.level_seconds.push_back(elapsed.count());
+    result.level_iterations.push_back(level_result.iterations());
+  }
+  return result;
+}
+
+// float32/float64 vertices and int32/int64 faces, as accepted from NumPy
+#define INSTANTIATE_ICP_TARGET(Scalar, Index)                               \
+  template ICPTarget::ICPTarget(const RowMatrixXRef<Scalar>&,               \
+                                const RowMatrixXRef<Index>&);               \
+  template ICPResult ICPTarget::icp<Scalar, Index>(                         \
+      const RowMatrixXRef<Scalar>&, const RowMatrixXRef<Index>&,            \
+      const ICPOptions&) const;                                             \
+  template ICPResult ICPTarget::icp_pyramid<Scalar, Index>(                 \
+      const RowMatrixXRef<Scalar>&, const RowMatrixXRef<Index>&,            \
+      const std::vector<ICPOptions>&) const;
+
+INSTANTIATE_ICP_TARGET(float, std::int32_t)
+INSTANTIATE_ICP_TARGET(float, std::int64_t)
+INSTANTIATE_ICP_TARGET(double, std::int32_t)
+INSTANTIATE_ICP_TARGET(double, std::int64_t)
+#undef INSTANTIATE_ICP_TARGET
@@ -0,0 +1,151 @@
+#pragma once
+
+#include <igl/AABB.h>
+#include <igl/per_face_normals.h>
+#include <igl/random_points_on_mesh.h>
+#include <igl/read_triangle_mesh.h>
+#include <igl/rigid_alignment.h>
+
+#include <Eigen/Core>
+#include <cstdint>
+#include <functional>
+#include <stdexcept>
+#include <string>
+#include <utility>
+#include <vector>
+
+// Row-major dense matrix, the layout of C-contiguous NumPy arrays, and a
+// read-only reference to one that binds to mapped NumPy memory without a copy
+template <typename T>
+using RowMatrixX =
+    Eigen::Matrix<T, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>;
+template <typename T>
+using RowMatrixXRef = Eigen::Ref<const RowMatrixX<T>>;
+
+// Error minimized per sample pair: distance to the tangent plane of the
+// closest point, or to the closest point itself
+enum class ICPMetric { PointToPlane, PointToPoint };
+
+// Robust weighting of the sample pairs by their residual (IRLS)
+enum class ICPKernel { None, Huber, Tukey };
+
+// Progress of one ICP iteration, as passed to ICPOptions::callback
+struct ICPIteration {
+  int iteration = 0;
+  // RMS closest-point distance before the update and relative sample
+  // motion of the update, as appended to ICPResult::rmse / step
+  double rmse = 0.0;
+  double step = 0.0;
+  // Wall time of the iteration and of its parts: sampling the source,
+  // closest points on the target and the rigid solve
+  double seconds = 0.0;
+  double sample_seconds = 0.0;
+  double closest_point_seconds = 0.0;
+  double solve_seconds = 0.0;
+};
+
+// Settings of the ICP loop run by ICPTarget::icp
+struct ICPOptions {
+  // Points sampled on the source mesh per iteration
+  int num_samples = 2000;
+  int max_iters = 30;
+  // Stop once |rmse_prev - rmse| / rmse_prev falls below this (0 = off)
+  double rel_rmse_tol = 1e-4;
+  // Stop once the RMS motion of the samples in one iteration, relative to
+  // the target's bounding box diagonal, falls below this (0 = off)
+  double step_tol = 1e-5;
+  // Ignore sample pairs farther apart than this (0 = keep all)
+  double max_distance = 0.0;
+  // Initial transform: the loop starts from VA * R0 + t0^T
+  Eigen::Matrix3d R0 = Eigen::Matrix3d::Identity();
+  Eigen::Vector3d t0 = Eigen::Vector3d::Zero();
+  ICPMetric metric = ICPMetric::PointToPlane;
+  ICPKernel kernel = ICPKernel::None;
+  // Kernel width in distance units (0 = the kernel's tuning constant times
+  // a robust residual scale, 1.4826 * median |r|, every iteration)
+  double kernel_scale = 0.0;
+  // Trimmed ICP: keep only this fraction of the sample pairs, those with
+  // the smallest residuals (1 = keep all)
+  double trim_fraction = 1.0;
+  // Sample the source once and move the same points with the pose every
+  // iteration, instead of resampling the moved source each iteration
+  bool fixed_samples = false;
+  // Seed of the source sampling (0 = nondeterministic)
+  std::uint32_t seed = 0;
+  // Called after every iteration on the thread running the loop (empty = off)
+  std::function<void(const ICPIteration&)> callback;
+};
+
+// Transform plus per-iteration history of an ICP run
+struct ICPResult {
+  Eigen::Matrix3d R = Eigen::Matrix3d::Identity();
+  Eigen::Vector3d t = Eigen::Vector3d::Zero();
+  // RMS closest-point distance of the samples before each update
+  std::vector<double> rmse;
+  // RMS motion of the samples in each update, relative to the target's
+  // bounding box diagonal
+  std::vector<double> step;
+  bool converged = false;
+  // Wall time and iteration count of each level of icp_pyramid
+  std::vector<double> level_seconds;
+  std::vector<int> level_iterations;
+  int iterations() const { return static_cast<int>(rmse.size()); }
+  // The same transform as one 4x4 matrix acting on column vectors,
+  // T * [x; 1] = [R^T x + t; 1], as used by Open3D
+  Eigen::Matrix4d transform() const {
+    Eigen::Matrix4d T = Eigen::Matrix4d::Identity();
+    T.topLeftCorner<3, 3>() = R.transpose();
+    T.topRightCorner<3, 1>() = t;
+    return T;
+  }
+};
+
+// Target mesh (VB, FB) whose AABB tree and face normals are built once and
+// reused by every ICP call against it.
+class ICPTarget {
+ public:
+  ICPTarget(const Eigen::MatrixXd& VB, const Eigen::MatrixXi& FB);
+  // From float32/float64 vertices and int32/int64 faces; the target is
+  // copied once into the tree's storage
+  template <typename Scalar, typename Index>
+  ICPTarget(const RowMatrixXRef<Scalar>& VB, const RowMatrixXRef<Index>& FB);
+
+  // Convenience: load the target mesh from a path
+  static ICPTarget from_path(const std::string& path_b);
+
+  // ICP loop of igl::iterative_closest_point with early termination, a
+  // per-iteration history and the metric, kernel, trimming and sampling
+  // choices of options. The source is read in place: samples are drawn on
+  // (VA, FA) and then moved, so VA is never transformed or copied.
+  // Instantiated for float/double vertices and int32/int64 faces.
+  template <typename Scalar, typename Index>
+  ICPResult icp(const RowMatrixXRef<Scalar>& VA,
+                const RowMatrixXRef<Index>& FA,
+                const ICPOptions& options = ICPOptions()) const;
+  ICPResult icp(const Eigen::MatrixXd& VA, const Eigen::MatrixXi& FA,
+                const ICPOptions& options = ICPOptions()) const;
+
+  // Coarse-to-fine ICP: run icp once per level, each level starting from
+  // the transform of the previous one (levels[0].R0/t0 seed the first).
+  // The histories of all levels are concatenated.
+  template <typename Scalar, typename Index>
+  ICPResult icp_pyramid(const RowMatrixXRef<Scalar>& VA,
+                        const RowMatrixXRef<Index>& FA,
+                        const std::vector<ICPOptions>& levels) const;
+  ICPResult icp_pyramid(const Eigen::MatrixXd& VA, const Eigen::MatrixXi& FA,
+                        const std::vector<ICPOptions>& levels) const;
+
+  const Eigen::MatrixXd& V() const { return VB_; }
+  const Eigen::MatrixXi& F() const { return FB_; }
+  double diagonal() const { return diag_; }
+
+ private:
+  // Build the tree, normals and diagonal from VB_, FB_
+  void init();
+
+  Eigen::MatrixXd VB_;
+  Eigen::MatrixXi FB_;
+  Eigen::MatrixXd NB_;
+  double diag_;
+  igl::AABB<Eigen::MatrixXd, 3> tree_;
+};
@@ -0,0 +1,56 @@
+#pragma once
+
+#include <algorithm>
+#include <atomic>
+#include <exception>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+// Run fn(i) for i in [0, n) on up to num_threads native threads (0 = all
+// hardware threads). Work is handed out one index at a time so uneven jobs
+// balance across threads. The first exception thrown by fn is rethrown on the
+// calling thread once all workers have stopped.
+template <typename Fn>
+void parallel_for(size_t n, int num_threads, const Fn& fn) {
+  size_t threads = num_threads > 0 ? static_cast<size_t>(num_threads)
+                                   : std::thread::hardware_concurrency();
+  threads = std::max<size_t>(1, std::min(threads, n));
+  if (threads <= 1) {
+    for (size_t i = 0; i < n; ++i) {
+      fn(i);
+    }
+    return;
+  }
+
+  std::atomic<size_t> next(0);
+  std::atomic<bool> failed(false);
+  std::exception_ptr error;
+  std::mutex error_mutex;
+  auto worker = [&]() {
+    for (size_t i = next++; i < n && !failed; i = next++) {
+      try {
+        fn(i);
+      } catch (...) {
+        std::lock_guard<std::mutex> lock(error_mutex);
+        if (!error) {
+          error = std::current_exception();
+        }
+        failed = true;
+      }
+    }
+  };
+
+  std::vector<std::thread> pool;
+  pool.reserve(threads - 1);
+  for (size_t k = 0; k + 1 < threads; ++k) {
+    pool.emplace_back(worker);
+  }
+  worker();
+  for (auto& th : pool) {
+    th.join();
+  }
+  if (error) {
+    std::rethrow_exception(error);
+  }
+}
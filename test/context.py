@@ -2,6 +2,8 @@ import numpy as np
 import gpytoolbox as gpy
 import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+# The registration scripts, for their NumPy-only modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../scripts')))
 import meshapprox
 import utility
 import unittest
\ No newline at end of file
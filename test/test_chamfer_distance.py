@@ -18,6 +18,26 @@ class TestChamferDistance(unittest.TestCase):
         # check that the chamfer distances decrease
         for i in range(len(cds)-1):
             self.assertTrue(cds[i+1] < cds[i])
+    def test_chunk_size_does_not_change_result(self):
+        V, F = gpy.read_mesh("data/bunny.obj")
+        n = 100000
+        cds = [utility.chamfer_distance(V,F,V+0.01,F,n=n,chunk_size=c,rng=np.random.default_rng(0))
+               for c in [n, 1000]]
+        self.assertAlmostEqual(cds[0], cds[1], places=3)
+    def test_one_sided_and_truncated(self):
+        V, F = gpy.read_mesh("data/bunny.obj")
+        W = V + 0.05
+        one = utility.chamfer_distance(V,F,W,F,n=50000,one_sided=True)
+        both = utility.chamfer_distance(V,F,W,F,n=50000)
+        self.assertTrue(0.0 < one < both)
+        # each truncated direction is at most the truncation
+        cd = utility.chamfer_distance(V,F,W,F,n=50000,truncation=0.01)
+        self.assertTrue(cd <= 2*0.01 + 1e-12)
+    def test_tree_reused_for_many_queries(self):
+        V, F = gpy.read_mesh("data/bunny.obj")
+        tree = utility.ChamferTree(V, F, n=100000)
+        d0 = tree.mean_squared_distance(V, F, n=10000)
+        d1 = tree.mean_squared_distance(V+0.05, F, n=10000)
+        self.assertTrue(d0 < d1)
     def test_something_else(self):
         pass
-            
\ No newline at end of file
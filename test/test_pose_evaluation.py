@@ -0,0 +1,58 @@
+from .context import *
+import open3d as o3d
+from pose_evaluation import PoseEvaluator
+
+
+def random_pose(rng, angle, shift):
+    axis = rng.normal(size=3)
+    axis /= np.linalg.norm(axis)
+    K = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    T = np.eye(4)
+    T[:3, :3] = np.eye(3) + np.sin(angle) * K + (1 - np.cos(angle)) * K @ K
+    T[:3, 3] = rng.normal(size=3) * shift
+    return T
+
+
+class TestPoseEvaluation(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        V, F = gpy.read_mesh("data/bunny.obj", reader="Python")
+        self.target = V
+        self.source = V[rng.choice(len(V), 1000, replace=False)] + rng.normal(size=(1000, 3)) * 1e-3
+        # Poses from aligned to clearly off, so fitness varies between them
+        self.poses = np.stack([random_pose(rng, a, s) for a, s in
+                               [(0.0, 0.0), (0.05, 0.005), (0.1, 0.01), (0.3, 0.02), (0.6, 0.05)]])
+        self.max_distance = 0.01
+
+    def reference(self):
+        source = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(self.source))
+        target = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(self.target))
+        results = [o3d.pipelines.registration.evaluate_registration(
+            source, target, self.max_distance, T) for T in self.poses]
+        return np.array([r.fitness for r in results]), np.array([r.inlier_rmse for r in results])
+
+    def check(self, metrics):
+        fitness, rmse = self.reference()
+        self.assertTrue(fitness.min() < 0.9)
+        np.testing.assert_allclose(metrics["fitness"], fitness, atol=1e-12)
+        np.testing.assert_allclose(metrics["inlier_rmse"], rmse, atol=1e-9)
+
+    def test_matches_evaluate_registration(self):
+        evaluator = PoseEvaluator(self.target)
+        self.check(evaluator.evaluate(self.source, self.poses, self.max_distance))
+
+    def test_truncation_does_not_change_inliers(self):
+        evaluator = PoseEvaluator(self.target)
+        for truncation in [0.2 * self.max_distance, 5 * self.max_distance]:
+            metrics = evaluator.evaluate(self.source, self.poses, self.max_distance,
+                                         chamfer=True, chamfer_truncation=truncation)
+            self.check(metrics)
+            self.assertTrue(np.all(metrics["chamfer"] <= 2 * truncation + 1e-12))
+
+    def test_chunks_do_not_change_result(self):
+        evaluator = PoseEvaluator(self.target)
+        full = evaluator.evaluate(self.source, self.poses, self.max_distance, chamfer=True)
+        chunked = evaluator.evaluate(self.source, self.poses, self.max_distance, chamfer=True,
+                                     chunk_size=300)
+        for name in full:
+            np.testing.assert_allclose(chunked[name], full[name])
@@ -1 +1 @@
-from .chamfer_distance import chamfer_distance
\ No newline at end of file
+from .chamfer_distance import chamfer_distance, ChamferTree
\ No newline at end of file
@@ -1,9 +1,61 @@
 import gpytoolbox as gpy
 import numpy as np
+from scipy.spatial import cKDTree
 
-def chamfer_distance(v1,f1,v2,f2,n=1000000):
-    P1 = gpy.random_points_on_mesh(v1,f1,n)
-    P2 = gpy.random_points_on_mesh(v2,f2,n)
-    d1 = gpy.squared_distance(P1,P2,use_aabb=True,use_cpp=True)[0]
-    d2 = gpy.squared_distance(P2,P1,use_aabb=True,use_cpp=True)[0]
-    return np.sqrt(np.mean(d1)) + np.sqrt(np.mean(d2))
\ No newline at end of file
+
+class ChamferTree:
+    """
+    n random points on a mesh (v,f) with a KD-tree built once, for
+    streaming nearest-neighbor queries from other meshes in bounded memory.
+    """
+
+    def __init__(self, v, f, n=1000000, rng=None):
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.points = gpy.random_points_on_mesh(v, f, n, rng=self.rng)
+        self.tree = cKDTree(self.points)
+
+    def squared_distances(self, P, truncation=None):
+        """Squared distances from the query points P to the nearest tree point."""
+        if truncation is None:
+            d = self.tree.query(P, k=1, workers=-1)[0]
+        else:
+            # Points beyond the bound come back as inf without a full search
+            d = self.tree.query(P, k=1, workers=-1, distance_upper_bound=truncation)[0]
+            d = np.minimum(d, truncation)
+        return d * d
+
+    def mean_squared_distance(self, v, f, n=1000000, chunk_size=1 << 18, truncation=None):
+        """
+        Mean squared distance from n random points on (v,f) to the tree
+        points. Query points are sampled and queried chunk_size at a time,
+        so memory does not grow with n. With truncation, distances are
+        clamped to at most truncation.
+        """
+        total = 0.0
+        for start in range(0, n, chunk_size):
+            m = min(chunk_size, n - start)
+            P = gpy.random_points_on_mesh(v, f, m, rng=self.rng)
+            total += np.sum(self.squared_distances(P, truncation))
+        return total / n
+
+
+def chamfer_distance(v1, f1, v2, f2, n=1000000, chunk_size=1 << 18,
+                     one_sided=False, truncation=None, rng=None):
+    """
+    Chamfer distance between meshes (v1,f1) and (v2,f2) estimated with n
+    random points on each: the sum of the RMS nearest-neighbor distances in
+    both directions. With one_sided, only the distance from (v1,f1) to
+    (v2,f2) is returned. With truncation, each nearest-neighbor distance is
+    clamped to at most truncation, so outliers and partial overlap do not
+    dominate.
+    """
+    tree2 = ChamferTree(v2, f2, n, rng=rng)
+    d1 = tree2.mean_squared_distance(v1, f1, n, chunk_size, truncation)
+    if one_sided:
+        return np.sqrt(d1)
+    # Drop the first tree before building the second to bound peak memory
+    rng = tree2.rng
+    del tree2
+    tree1 = ChamferTree(v1, f1, n, rng=rng)
+    d2 = tree1.mean_squared_distance(v2, f2, n, chunk_size, truncation)
+    return np.sqrt(d1) + np.sqrt(d2)